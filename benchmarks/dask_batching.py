@@ -0,0 +1,109 @@
+"""Compares the time to serve the chunks of a dask-backed array with lazy
+operations (a channel of affinities, thresholded) by computing each chunk
+request separately (without ``dask_batcher``) and with a ``DaskBatcher``.
+Chunks are requested concurrently, as by the neuroglancer server.
+
+Usage:
+
+    python benchmarks/dask_batching.py [--size 256] [--chunk-size 64] [--threads 8]
+"""
+
+import argparse
+import itertools
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import neuroglancer
+import numpy as np
+import zarr
+from funlib.persistence import Array
+
+from funlib.show.neuroglancer import DaskBatcher, LocalVolume
+from funlib.show.neuroglancer.add_layer import get_volume_data
+
+
+def create_array(path, size, chunk_size):
+    data = zarr.open_array(
+        path,
+        mode="w",
+        shape=(3, size, size, size),
+        chunks=(1, chunk_size, chunk_size, chunk_size),
+        dtype=np.float32,
+    )
+    data[:] = np.random.default_rng(0).uniform(size=data.shape).astype(np.float32)
+    array = Array(
+        zarr.open_array(path, mode="r"),
+        voxel_size=(4, 4, 4),
+        axis_names=["c^", "z", "y", "x"],
+        chunks=(1, chunk_size, chunk_size, chunk_size),
+    )
+    array.lazy_op(np.s_[0])
+    array.lazy_op(lambda d: (d > 0.5).astype(np.uint8))
+    return array
+
+
+def serve(volume, size, chunk_size, num_threads, repeat):
+    starts = list(itertools.product(range(0, size, chunk_size), repeat=3))
+
+    def get_chunk(start):
+        # as parsed by the neuroglancer server
+        start = np.array(start)
+        end = start + chunk_size
+        return volume.get_encoded_subvolume("raw", start, end)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            chunks = list(executor.map(get_chunk, starts))
+        duration = time.perf_counter() - start_time
+    return chunks, duration / (repeat * len(starts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scheduler", type=str, default="threads")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        array = create_array(directory + "/affs.zarr", args.size, args.chunk_size)
+        dimensions = neuroglancer.CoordinateSpace(
+            names=["z", "y", "x"], units="nm", scales=[4, 4, 4]
+        )
+        print(
+            "%d^3 voxels in chunks of %d^3, requested from %d threads"
+            % (args.size, args.chunk_size, args.threads)
+        )
+
+        results = []
+        for name, dask_batcher in [
+            ("per-request compute", None),
+            ("DaskBatcher", DaskBatcher(scheduler=args.scheduler)),
+        ]:
+            volume = LocalVolume(
+                dimensions=dimensions,
+                volume_type="segmentation",
+                **get_volume_data(array, dask_batcher=dask_batcher),
+            )
+            chunks, duration = serve(
+                volume, args.size, args.chunk_size, args.threads, args.repeat
+            )
+            results.append(chunks)
+            print(f"{name:>20}: {duration * 1e3:8.2f} ms per chunk")
+            if dask_batcher is not None:
+                print(f"{'':>20}  {dask_batcher}")
+
+        # both serve the same chunks
+        assert results[0] == results[1]
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compares the time to get the meshes of a number of objects from
+neuroglancer's on-demand mesh generator (the default of ``add_layer``) and
+from a ``MeshGenerator``, for the first and a coarser scale, before and after
+the meshes are cached.
+
+Usage:
+
+    python benchmarks/meshes.py [--size 256] [--segment-size 16] [--objects 100]
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import neuroglancer
+import numpy as np
+
+from funlib.show.neuroglancer import LocalVolume, MeshGenerator, MeshService
+
+
+def create_labels(size, segment_size, seed=0):
+    # blocky segments of segment_size^3 voxels with random IDs
+    rng = np.random.default_rng(seed)
+    grid_size = -(-size // segment_size)
+    labels = rng.permutation(grid_size**3).astype(np.uint64) + 1
+    labels = labels.reshape((grid_size,) * 3)
+    for axis in range(3):
+        labels = np.repeat(labels, segment_size, axis=axis)
+    return np.ascontiguousarray(labels[:size, :size, :size])
+
+
+def create_volume(labels, scale):
+    return LocalVolume(
+        data=labels,
+        dimensions=neuroglancer.CoordinateSpace(
+            names=["z", "y", "x"], units="nm", scales=[4 * scale] * 3
+        ),
+        volume_type="segmentation",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--segment-size", type=int, default=16)
+    parser.add_argument("--objects", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    labels = create_labels(args.size, args.segment_size)
+    s0 = create_volume(labels, 1)
+    s1 = create_volume(np.ascontiguousarray(labels[::2, ::2, ::2]), 2)
+    object_ids = [int(i) for i in np.unique(labels[: args.size // 2])]
+    object_ids = object_ids[: args.objects]
+    print(
+        "%d objects of %d^3 voxels in a %d^3 volume"
+        % (len(object_ids), args.segment_size, args.size)
+    )
+
+    start_time = time.perf_counter()
+    for object_id in object_ids:
+        s0.get_object_mesh(object_id)
+    print(f"{'neuroglancer':>24}: {time.perf_counter() - start_time:8.2f}s")
+
+    cache_dir = tempfile.mkdtemp()
+    service = MeshService(num_workers=args.workers, cache_dir=cache_dir)
+    # start the worker processes
+    service.submit(abs, 0).result()
+    try:
+        for name, volume in [("s0", s0), ("s1", s1)]:
+            generator = MeshGenerator(service, volume, s0, "benchmark")
+            start_time = time.perf_counter()
+            generator.generate(object_ids)
+            duration = time.perf_counter() - start_time
+            print(f"{'MeshGenerator ' + name:>24}: {duration:8.2f}s")
+
+            start_time = time.perf_counter()
+            for object_id in object_ids:
+                generator.get_mesh(object_id)
+            duration = time.perf_counter() - start_time
+            print(f"{'MeshGenerator ' + name + ', cached':>24}: {duration:8.2f}s")
+    finally:
+        service.shutdown()
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Measures the per-frame overhead of setting the viewer state (and the states
+to prefetch) in ``run_render``, for full state updates and camera-only
+updates. No frames are captured.
+
+Usage:
+
+    python benchmarks/render_state_updates.py [--layers 30] [--segments 100000]
+"""
+
+import argparse
+import time
+
+import neuroglancer
+import numpy as np
+
+from funlib.show.neuroglancer.video_tool import (
+    RenderStates,
+    camera_json_keys,
+    get_render_frames,
+    set_render_state,
+)
+
+
+def create_viewer(num_layers, num_segments):
+    viewer = neuroglancer.Viewer()
+    dimensions = neuroglancer.CoordinateSpace(
+        names=["z", "y", "x"], units="nm", scales=[4, 4, 4]
+    )
+    with viewer.txn() as s:
+        s.dimensions = dimensions
+        for i in range(num_layers):
+            s.layers["raw_%d" % i] = neuroglancer.ImageLayer(
+                source=neuroglancer.LocalVolume(
+                    data=np.zeros((8, 8, 8), dtype=np.uint8), dimensions=dimensions
+                )
+            )
+        s.layers["labels"] = neuroglancer.SegmentationLayer(
+            source=neuroglancer.LocalVolume(
+                data=np.zeros((8, 8, 8), dtype=np.uint64), dimensions=dimensions
+            ),
+            segments=set(range(1, num_segments + 1)),
+        )
+    return viewer
+
+
+def create_keypoints(viewer, num_keypoints):
+    keypoints = []
+    for i in range(num_keypoints):
+        state = neuroglancer.ViewerState(viewer.state.to_json())
+        state.position = [10 * i, 20 * i, 30 * i]
+        state.cross_section_scale = 1 + i
+        state.projection_orientation = [np.sin(i / 4), 0, 0, np.cos(i / 4)]
+        keypoints.append({"state": state, "transition_duration": 1})
+    return keypoints
+
+
+def set_full_state(viewer, cur_state, prefetch_states):
+    # as run_render does with state_updates = "full"
+    prev_state = viewer.state.to_json()
+    cur_state = cur_state.to_json()
+    cur_state["layers"] = prev_state["layers"]
+    cur_state = neuroglancer.ViewerState(cur_state)
+    viewer.set_state(cur_state)
+    with viewer.config_state.txn() as s:
+        del s.prefetch[:]
+        for i, state in enumerate(prefetch_states):
+            s.prefetch.append(
+                neuroglancer.PrefetchState(
+                    state=state, priority=len(prefetch_states) - i
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=30)
+    parser.add_argument("--segments", type=int, default=100000)
+    parser.add_argument("--keypoints", type=int, default=3)
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--prefetch", type=int, default=4)
+    args = parser.parse_args()
+
+    viewer = create_viewer(args.layers, args.segments)
+    keypoints = create_keypoints(viewer, args.keypoints)
+    frames = get_render_frames(keypoints, args.fps)
+    print(
+        "%d frames, %d layers, %d selected segments, %d prefetched states"
+        % (len(frames), args.layers + 1, args.segments, args.prefetch)
+    )
+
+    # full updates, interpolated without layers (interpolating layers fails in
+    # some versions of neuroglancer, and they are replaced by set_full_state)
+    start_time = time.perf_counter()
+    keypoint_states = [
+        neuroglancer.ViewerState(dict(k["state"].to_json(), layers=[]))
+        for k in keypoints
+    ]
+    states = [
+        neuroglancer.ViewerState.interpolate(
+            keypoint_states[i], keypoint_states[i + 1], t
+        )
+        for _, i, t in frames
+    ]
+    interpolation_time = time.perf_counter() - start_time
+    full_states = []
+    start_time = time.perf_counter()
+    for index in range(len(frames)):
+        set_full_state(
+            viewer, states[index], states[index + 1 : index + 1 + args.prefetch]
+        )
+        full_states.append(viewer.shared_state.raw_state)
+    full_time = time.perf_counter() - start_time + interpolation_time
+
+    # camera updates
+    start_time = time.perf_counter()
+    render_states = RenderStates(
+        [k["state"] for k in keypoints], viewer.shared_state.raw_state["layers"]
+    )
+    states = [render_states.get_state(i, t) for _, i, t in frames]
+    interpolation_time = time.perf_counter() - start_time
+    camera_states = []
+    start_time = time.perf_counter()
+    for index in range(len(frames)):
+        set_render_state(
+            viewer, states[index], states[index + 1 : index + 1 + args.prefetch]
+        )
+        camera_states.append(viewer.shared_state.raw_state)
+    camera_time = time.perf_counter() - start_time + interpolation_time
+
+    # both modes result in the same viewer states
+    for full_state, camera_state in zip(full_states, camera_states):
+        assert full_state.keys() == camera_state.keys()
+        for key in full_state:
+            if key in camera_json_keys.values():
+                np.testing.assert_allclose(full_state[key], camera_state[key])
+            else:
+                assert full_state[key] == camera_state[key]
+
+    for name, total in [("full", full_time), ("camera", camera_time)]:
+        print(f"{name:>10}: {total / len(frames) * 1e3:8.2f} ms per frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Measures the per-request cost of resolving a chunk request's scale key to a
+level of a ``ScalePyramid``.
+
+Usage:
+
+    python benchmarks/scale_pyramid.py [--levels 10] [--repeat 100000]
+"""
+
+import argparse
+import timeit
+
+import neuroglancer
+import numpy as np
+
+from funlib.show.neuroglancer import ScalePyramid
+
+
+def create_pyramid(num_levels):
+    volume_layers = []
+    for level in range(num_levels):
+        factor = 2**level
+        volume_layers.append(
+            neuroglancer.LocalVolume(
+                data=np.zeros((2, 2, 2), dtype=np.uint8),
+                dimensions=neuroglancer.CoordinateSpace(
+                    names=["z", "y", "x"],
+                    units="nm",
+                    scales=[4 * factor, 4 * factor, 4 * factor],
+                ),
+            )
+        )
+    return ScalePyramid(volume_layers)
+
+
+def resolve_uncached(pyramid, scale_key):
+    # the lookup as it was done before memoization: parse the key and search
+    # all levels for every request
+    scale = tuple(int(s) for s in scale_key.split(","))
+    closest_scale = pyramid._find_closest_scale(scale)
+    relative_scale = np.array(scale) // np.array(closest_scale)
+    return (
+        pyramid.volume_layers[closest_scale],
+        ",".join(map(str, relative_scale)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=100000)
+    args = parser.parse_args()
+
+    pyramid = create_pyramid(args.levels)
+    # a mix of stored and intermediate scales, as requested by neuroglancer
+    scale_keys = [
+        ",".join((str(2**level),) * 3) for level in range(args.levels + 2)
+    ] + ["1,2,2", "2,4,4", "4,8,8"]
+
+    for scale_key in scale_keys:
+        assert resolve_uncached(pyramid, scale_key) == pyramid._resolve_scale(scale_key)
+
+    for name, func in [
+        ("uncached", resolve_uncached),
+        ("memoized", ScalePyramid._resolve_scale),
+    ]:
+        total = timeit.timeit(
+            lambda: [func(pyramid, scale_key) for scale_key in scale_keys],
+            number=args.repeat // len(scale_keys),
+        )
+        per_request = total / (args.repeat // len(scale_keys) * len(scale_keys))
+        print(f"{name:>10}: {per_request * 1e6:8.3f} us per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,45 @@
 from .video_tool import (
     RenderArgs as RenderArgs,
+    convert_script as convert_script,
+    load_script as load_script,
+    save_script as save_script,
     run_edit as run_edit,
     run_render as run_render,
 )
 from .scale_pyramid import ScalePyramid as ScalePyramid
-from .add_layer import add_layer as add_layer
+from .add_layer import (
+    add_layer as add_layer,
+    add_annotation_layer as add_annotation_layer,
+)
+from .derived_array import create_derived_array as create_derived_array
+from .annotation_source import (
+    AnnotationSource as AnnotationSource,
+    open_annotations as open_annotations,
+)
+from .chunk_cache import (
+    ChunkCache as ChunkCache,
+    DecodedChunkCache as DecodedChunkCache,
+)
+from .chunk_aligned_array import ChunkAlignedArray as ChunkAlignedArray
+from .local_volume import LocalVolume as LocalVolume
+from .metadata_cache import MetadataCache as MetadataCache
+from .headless import HeadlessRenderer as HeadlessRenderer
+from .pyramid_builder import PyramidBuilder as PyramidBuilder
+from .io_pool import ChunkRequestPool as ChunkRequestPool
+from .dask_batcher import (
+    BatchedDaskArray as BatchedDaskArray,
+    DaskBatcher as DaskBatcher,
+)
+from .serving_policy import ServingPolicy as ServingPolicy
+from .metrics import ChunkMetrics as ChunkMetrics
+from .mesh_service import (
+    MeshGenerator as MeshGenerator,
+    MeshService as MeshService,
+)
+from .frame_sink import (
+    FrameSink as FrameSink,
+    PngDirectorySink as PngDirectorySink,
+    VideoSink as VideoSink,
+    ArchiveSink as ArchiveSink,
+    JournaledSink as JournaledSink,
+)
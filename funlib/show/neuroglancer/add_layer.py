@@ -1,12 +1,19 @@
+from .annotation_source import AnnotationSource
+from .chunk_aligned_array import ChunkAlignedArray, get_chunk_layout
+from .dask_batcher import BatchedDaskArray
+from .local_volume import LocalVolume
+from .mesh_service import MeshGenerator
 from .scale_pyramid import ScalePyramid
+import dask.array as da
 import neuroglancer
+import numpy as np
 from funlib.persistence import Array
 
 
 rgb_shader_code = """
 void main() {
     emitRGB(
-        vec3(
+        %f * vec3(
             toNormalized(getDataValue(%i)),
             toNormalized(getDataValue(%i)),
             toNormalized(getDataValue(%i)))
@@ -27,6 +34,31 @@ void main() {
   emitGrayscale(255.0*toNormalized(getDataValue()));
 }"""
 
+grayscale_shader_code = """
+%s
+void main() {
+    emitGrayscale(normalized());
+}"""
+
+rgb_auto_shader_code = """
+%s
+void main() {
+    emitRGB(
+        vec3(
+            %s,
+            %s,
+            %s)
+        );
+}"""
+
+projected_rgb_shader_code = """
+%s
+void main() {
+    vec3 color = vec3(0.0);
+%s
+    emitRGB(color / %f);
+}"""
+
 heatmap_shader_code = """
 void main() {
     float v = toNormalized(getDataValue(0));
@@ -62,40 +94,130 @@ def create_coordinate_space(
     )
 
 
-def guess_shader_code(array: Array):
+def compute_statistics(
+    array: Array | list[Array], max_chunks=16, max_samples_per_chunk=2**16, seed=0
+):
+    """Estimate the intensity range of ``array`` from a bounded random sample
+    of its storage chunks, without reading all of it. For a list of arrays
+    (a multiscale pyramid), only the coarsest level is sampled.
+
+    Returns a JSON serializable dict with the ``min`` and ``max`` of the
+    sampled values, the ``low`` and ``high`` percentiles (0.5 and 99.5) to use
+    as contrast window, and the indices of the sampled ``chunks`` (``None`` if
+    the array is not chunked).
     """
-    TODO: This function is not used yet.
-    It should make some reasonable guesses for basic visualization parameters.
-    Guess volume type (or read from optional metadata?):
-        - bool/uint32/uint64/int32/int64 -> Segmentation
-        - floats/int8/uint8 -> Image
-    Guess shader for Image volumes:
-        - 1 channel dimension:
-            - 1 channel -> grayscale (add shader options for color and threshold)
-            - 2 channels -> projected RGB (set B to 0 or 1 or R+G?)
-            - 3 channels -> RGB
-            - 4 channels -> projected RGB (PCA? Random linear combinations? Randomizable with "l" key?)
-        - multiple channel dimensions?:
+
+    if isinstance(array, list):
+        array = max(array, key=lambda a: tuple(a.voxel_size))
+
+    rng = np.random.default_rng(seed)
+    data = array.data
+    if hasattr(data, "blocks"):
+        num_chunks = int(np.prod(data.numblocks))
+        chunk_indices = rng.choice(
+            num_chunks, min(max_chunks, num_chunks), replace=False
+        )
+        chunk_indices = [
+            [int(c) for c in np.unravel_index(i, data.numblocks)] for i in chunk_indices
+        ]
+        chunks = (data.blocks[tuple(c)] for c in chunk_indices)
+    else:
+        chunk_indices = None
+        chunks = [data]
+
+    samples = []
+    for chunk in chunks:
+        values = np.asarray(chunk).ravel()
+        if len(values) > max_samples_per_chunk:
+            values = values[rng.integers(0, len(values), max_samples_per_chunk)]
+        samples.append(values)
+    samples = np.concatenate(samples).astype(np.float64)
+    samples = samples[np.isfinite(samples)]
+
+    if len(samples) == 0:
+        return {
+            "min": 0.0,
+            "max": 1.0,
+            "low": 0.0,
+            "high": 1.0,
+            "chunks": chunk_indices,
+        }
+
+    low, high = np.percentile(samples, [0.5, 99.5])
+    return {
+        "min": float(samples.min()),
+        "max": float(samples.max()),
+        "low": float(low),
+        "high": float(high),
+        "chunks": chunk_indices,
+    }
+
+
+def guess_shader_code(array: Array, statistics=None):
+    """Guess a shader for ``array``:
+
+        - segmentation volumes (see ``get_volume_type``) -> neuroglancer's
+          default segmentation shader (``None``)
+        - no or a single channel -> grayscale
+        - 2 channels -> red and green
+        - 3 channels -> RGB
+        - more channels -> projected to RGB, with the hue of each channel
+          evenly spaced
+        - multiple channel dimensions -> neuroglancer's default shader
+          (``None``)
+
+    If ``statistics`` (as computed by ``compute_statistics``) are given, the
+    contrast window is set to their ``low`` and ``high`` values.
     """
-    raise NotImplementedError()
+
+    if get_volume_type(array) == "segmentation":
+        return None
+
     channel_dim_shapes = [
         array.shape[i]
         for i in range(len(array.axis_names))
         if "^" in array.axis_names[i]
     ]
-    if len(channel_dim_shapes) == 0:
-        return None  # default shader
-
-    if len(channel_dim_shapes) == 1:
-        num_channels = channel_dim_shapes[0]
-        if num_channels == 1:
-            return None  # default shader
-        if num_channels == 2:
-            return projected_rgb_shader_code % num_channels
-        if num_channels == 3:
-            return rgb_shader_code % (0, 1, 2)
-        if num_channels > 3:
-            return projected_rgb_shader_code % num_channels
+    if len(channel_dim_shapes) > 1:
+        return None
+    num_channels = channel_dim_shapes[0] if channel_dim_shapes else 1
+
+    if statistics is not None:
+        low, high = statistics["low"], statistics["high"]
+        if high <= low:
+            low, high = statistics["min"], statistics["max"]
+        if np.issubdtype(array.dtype, np.integer):
+            # invlerp ranges of integer data have to be integers
+            low, high = int(np.floor(low)), int(np.ceil(high))
+        if high <= low:
+            high = low + 1
+        control = "#uicontrol invlerp normalized(range=[%r, %r])" % (low, high)
+    else:
+        control = "#uicontrol invlerp normalized"
+
+    if num_channels == 1:
+        return grayscale_shader_code % control
+
+    if num_channels <= 3:
+        channels = ["normalized(getDataValue(%d))" % c for c in range(num_channels)]
+        channels += ["0.0"] * (3 - num_channels)
+        return rgb_auto_shader_code % ((control,) + tuple(channels))
+
+    colors = []
+    for c in range(num_channels):
+        hue = c / num_channels
+        # evenly spaced hues at full saturation and value
+        color = np.clip(np.abs((hue * 6 + np.array([0, 4, 2])) % 6 - 3) - 1, 0, 1)
+        colors.append(
+            "    color += normalized(getDataValue(%d)) * vec3(%f, %f, %f);"
+            % ((c,) + tuple(color))
+        )
+    return projected_rgb_shader_code % (
+        control,
+        "\n".join(colors),
+        # normalize, such that all channels at maximum give white
+        num_channels / 3,
+    )
 
 
 def create_shader_code(
@@ -135,6 +257,39 @@ def create_shader_code(
         return heatmap_shader_code
 
 
+def get_volume_type(array: Array):
+    """Guess the neuroglancer volume type of ``array``: ``"segmentation"`` for
+    label arrays (``uint32`` or ``uint64`` without channel dimensions, and 3D
+    ``uint16`` arrays, as guessed by neuroglancer), ``"image"`` otherwise."""
+
+    if array.channel_dims == 0 and (
+        array.dtype in (np.uint32, np.uint64)
+        or (array.dtype == np.uint16 and array.spatial_dims == 3)
+    ):
+        return "segmentation"
+    return "image"
+
+
+def get_volume_data(array: Array, storage_cache=None, dask_batcher=None):
+    """Get the data and chunk layout arguments for a ``LocalVolume`` showing
+    ``array``. If a ``storage_cache`` is given and ``array`` is chunked, reads
+    are aligned to its storage chunks. If a ``dask_batcher`` is given, reads
+    are aligned to the blocks of the dask array of ``array`` and computed in
+    batches."""
+
+    if dask_batcher is not None and isinstance(array.data, da.Array):
+        data = BatchedDaskArray(array.data, dask_batcher, storage_cache)
+    elif storage_cache is not None and hasattr(array.data, "chunks"):
+        data = ChunkAlignedArray(array.data, storage_cache)
+    else:
+        return {"data": array.data}
+
+    return {
+        "data": data,
+        **get_chunk_layout(data.chunk_shape, array.axis_names),
+    }
+
+
 def add_layer(
     context,
     array: Array | list[Array],
@@ -145,6 +300,18 @@ def add_layer(
     color=None,
     visible=True,
     value_scale_factor=1.0,
+    chunk_cache=None,
+    native_scales=False,
+    storage_cache=None,
+    io_pool=None,
+    statistics=None,
+    serving_policy=None,
+    mesh_service=None,
+    mesh_level=1,
+    mesh_key=None,
+    mesh_version=None,
+    dask_batcher=None,
+    metrics=None,
 ):
     """Add a layer to a neuroglancer context.
 
@@ -198,6 +365,80 @@ def add_layer(
 
             A float to scale array values with for visualization.
 
+        chunk_cache:
+
+            A ``ChunkCache`` to keep encoded chunks of this layer in. The same
+            cache can be shared between layers. If not given, chunks are read
+            and encoded on every request.
+
+        native_scales:
+
+            If set and a list of arrays is given, only the scales of these
+            arrays are shown and no scales are downsampled on-the-fly.
+
+        storage_cache:
+
+            A ``DecodedChunkCache`` to keep decoded storage chunks of this
+            layer in. If given, all reads are aligned to the storage chunks of
+            ``array``, such that each storage chunk is only decoded once for
+            several (smaller or misaligned) neuroglancer chunks. The same cache
+            can be shared between layers.
+
+        io_pool:
+
+            A ``ChunkRequestPool`` to read and encode chunks of this layer in,
+            usually shared between all layers of a viewer. If not given,
+            chunks are read in the threads of the neuroglancer server.
+
+        statistics:
+
+            Intensity statistics of ``array`` as computed by
+            ``compute_statistics``. If given and no ``shader`` is set, a
+            shader is chosen with ``guess_shader_code`` and its contrast
+            window is set from the statistics.
+
+        serving_policy:
+
+            A ``ServingPolicy`` that limits which chunks of this layer are
+            read from storage (by region of interest and scale), and how many
+            bytes per second. Chunks it does not allow are served as zeros.
+
+        mesh_service:
+
+            A ``MeshService`` to generate (and cache) meshes of segmentation
+            layers in, usually shared between all layers of a viewer. If not
+            given, meshes are generated from the first scale by neuroglancer
+            on each request.
+
+        mesh_level:
+
+            The scale to generate meshes from, if a list of arrays is given
+            (clipped to the coarsest scale).
+
+        mesh_key:
+
+            A unique name of ``array`` (e.g., its path) to cache meshes
+            under. Defaults to ``name``.
+
+        mesh_version:
+
+            The version of the data of ``array`` (e.g., its modification
+            time). Meshes cached for other versions are regenerated.
+
+        dask_batcher:
+
+            A ``DaskBatcher`` to compute the chunks of ``array`` in, in
+            batches of concurrent requests. Worth it for arrays that are
+            computed (e.g., derived arrays or arrays with lazy operations
+            other than slicing), reads of stored arrays are faster without.
+            If not given, each chunk is computed separately.
+
+        metrics:
+
+            A ``ChunkMetrics`` to record the chunk requests of this layer in
+            (counts, bytes sent, and read and encode times, per scale),
+            usually shared between all layers of a viewer.
+
         units:
 
             The units used for resolution and offset.
@@ -207,19 +448,38 @@ def add_layer(
         rgb_channels = [0, 1, 2]
 
     is_multiscale = isinstance(array, list)
+    if is_multiscale:
+        # finest scale first
+        array = sorted(array, key=lambda a: tuple(a.voxel_size))
+
+    if serving_policy is not None:
+        serving_policy = serving_policy.bind(array)
+
+    layer_metrics = metrics.layer(name) if metrics is not None else None
+
+    volume_type = get_volume_type(array[0] if is_multiscale else array)
 
     if is_multiscale:
         dimensions = []
         for a in array:
             dimensions.append(create_coordinate_space(a))
 
+        volumes = [
+            LocalVolume(
+                voxel_offset=voxel_offset,
+                dimensions=array_dims,
+                volume_type=volume_type,
+                **get_volume_data(a, storage_cache, dask_batcher),
+            )
+            for a, (array_dims, voxel_offset) in zip(array, dimensions)
+        ]
         layer = ScalePyramid(
-            [
-                neuroglancer.LocalVolume(
-                    data=a.data, voxel_offset=voxel_offset, dimensions=array_dims
-                )
-                for a, (array_dims, voxel_offset) in zip(array, dimensions)
-            ]
+            volumes,
+            chunk_cache=chunk_cache,
+            native_scales=native_scales,
+            io_pool=io_pool,
+            serving_policy=serving_policy,
+            metrics=layer_metrics,
         )
 
         array = array[0]
@@ -227,16 +487,38 @@ def add_layer(
     else:
         dimensions, voxel_offset = create_coordinate_space(array)
 
-        layer = neuroglancer.LocalVolume(
-            data=array.data,
+        layer = LocalVolume(
             voxel_offset=voxel_offset,
             dimensions=dimensions,
+            volume_type=volume_type,
+            chunk_cache=chunk_cache,
+            io_pool=io_pool,
+            serving_policy=serving_policy,
+            metrics=layer_metrics,
+            **get_volume_data(array, storage_cache, dask_batcher),
+        )
+        volumes = [layer]
+
+    # neuroglancer's mesh generator supports 3D segmentations only
+    if (
+        mesh_service is not None
+        and volume_type == "segmentation"
+        and array.spatial_dims == 3
+    ):
+        layer.mesh_generator = MeshGenerator(
+            mesh_service,
+            volumes[min(mesh_level, len(volumes) - 1)],
+            volumes[0],
+            mesh_key if mesh_key is not None else name,
+            mesh_version,
         )
 
     if shader is not None:
         shader_code = create_shader_code(
             shader, array.channel_dims, rgb_channels, color, value_scale_factor
         )
+    elif statistics is not None:
+        shader_code = guess_shader_code(array, statistics)
     else:
         shader_code = None
 
@@ -260,3 +542,56 @@ def add_layer(
             context.layers.append(
                 name=name, layer=layer, visible=visible, shader=shader_code
             )
+
+
+def add_annotation_layer(
+    context,
+    source: AnnotationSource,
+    name: str,
+    shader: str | None = None,
+    visible=True,
+    linked_segmentation_layer: str | None = None,
+):
+    """Add a layer showing an ``AnnotationSource`` to a neuroglancer context.
+    The annotations are served by the neuroglancer server of this process, by
+    region and level of detail.
+
+    Args:
+
+        context:
+
+            The neuroglancer context to add a layer to, as obtained by
+            ``viewer.txn()``.
+
+        source:
+
+            The ``AnnotationSource`` to show.
+
+        name:
+
+            The name of the layer.
+
+        shader:
+
+            An annotation shader, neuroglancer's default if not given.
+
+        visible:
+
+            A bool which defines the initial layer visibility.
+
+        linked_segmentation_layer:
+
+            The name of a segmentation layer to link all relationships of
+            ``source`` to, such that annotations can be filtered by the
+            selected segments.
+    """
+
+    layer = neuroglancer.AnnotationLayer(source=source.url)
+    if shader is not None:
+        layer.shader = shader
+    if linked_segmentation_layer is not None:
+        layer.linked_segmentation_layer = {
+            relationship: linked_segmentation_layer
+            for relationship in source.relationships
+        }
+    context.layers.append(name=name, layer=layer, visible=visible)
@@ -0,0 +1,537 @@
+"""Serves large sets of point and line annotations (e.g., synapses or skeleton
+graphs) to neuroglancer in its precomputed annotation format, from the
+neuroglancer server of this process.
+
+Annotations are indexed in a multi-level spatial grid: the first level is a
+single cell with a random subset of at most ``limit`` annotations, each
+following level halves the cells and holds a random subset of the remaining
+annotations, up to ``limit`` per cell. Neuroglancer only requests the cells
+in view, and only the levels needed for the current zoom. Annotations can
+also be requested by ID and by related segment (e.g., all edges of a
+skeleton).
+"""
+
+from neuroglancer.random_token import make_random_token
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import neuroglancer
+import numpy as np
+import tornado.web
+import zarr
+
+logger = logging.getLogger(__name__)
+
+ANNOTATION_PATH_REGEX = r"^/funlib/annotations/(?P<token>[^/]+)/(?P<path>.+)$"
+
+# sources served by the neuroglancer server, by token
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+class AnnotationSource:
+    """A set of point or line annotations, served to neuroglancer with a
+    spatial index, an index by ID, and an index by related segment.
+
+    Args:
+
+            dimensions (``neuroglancer.CoordinateSpace``):
+
+                The coordinate space of the annotations.
+
+            annotation_type (``str``):
+
+                ``"point"`` or ``"line"``.
+
+            geometry (``ndarray``):
+
+                The points as an array of shape ``(n, rank)``, or the lines as
+                an array of shape ``(n, 2, rank)`` (start and end points), in
+                the units of ``dimensions``.
+
+            ids (``ndarray``, optional):
+
+                The ``uint64`` IDs of the annotations. Defaults to
+                ``0, ..., n - 1``.
+
+            relationships (``dict``, optional):
+
+                Segment IDs related to each annotation, by name of the
+                relationship, as arrays of shape ``(n,)`` or ``(n, k)``. ID 0
+                means no segment.
+
+            properties (``dict``, optional):
+
+                Numeric properties of the annotations (e.g., a score), by
+                name, as arrays of shape ``(n,)``. Properties are served as
+                ``float32``, ``int32``, or ``uint32``.
+
+            limit (``int``, optional):
+
+                The maximum number of annotations per cell of the spatial
+                index (except in its last level).
+
+            max_levels (``int``, optional):
+
+                The maximum number of levels of the spatial index. The last
+                level holds all remaining annotations.
+    """
+
+    def __init__(
+        self,
+        dimensions,
+        annotation_type,
+        geometry,
+        ids=None,
+        relationships=None,
+        properties=None,
+        limit=1000,
+        max_levels=12,
+    ):
+        if annotation_type not in ("point", "line"):
+            raise ValueError("Unsupported annotation type %s" % annotation_type)
+
+        start_time = time.perf_counter()
+
+        rank = dimensions.rank
+        geometry = np.asarray(geometry, dtype=np.float32)
+        num_points = 1 if annotation_type == "point" else 2
+        geometry = geometry.reshape((-1, num_points * rank))
+        num_annotations = len(geometry)
+        points = geometry.reshape((num_annotations, num_points, rank))
+
+        if ids is None:
+            ids = np.arange(num_annotations, dtype=np.uint64)
+        ids = np.asarray(ids, dtype=np.uint64)
+        if ids.shape != (num_annotations,):
+            raise ValueError("Expected %d annotation IDs" % num_annotations)
+
+        if relationships is None:
+            relationships = {}
+        if properties is None:
+            properties = {}
+
+        self.dimensions = dimensions
+        self.annotation_type = annotation_type
+        self.ids = ids
+        self.relationships = list(relationships)
+        self.num_annotations = num_annotations
+        self.token = make_random_token()
+
+        if num_annotations > 0:
+            self.lower_bound = points.min(axis=(0, 1)).astype(np.float64)
+            self.upper_bound = points.max(axis=(0, 1)).astype(np.float64)
+        else:
+            self.lower_bound = np.zeros(rank)
+            self.upper_bound = np.ones(rank)
+
+        # encoded annotations, with fixed-size properties
+        self.properties = []
+        dtype = [("geometry", "<f4", (num_points * rank,))]
+        for name, values in properties.items():
+            values = np.asarray(values)
+            if values.dtype.kind == "f":
+                property_dtype = np.dtype("<f4")
+            elif values.dtype.kind == "i":
+                property_dtype = np.dtype("<i4")
+            else:
+                property_dtype = np.dtype("<u4")
+            self.properties.append({"id": name, "type": property_dtype.name})
+            dtype.append((name, property_dtype))
+        self._records = np.zeros(num_annotations, dtype=dtype)
+        self._records["geometry"] = geometry
+        for name, values in properties.items():
+            self._records[name] = values
+        self._encoded_ids = ids.astype("<u8")
+
+        self._id_order = np.argsort(ids, kind="stable")
+        self._sorted_ids = ids[self._id_order]
+
+        # the segments related to each annotation, and the annotations
+        # related to each segment
+        self._related_segments = []
+        self._related_annotations = []
+        for name, segment_ids in relationships.items():
+            segment_ids = np.asarray(segment_ids, dtype=np.uint64)
+            segment_ids = segment_ids.reshape((num_annotations, -1))
+            self._related_segments.append(segment_ids)
+            annotations = np.repeat(
+                np.arange(num_annotations), segment_ids.shape[1]
+            ).reshape(segment_ids.shape)
+            mask = segment_ids != 0
+            segment_ids, annotations = segment_ids[mask], annotations[mask]
+            order = np.argsort(segment_ids, kind="stable")
+            self._related_annotations.append((segment_ids[order], annotations[order]))
+
+        self.levels = self._create_spatial_index(
+            points.min(axis=1), points.max(axis=1), limit, max_levels
+        )
+
+        logger.info(
+            "Indexed %d annotations in %d levels in %.2fs",
+            num_annotations,
+            len(self.levels),
+            time.perf_counter() - start_time,
+        )
+
+    @property
+    def url(self):
+        """The URL of this source to use in an ``AnnotationLayer``. Accessing
+        it serves the source from the neuroglancer server."""
+
+        server = _install_handler()
+        with _sources_lock:
+            _sources[self.token] = self
+        return "precomputed://%s/funlib/annotations/%s" % (
+            server.server_url,
+            self.token,
+        )
+
+    def get_info(self):
+        return {
+            "@type": "neuroglancer_annotations_v1",
+            "dimensions": self.dimensions.to_json(),
+            "lower_bound": self.lower_bound.tolist(),
+            "upper_bound": self.upper_bound.tolist(),
+            "annotation_type": self.annotation_type,
+            "properties": self.properties,
+            "relationships": [
+                {"id": name, "key": "rel_%s" % name} for name in self.relationships
+            ],
+            "by_id": {"key": "by_id"},
+            "spatial": [
+                {
+                    "key": "spatial%d" % i,
+                    "grid_shape": level["grid_shape"].tolist(),
+                    "chunk_size": level["chunk_size"].tolist(),
+                    "limit": level["limit"],
+                }
+                for i, level in enumerate(self.levels)
+            ],
+        }
+
+    def get(self, path):
+        """Get the encoded file at ``path`` (relative to the source's URL), or
+        ``None`` if it does not exist."""
+
+        key, _, name = path.partition("/")
+        try:
+            if path == "info":
+                return json.dumps(self.get_info()).encode()
+            if key == "by_id":
+                return self.get_annotation(int(name))
+            if key.startswith("rel_"):
+                return self.get_related_annotations(key[4:], int(name))
+            if key.startswith("spatial"):
+                cell = [int(x) for x in name.split("_")]
+                return self.get_cell(int(key[7:]), cell)
+        except ValueError:
+            pass
+        return None
+
+    def get_cell(self, level, cell):
+        """Get the encoded annotations of ``cell`` in ``level`` of the spatial
+        index."""
+
+        if level >= len(self.levels):
+            return None
+        level = self.levels[level]
+        grid_shape = level["grid_shape"]
+        cell = np.array(cell)
+        if len(cell) != len(grid_shape) or np.any((cell < 0) | (cell >= grid_shape)):
+            return None
+        flat_index = np.ravel_multi_index(cell, grid_shape)
+        i = np.searchsorted(level["cells"], flat_index)
+        if i == len(level["cells"]) or level["cells"][i] != flat_index:
+            return self._encode_annotations([])
+        return self._encode_annotations(
+            level["annotations"][level["offsets"][i] : level["offsets"][i + 1]]
+        )
+
+    def get_annotation(self, annotation_id):
+        """Get the encoded annotation with ID ``annotation_id``, and its
+        related segments."""
+
+        i = np.searchsorted(self._sorted_ids, annotation_id)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != annotation_id:
+            return None
+        index = self._id_order[i]
+        data = [self._records[index].tobytes()]
+        for segment_ids in self._related_segments:
+            segment_ids = segment_ids[index]
+            segment_ids = segment_ids[segment_ids != 0]
+            data.append(np.uint32(len(segment_ids)).astype("<u4").tobytes())
+            data.append(segment_ids.astype("<u8").tobytes())
+        return b"".join(data)
+
+    def get_related_annotations(self, relationship, segment_id):
+        """Get the encoded annotations related to ``segment_id``."""
+
+        if relationship not in self.relationships:
+            return None
+        segment_ids, annotations = self._related_annotations[
+            self.relationships.index(relationship)
+        ]
+        begin = np.searchsorted(segment_ids, segment_id, side="left")
+        end = np.searchsorted(segment_ids, segment_id, side="right")
+        return self._encode_annotations(annotations[begin:end])
+
+    def _encode_annotations(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return b"".join(
+            [
+                np.uint64(len(indices)).astype("<u8").tobytes(),
+                self._records[indices].tobytes(),
+                self._encoded_ids[indices].tobytes(),
+            ]
+        )
+
+    def _create_spatial_index(self, lower, upper, limit, max_levels):
+        """Assign the annotations with bounding boxes from ``lower`` to
+        ``upper`` to the levels of the spatial index.
+
+        Annotations are visited in random order, such that each cell holds a
+        random sample of the annotations in it and neuroglancer can show a
+        prefix of a cell to reduce the density further. An annotation is
+        assigned to the first level in which the cell of its center has room
+        left, and is stored in all cells of that level it intersects."""
+
+        rng = np.random.default_rng(0)
+        extent = self.upper_bound - self.lower_bound
+        extent[extent <= 0] = 1
+        chunk_size = extent.copy()
+        centers = (lower + upper) / 2
+
+        levels = []
+        remaining = rng.permutation(self.num_annotations)
+        while True:
+            grid_shape = np.maximum(np.ceil(extent / chunk_size - 1e-6), 1).astype(
+                np.int64
+            )
+            last = len(levels) == max_levels - 1
+
+            if last:
+                assigned = remaining
+                remaining = remaining[:0]
+            else:
+                # the rank of each remaining annotation in the cell of its
+                # center, in (random) visiting order
+                cells = np.ravel_multi_index(
+                    self._get_cells(centers[remaining], chunk_size, grid_shape).T,
+                    grid_shape,
+                )
+                order = np.argsort(cells, kind="stable")
+                sorted_cells = cells[order]
+                starts = np.flatnonzero(
+                    np.r_[True, sorted_cells[1:] != sorted_cells[:-1]]
+                )
+                ranks = np.empty(len(cells), dtype=np.int64)
+                ranks[order] = np.arange(len(cells)) - np.repeat(
+                    starts, np.diff(np.r_[starts, len(cells)])
+                )
+                assigned = remaining[ranks < limit]
+                remaining = remaining[ranks >= limit]
+
+            levels.append(
+                self._create_level(
+                    lower[assigned], upper[assigned], assigned, chunk_size, grid_shape
+                )
+            )
+
+            if len(remaining) == 0:
+                return levels
+
+            # halve the largest dimensions of the cells, to keep them close to
+            # isotropic
+            chunk_size = chunk_size.copy()
+            halve = chunk_size >= chunk_size.max() / 2
+            chunk_size[halve] /= 2
+
+    def _create_level(self, lower, upper, annotations, chunk_size, grid_shape):
+        begin = self._get_cells(lower, chunk_size, grid_shape)
+        end = self._get_cells(upper, chunk_size, grid_shape) + 1
+
+        # all cells intersected by each annotation
+        sizes = end - begin
+        counts = np.prod(sizes, axis=1)
+        repeated = np.repeat(np.arange(len(annotations)), counts)
+        local = np.arange(len(repeated)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = np.empty((len(repeated), len(grid_shape)), dtype=np.int64)
+        for d in reversed(range(len(grid_shape))):
+            cells[:, d] = begin[repeated, d] + local % sizes[repeated, d]
+            local //= sizes[repeated, d]
+        cells = np.ravel_multi_index(cells.T, grid_shape)
+
+        # stable, to keep the random order of annotations in each cell
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        unique_cells, offsets = np.unique(cells, return_index=True)
+        num_per_cell = np.diff(np.r_[offsets, len(cells)])
+        return {
+            "grid_shape": grid_shape,
+            "chunk_size": chunk_size,
+            "limit": int(num_per_cell.max()) if len(num_per_cell) > 0 else 1,
+            "cells": unique_cells,
+            "offsets": np.r_[offsets, len(cells)],
+            "annotations": annotations[repeated[order]],
+        }
+
+    def _get_cells(self, points, chunk_size, grid_shape):
+        cells = np.floor((points - self.lower_bound) / chunk_size).astype(np.int64)
+        return np.clip(cells, 0, grid_shape - 1)
+
+    def __repr__(self):
+        return "AnnotationSource(%d %s annotations, %d levels)" % (
+            self.num_annotations,
+            self.annotation_type,
+            len(self.levels),
+        )
+
+
+class AnnotationHandler(tornado.web.RequestHandler):
+    async def get(self, token, path):
+        with _sources_lock:
+            source = _sources.get(token)
+        if source is None:
+            self.send_error(404)
+            return
+
+        try:
+            data = await asyncio.wrap_future(
+                neuroglancer.server.global_server.executor.submit(source.get, path)
+            )
+        except Exception as e:
+            self.send_error(500, message=str(e))
+            return
+        if data is None:
+            self.send_error(404)
+            return
+        if path == "info":
+            self.set_header("Content-type", "application/json")
+        else:
+            self.set_header("Content-type", "application/octet-stream")
+        self.finish(data)
+
+
+def _install_handler():
+    """Start the neuroglancer server, and let it serve annotation sources."""
+
+    neuroglancer.server.start()
+    server = neuroglancer.server.global_server
+    with _sources_lock:
+        if not getattr(server, "funlib_annotations", False):
+            server.app.add_handlers(
+                r".*$", [(ANNOTATION_PATH_REGEX, AnnotationHandler)]
+            )
+            server.funlib_annotations = True
+    return server
+
+
+def is_annotation_file(path):
+    """Whether ``path`` is an annotation file that can be opened with
+    :func:`open_annotations`."""
+
+    path = str(path)
+    if path.endswith(".npz") and os.path.isfile(path):
+        return True
+    if not os.path.isdir(path):
+        return False
+    try:
+        group = zarr.open_group(path, mode="r")
+    except Exception:
+        return False
+    keys = set(group.array_keys())
+    return "points" in keys or "lines" in keys or {"nodes", "edges"} <= keys
+
+
+def open_annotations(path, limit=1000):
+    """Open the annotations stored in the ``.npz`` file or zarr group at
+    ``path``, which contains one of the arrays
+
+        ``points``:  ``(n, rank)`` point annotations,
+        ``lines``:   ``(n, 2, rank)`` line annotations (start and end points),
+        ``nodes`` and ``edges``:  a skeleton graph, with ``(n, rank)`` node
+                     positions and ``(m, 2)`` edges (as indices into
+                     ``nodes``), shown as line annotations,
+
+    in world units. Further arrays are:
+
+        ``ids``:  ``(n,)`` IDs of the annotations (or edges of a skeleton
+                  graph), optional.
+        ``<name>_ids``:  IDs of segments related to the annotations, shown as
+                  relationship ``<name>``. For skeleton graphs, these are
+                  given per node, and edges are related to the segment of
+                  their first node (e.g., ``skeleton_ids`` relates all
+                  edges to the ID of their skeleton).
+        ``<name>``:  any other ``(n,)`` array is shown as property ``<name>``.
+
+    The axis names and units of the coordinates are taken from the attributes
+    ``axis_names`` and ``units`` of a zarr group (or arrays of these names in
+    an ``.npz`` file), and default to ``z, y, x`` (the last ``rank`` of them)
+    and ``nm``."""
+
+    path = str(path)
+    if path.endswith(".npz"):
+        with np.load(path) as f:
+            arrays = {key: f[key] for key in f.files}
+        attrs = {
+            key: arrays.pop(key).tolist()
+            for key in ("axis_names", "units")
+            if key in arrays
+        }
+    else:
+        group = zarr.open_group(path, mode="r")
+        arrays = {key: group[key][...] for key in group.array_keys()}
+        attrs = dict(group.attrs)
+
+    if "points" in arrays:
+        annotation_type = "point"
+        geometry = arrays.pop("points")
+    elif "lines" in arrays:
+        annotation_type = "line"
+        geometry = arrays.pop("lines")
+    elif "nodes" in arrays and "edges" in arrays:
+        annotation_type = "line"
+        nodes = arrays.pop("nodes")
+        edges = arrays.pop("edges").astype(np.int64)
+        geometry = nodes[edges]
+        # per node arrays apply to the first node of each edge
+        for key, values in list(arrays.items()):
+            if key != "ids" and len(values) == len(nodes):
+                arrays[key] = values[edges[:, 0]]
+    else:
+        raise ValueError("No annotations found in %s" % path)
+
+    rank = geometry.shape[-1]
+    axis_names = attrs.get("axis_names", ["z", "y", "x"][-rank:])
+    units = attrs.get("units", "nm")
+    dimensions = neuroglancer.CoordinateSpace(
+        names=list(axis_names),
+        units=[units] * rank if isinstance(units, str) else list(units),
+        scales=[1] * rank,
+    )
+
+    ids = arrays.pop("ids", None)
+    relationships = {}
+    properties = {}
+    for key, values in arrays.items():
+        if len(values) != len(geometry):
+            logger.warning("Ignoring %s in %s, it has the wrong length", key, path)
+        elif key.endswith("_ids"):
+            relationships[key[:-4]] = values
+        elif values.ndim == 1 and values.dtype.kind in "biuf":
+            properties[key] = values
+
+    return AnnotationSource(
+        dimensions,
+        annotation_type,
+        geometry,
+        ids=ids,
+        relationships=relationships,
+        properties=properties,
+        limit=limit,
+    )
@@ -0,0 +1,184 @@
+import itertools
+import math
+import threading
+import uuid
+
+import numpy as np
+
+
+def get_chunk_layout(chunk_shape, axis_names):
+    """Get the ``chunk_layout`` and ``max_voxels_per_chunk_log2`` arguments for
+    ``neuroglancer.LocalVolume`` that come closest to storage chunks of
+    ``chunk_shape``: flat chunks for storage chunks with a single section in a
+    spatial dimension, isotropic chunks otherwise, and the same number of
+    voxels per chunk."""
+
+    spatial_chunk_shape = [
+        size for size, name in zip(chunk_shape, axis_names) if "^" not in name
+    ]
+    if len(spatial_chunk_shape) == 3 and min(spatial_chunk_shape) == 1:
+        chunk_layout = "flat"
+    else:
+        chunk_layout = "isotropic"
+
+    return {
+        "chunk_layout": chunk_layout,
+        "max_voxels_per_chunk_log2": max(
+            1, int(round(math.log2(np.prod(spatial_chunk_shape))))
+        ),
+    }
+
+
+class ChunkAlignedArray:
+    """Wraps a chunked (dask) array, such that all reads are aligned to its
+    storage chunks.
+
+    Each storage chunk overlapping a read is read and decoded as a whole and
+    kept in a :class:`DecodedChunkCache`. Reads that fall within a single
+    storage chunk return a view into the cached chunk, all other reads are
+    assembled from the cached chunks. Concurrent reads of the same chunk
+    decode it only once.
+
+    Args:
+
+            data (``dask.array.Array``):
+
+                The array to wrap, its ``chunks`` give the storage chunk grid.
+
+            cache (``DecodedChunkCache``):
+
+                The cache to keep decoded chunks in, can be shared between
+                arrays.
+    """
+
+    def __init__(self, data, cache):
+        self.data = data
+        self.cache = cache
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+        self.token = uuid.uuid4().hex
+
+        # the first voxel of each chunk, and the end of the array
+        self._boundaries = [
+            np.concatenate([[0], np.cumsum(chunks)]) for chunks in data.chunks
+        ]
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def invalidate(self):
+        """Remove the decoded chunks of this array from the cache."""
+
+        if self.cache is not None:
+            self.cache.invalidate(self.token)
+
+    @property
+    def chunk_shape(self):
+        return tuple(int(max(chunks)) for chunks in self.data.chunks)
+
+    def __getitem__(self, index):
+        bounds = self._get_bounds(index)
+        if bounds is None:
+            return np.asarray(self.data[index])
+
+        chunk_ranges = [
+            range(
+                np.searchsorted(boundaries, start, side="right") - 1,
+                np.searchsorted(boundaries, stop, side="left"),
+            )
+            for boundaries, (start, stop) in zip(self._boundaries, bounds)
+        ]
+
+        chunk_indices = list(itertools.product(*chunk_ranges))
+        chunks = self._get_chunks(chunk_indices)
+
+        if len(chunk_indices) == 1:
+            return chunks[0][self._get_slices(chunk_indices[0], bounds)]
+
+        result = np.empty(
+            tuple(stop - start for start, stop in bounds), dtype=self.dtype
+        )
+        for chunk_index, chunk in zip(chunk_indices, chunks):
+            chunk_bounds = [
+                (
+                    max(start, boundaries[c]),
+                    min(stop, boundaries[c + 1]),
+                )
+                for boundaries, c, (start, stop) in zip(
+                    self._boundaries, chunk_index, bounds
+                )
+            ]
+            result[
+                tuple(
+                    slice(chunk_start - start, chunk_stop - start)
+                    for (chunk_start, chunk_stop), (start, _) in zip(
+                        chunk_bounds, bounds
+                    )
+                )
+            ] = chunk[self._get_slices(chunk_index, chunk_bounds)]
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[(slice(None),) * self.ndim], dtype=dtype)
+
+    def transpose(self, *axes):
+        # neuroglancer's mesh generator reads the transposed array as a whole
+        return np.asarray(self).transpose(*axes)
+
+    def _get_bounds(self, index):
+        """Get ``(start, stop)`` for each dimension, or ``None`` if ``index``
+        is not a tuple of contiguous slices."""
+
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) != self.ndim or not all(
+            isinstance(s, slice) and s.step in (None, 1) for s in index
+        ):
+            return None
+        bounds = [s.indices(size)[:2] for s, size in zip(index, self.shape)]
+        if any(stop <= start for start, stop in bounds):
+            return None
+        return bounds
+
+    def _get_slices(self, chunk_index, bounds):
+        return tuple(
+            slice(start - boundaries[c], stop - boundaries[c])
+            for boundaries, c, (start, stop) in zip(
+                self._boundaries, chunk_index, bounds
+            )
+        )
+
+    def _get_chunks(self, chunk_indices):
+        return [self._get_chunk(chunk_index) for chunk_index in chunk_indices]
+
+    def _get_chunk(self, chunk_index):
+        chunk = self.cache.get(self.token, chunk_index)
+        if chunk is not None:
+            return chunk
+
+        with self._pending_lock:
+            pending = self._pending.get(chunk_index)
+            if pending is None:
+                pending = self._pending[chunk_index] = [threading.Event(), None]
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending[0].wait()
+            if pending[1] is not None:
+                return pending[1]
+            # decoding failed in the other thread, try again here
+            return self._get_chunk(chunk_index)
+
+        try:
+            chunk = np.asarray(self.data.blocks[chunk_index])
+            # views of cached chunks are handed out, protect them
+            chunk.flags.writeable = False
+            pending[1] = chunk
+            self.cache.put(self.token, chunk_index, chunk)
+            return chunk
+        finally:
+            with self._pending_lock:
+                del self._pending[chunk_index]
+            pending[0].set()
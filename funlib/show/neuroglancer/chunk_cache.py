@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkCache:
+    """A least-recently-used cache of encoded chunks, bounded by the total
+    number of bytes of the cached chunks. A single cache can be shared between
+    several volumes.
+
+    Args:
+
+        max_bytes (``int``):
+
+            The maximal size of all cached chunks together in bytes. Chunks
+            larger than this are not cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, key):
+        """Get the cached ``(data, content_type)`` for chunk ``key`` of the
+        volume with ``token``, or ``None`` if it is not cached."""
+
+        with self._lock:
+            try:
+                chunk = self._chunks[(token, key)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._chunks.move_to_end((token, key))
+            self.hits += 1
+            return chunk
+
+    def put(self, token, key, chunk):
+        """Store the encoded ``chunk``, a tuple ``(data, content_type)``, and
+        evict the least recently used chunks as needed."""
+
+        size = self._get_size(chunk)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._chunks.pop((token, key), None)
+            if previous is not None:
+                self.num_bytes -= self._get_size(previous)
+            self._chunks[(token, key)] = chunk
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.num_bytes -= self._get_size(evicted)
+                self.evictions += 1
+
+    def invalidate(self, token=None):
+        """Remove all chunks of the volume with ``token`` from the cache, or
+        all chunks if ``token`` is not given."""
+
+        with self._lock:
+            if token is None:
+                self._chunks.clear()
+                self.num_bytes = 0
+                return
+            for cache_key in [k for k in self._chunks.keys() if k[0] == token]:
+                self.num_bytes -= self._get_size(self._chunks.pop(cache_key))
+
+        logger.debug("Invalidated cached chunks of volume %s", token)
+
+    def _get_size(self, chunk):
+        return len(chunk[0])
+
+    def __repr__(self):
+        return "%s(%d chunks, %d/%d bytes, %d hits, %d misses, %d evictions)" % (
+            type(self).__name__,
+            len(self._chunks),
+            self.num_bytes,
+            self.max_bytes,
+            self.hits,
+            self.misses,
+            self.evictions,
+        )
+
+
+class DecodedChunkCache(ChunkCache):
+    """A least-recently-used cache of decoded storage chunks, stored as numpy
+    arrays, bounded by their total number of bytes. See
+    :class:`ChunkAlignedArray`."""
+
+    def _get_size(self, chunk):
+        return chunk.nbytes
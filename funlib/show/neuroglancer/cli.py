@@ -1,11 +1,42 @@
 #!/usr/bin/env python
 
-from funlib.show.neuroglancer import add_layer
+from funlib.show.neuroglancer import (
+    add_annotation_layer,
+    add_layer,
+    ChunkCache,
+    ChunkMetrics,
+    ChunkRequestPool,
+    DaskBatcher,
+    DecodedChunkCache,
+    MeshService,
+    MetadataCache,
+    PyramidBuilder,
+    ServingPolicy,
+)
+from funlib.geometry import Coordinate, Roi
 from funlib.persistence import open_ds
+from funlib.show.neuroglancer.add_layer import compute_statistics, get_volume_type
+from funlib.show.neuroglancer.derived_array import (
+    create_derived_array,
+    get_identifier,
+    get_source_names,
+)
+from funlib.show.neuroglancer.annotation_source import (
+    AnnotationSource,
+    is_annotation_file,
+    open_annotations,
+)
+from funlib.show.neuroglancer.io_pool import set_server_threads
+from funlib.show.neuroglancer.metadata_cache import get_mtime
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import glob
 import neuroglancer
 import os
+import shutil
+import tempfile
+import threading
+import time
 import webbrowser
 from pathlib import Path
 import numpy as np  # noqa: F401 This import is used in the eval statement below
@@ -48,6 +79,24 @@ class SliceAction(argparse.Action):
         dest[-1] = (dest[-1], values[0])
 
 
+def parse_roi(roi):
+    """Parse a ROI given as ``begin:end`` in world units, e.g.,
+    ``0,0,0:400,4000,4000``."""
+
+    begin, end = roi.split(":")
+    begin = Coordinate(int(x) for x in begin.split(","))
+    end = Coordinate(int(x) for x in end.split(","))
+    return Roi(begin, end - begin)
+
+
+def parse_derived(derived):
+    """Parse a derived layer given as ``name=expression``, e.g.,
+    ``boundaries=affs[0] < 0.5``."""
+
+    name, expression = derived.split("=", 1)
+    return name.strip(), expression.strip()
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--dataset",
@@ -82,14 +131,451 @@ parser.add_argument(
     help="Bind address",
 )
 parser.add_argument("--port", type=int, default=0, help="The port to bind to.")
+parser.add_argument(
+    "--cache-size",
+    type=int,
+    default=0,
+    help="Size in MB of a cache for encoded chunks, shared by all layers "
+    "(default: no caching)",
+)
+parser.add_argument(
+    "--storage-cache-size",
+    type=int,
+    default=0,
+    help="Size in MB of a cache for decoded storage chunks, shared by all "
+    "layers. If set, reads are aligned to the storage chunks of datasets "
+    "(default: no caching)",
+)
+parser.add_argument(
+    "--native-scales",
+    action="store_true",
+    help="Only show the stored scales (s0, s1, ...) of multi-res datasets, "
+    "instead of downsampling missing scales on-the-fly",
+)
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Number of threads to open datasets with (default: number of CPUs "
+    "plus four, at most 32)",
+)
+parser.add_argument(
+    "--io-threads",
+    type=int,
+    default=None,
+    help="Number of threads to read and encode chunks with, shared by all "
+    "layers. Chunks in the current view are served first, and a single layer "
+    "can use at most half of the threads (default: let the neuroglancer "
+    "server read chunks)",
+)
+parser.add_argument(
+    "--roi",
+    type=parse_roi,
+    default=None,
+    help="Only read chunks at all scales in this region of interest, given "
+    "as begin:end in world units (e.g., 0,0,0:400,4000,4000). Outside of it, "
+    "only scales allowed by --min-voxel-size are read, other chunks are shown "
+    "as zeros",
+)
+parser.add_argument(
+    "--min-voxel-size",
+    type=lambda s: Coordinate(int(x) for x in s.split(",")),
+    default=None,
+    help="The finest voxel size in world units (e.g., 64,64,64) to read "
+    "outside of --roi (or everywhere, if no ROI is given). Multi-res datasets "
+    "always show at least their coarsest scale",
+)
+parser.add_argument(
+    "--max-mb-per-second",
+    type=float,
+    default=None,
+    help="Throttle chunk requests of each layer that read more than this many "
+    "MB per second from storage",
+)
+parser.add_argument(
+    "--meshes",
+    action="store_true",
+    help="Generate meshes of segmentation layers in a pool of processes, from "
+    "a coarser scale of multi-res datasets, and cache them on disk",
+)
+parser.add_argument(
+    "--mesh-workers",
+    type=int,
+    default=None,
+    help="Number of processes to generate meshes with (default: number of CPUs)",
+)
+parser.add_argument(
+    "--mesh-level",
+    type=int,
+    default=1,
+    help="The scale of multi-res datasets to generate meshes from (default: 1, "
+    "clipped to the coarsest scale)",
+)
+parser.add_argument(
+    "--mesh-cache-dir",
+    type=str,
+    default=None,
+    help="The directory to cache meshes in (default: "
+    "$XDG_CACHE_HOME/funlib.show.neuroglancer/meshes)",
+)
+parser.add_argument(
+    "--premesh",
+    type=str,
+    default=None,
+    help="A text file with object IDs to generate the meshes of in the "
+    "background, for all segmentation layers (implies --meshes)",
+)
+parser.add_argument(
+    "--dask-scheduler",
+    type=str,
+    default="threads",
+    help="The dask scheduler to compute chunks of derived layers with: "
+    "threads, synchronous, processes, or the address of a distributed "
+    "scheduler (e.g., tcp://host:8786). Concurrent chunk requests are "
+    "computed in batches (default: threads)",
+)
+parser.add_argument(
+    "--no-dask-batching",
+    action="store_true",
+    help="Compute each chunk request of derived layers with a separate dask " "graph",
+)
+parser.add_argument(
+    "--derived",
+    type=parse_derived,
+    action="append",
+    default=[],
+    help="Add a layer computed on-the-fly from other datasets, given as "
+    "name=expression with a NumPy expression over the names of the datasets "
+    "(e.g., 'boundaries=affs[0] < 0.5' or 'classes=np.argmax(affs, axis=0)'). "
+    "Characters of dataset names that are not allowed in Python names are "
+    "replaced by underscores. Can be given several times, later expressions "
+    "can use earlier derived layers",
+)
+parser.add_argument(
+    "--derived-cache-size",
+    type=int,
+    default=256,
+    help="Size in MB of a cache for computed chunks of derived layers, if "
+    "--storage-cache-size is not given (default: 256)",
+)
+parser.add_argument(
+    "--auto-config",
+    action="store_true",
+    help="Choose shaders and contrast windows of image layers automatically, "
+    "from a sample of the data read while opening datasets",
+)
+parser.add_argument(
+    "--no-metadata-cache",
+    action="store_true",
+    help="Do not use the on-disk cache of dataset metadata",
+)
+parser.add_argument(
+    "--refresh-metadata-cache",
+    action="store_true",
+    help="Read the metadata of all datasets from storage and update the cache",
+)
+parser.add_argument(
+    "--build-pyramids",
+    action="store_true",
+    help="Build multiscale pyramids for single-scale datasets in the "
+    "background, and switch their layers to the new scales as they are built",
+)
+parser.add_argument(
+    "--pyramid-dir",
+    type=str,
+    default=None,
+    help="The directory to store pyramids built with --build-pyramids in "
+    "(default: a temporary directory that is removed on exit)",
+)
+parser.add_argument(
+    "--slow-request-ms",
+    type=float,
+    default=1000,
+    help="Log chunk requests that take longer than this many milliseconds "
+    "(default: 1000)",
+)
+parser.add_argument(
+    "--metrics-interval",
+    type=float,
+    default=60,
+    help="Print a summary of the chunk requests of each layer every this many "
+    "seconds, 0 to disable (default: 60). Detailed metrics are served at the "
+    "printed /metrics URL",
+)
+
+
+print_lock = threading.Lock()
+
+
+def open_dataset(
+    ds_path, slices, scale_executor, metadata_cache=None, auto_config=False
+):
+    """Open the dataset at ``ds_path`` as an array or, if it is a multi-res
+    dataset, as a list of arrays (one per scale). Scales are opened
+    concurrently on ``scale_executor``. If a ``metadata_cache`` is given,
+    metadata is read from it where possible.
+
+    If ``auto_config`` is set, intensity statistics of image datasets are
+    computed from a sample of the data (or taken from the metadata cache, if
+    the sampled storage chunks did not change).
+
+    Annotation files (see ``open_annotations``) are opened as an
+    ``AnnotationSource`` instead.
+
+    Returns the array(s), their statistics (or ``None``), and the time it took
+    to open them."""
+
+    start_time = time.perf_counter()
+
+    # probing for annotations lists the keys of groups, remember the result
+    is_annotations = None
+    if metadata_cache is not None:
+        is_annotations = metadata_cache.get(ds_path, "annotations")
+    if is_annotations is None:
+        is_annotations = is_annotation_file(ds_path)
+        if metadata_cache is not None:
+            metadata_cache.put(ds_path, "annotations", is_annotations)
+
+    if is_annotations:
+        with print_lock:
+            print("Adding annotations %s" % (ds_path))
+        source = open_annotations(ds_path)
+        return source, None, time.perf_counter() - start_time
+
+    if metadata_cache is not None:
+        _open_ds = metadata_cache.open_ds
+        cached_scales = metadata_cache.get(ds_path, "scales")
+    else:
+        _open_ds = open_ds
+        cached_scales = None
+
+    try:
+        with print_lock:
+            print("Adding %s" % (ds_path))
+        if cached_scales is not None:
+            scales = [os.path.join(ds_path, s) for s in cached_scales]
+            array = list(scale_executor.map(_open_ds, scales))
+            arrays = array
+        else:
+            array = _open_ds(ds_path)
+            arrays = [array]
+
+    except Exception as e:
+        scales = glob.glob(f"{ds_path}/s*")
+        with print_lock:
+            print(type(e), e)
+            print("Didn't work, checking if this is multi-res...")
+            if len(scales) == 0:
+                print(f"Couldn't read {ds_path}, skipping...")
+            else:
+                print(
+                    "Found scales %s" % ([os.path.relpath(s, ds_path) for s in scales],)
+                )
+        if len(scales) == 0:
+            raise e
+        array = list(scale_executor.map(_open_ds, scales))
+        arrays = array
+        if metadata_cache is not None:
+            metadata_cache.put(
+                ds_path, "scales", [os.path.relpath(s, ds_path) for s in scales]
+            )
+
+    for arr in arrays:
+        if slices is not None:
+            arr.lazy_op(slices)
+
+    statistics = None
+    if auto_config and get_volume_type(arrays[0]) == "image":
+        # statistics of pyramids are computed from (and cached for) the
+        # coarsest scale
+        if isinstance(array, list):
+            coarsest = max(
+                range(len(arrays)), key=lambda i: tuple(arrays[i].voxel_size)
+            )
+            statistics_path = scales[coarsest]
+        else:
+            statistics_path = ds_path
+        # statistics of sliced datasets are not cached, they depend on the
+        # slices
+        if metadata_cache is not None and slices is None:
+            statistics = metadata_cache.get_statistics(statistics_path)
+        if statistics is None:
+            statistics = compute_statistics(array)
+            if metadata_cache is not None and slices is None:
+                metadata_cache.put_statistics(statistics_path, statistics)
+
+    return array, statistics, time.perf_counter() - start_time
+
+
+def get_data_version(ds_path):
+    """Get a version of the dataset at ``ds_path`` to cache meshes under: the
+    latest modification time of its metadata and of the directories in it
+    (e.g., its scales), or ``None`` if it is not a local directory."""
+
+    try:
+        paths = [ds_path] + [e.path for e in os.scandir(ds_path) if e.is_dir()]
+    except OSError:
+        return None
+    mtimes = [m for m in map(get_mtime, paths) if m is not None]
+    return max(mtimes) if mtimes else None
+
+
+def get_volume(viewer, layer):
+    """Get the local volume shown in ``layer`` of ``viewer``."""
+
+    for source in layer.source:
+        url = source.url if isinstance(source.url, str) else ""
+        if url.startswith("python://volume/"):
+            return viewer.volume_manager.volumes.get(url.split(".")[-1])
+    return None
+
+
+def build_pyramid(viewer, layer, directory, executor):
+    """Build a pyramid for the single-scale ``layer`` in the background.
+    Whenever a level is finished, requests for the layer are served from the
+    new ``ScalePyramid``."""
+
+    volume = get_volume(viewer, layer)
+
+    def on_level(pyramid):
+        # the pyramid has the token of the original volume, the layer's
+        # source URL stays the same and only the server-side volume changes
+        viewer.volume_manager.volumes[pyramid.token] = pyramid
+        if pyramid.chunk_cache is not None:
+            pyramid.chunk_cache.invalidate(pyramid.token)
+        with print_lock:
+            print(
+                "Layer %s: built %d/%d scales"
+                % (layer.name, len(builder.levels), len(builder.scales))
+            )
+
+    builder = PyramidBuilder(volume, directory, executor=executor, on_level=on_level)
+    builder.start()
+    return builder
+
+
+def premesh(name, mesh_generator, object_ids):
+    start_time = time.perf_counter()
+    num_meshes = mesh_generator.generate(object_ids)
+    with print_lock:
+        print(
+            "Layer %s: generated meshes of %d/%d objects in %.2fs"
+            % (name, num_meshes, len(object_ids), time.perf_counter() - start_time)
+        )
+
+
+def report_metrics(metrics, interval):
+    """Print a summary of ``metrics`` every ``interval`` seconds, if there
+    were chunk requests since the last one."""
+
+    last_summary = ""
+    while True:
+        time.sleep(interval)
+        summary = metrics.summary()
+        if summary and summary != last_summary:
+            with print_lock:
+                print(summary)
+            last_summary = summary
 
 
 def main():
     args = parser.parse_args()
 
+    start_time = time.perf_counter()
+
     neuroglancer.set_server_bind_address(args.bind_address, bind_port=args.port)
     viewer = neuroglancer.Viewer()
 
+    if args.cache_size > 0:
+        chunk_cache = ChunkCache(max_bytes=args.cache_size * 1024**2)
+    else:
+        chunk_cache = None
+
+    if args.storage_cache_size > 0:
+        storage_cache = DecodedChunkCache(max_bytes=args.storage_cache_size * 1024**2)
+    else:
+        storage_cache = None
+
+    if (
+        args.roi is not None
+        or args.min_voxel_size is not None
+        or args.max_mb_per_second is not None
+    ):
+        serving_policy = ServingPolicy(
+            roi=args.roi,
+            min_voxel_size=args.min_voxel_size,
+            max_bytes_per_second=(
+                int(args.max_mb_per_second * 1024**2)
+                if args.max_mb_per_second is not None
+                else None
+            ),
+        )
+    else:
+        serving_policy = None
+
+    if args.meshes or args.premesh is not None:
+        mesh_service = MeshService(
+            num_workers=args.mesh_workers, cache_dir=args.mesh_cache_dir
+        )
+    else:
+        mesh_service = None
+    if args.premesh is not None:
+        with open(args.premesh, "r") as f:
+            premesh_ids = [int(x) for x in f.read().split()]
+    premesh_threads = []
+
+    # chunks of stored datasets are read directly, only the chunks of derived
+    # layers are computed in batches
+    if args.no_dask_batching or not args.derived:
+        dask_batcher = None
+    elif "://" in args.dask_scheduler:
+        from distributed import Client
+
+        dask_batcher = DaskBatcher(scheduler=Client(args.dask_scheduler))
+    else:
+        dask_batcher = DaskBatcher(scheduler=args.dask_scheduler)
+
+    if args.no_metadata_cache:
+        metadata_cache = None
+    else:
+        metadata_cache = MetadataCache(refresh=args.refresh_metadata_cache)
+
+    # pyramids are built on a separate executor, such that opening datasets
+    # does not wait for them
+    builders = []
+    if args.build_pyramids:
+        if args.pyramid_dir is None:
+            pyramid_dir = tempfile.mkdtemp(prefix="funlib-show-pyramids-")
+        else:
+            pyramid_dir = args.pyramid_dir
+        build_executor = ThreadPoolExecutor(os.cpu_count())
+    else:
+        build_executor = None
+
+    url = str(viewer)
+    print(url)
+
+    metrics = ChunkMetrics(slow_request_seconds=args.slow_request_ms / 1e3)
+    print("Chunk request metrics at %s" % metrics.serve())
+    if args.metrics_interval > 0:
+        threading.Thread(
+            target=report_metrics,
+            args=(metrics, args.metrics_interval),
+            daemon=True,
+        ).start()
+
+    if args.io_threads is not None:
+        io_pool = ChunkRequestPool(args.io_threads, viewer=viewer)
+        # server threads only wait for the pool, allow more requests to queue
+        # there than the pool can handle at once
+        set_server_threads(4 * args.io_threads)
+    else:
+        io_pool = None
+    if os.environ.get("DISPLAY") and not args.no_browser:
+        webbrowser.open_new(url)
+
+    glob_paths = []
     for datasetslice in args.datasetslice:
         if isinstance(datasetslice, tuple):
             datasets, slices = datasetslice[0], eval(f"np.s_[{datasetslice[1]}]")
@@ -99,43 +585,197 @@ def main():
             raise NotImplementedError("Unreachable!")
 
         for glob_path in datasets:
-            print(f"Adding {glob_path} with slices {slices}")
-            for ds_path in glob.glob(glob_path):
+            with print_lock:
+                print(f"Adding {glob_path} with slices {slices}")
+            glob_paths.append((glob_path, slices))
+
+    # Datasets are opened concurrently, but added to the viewer in the order
+    # they were given, each as soon as it (and all its scales) are opened.
+    # Scales get their own executor, since waiting for them on the dataset
+    # executor could block all of its workers.
+    num_jobs = args.jobs if args.jobs is not None else min(32, os.cpu_count() + 4)
+    with ThreadPoolExecutor(num_jobs) as executor, ThreadPoolExecutor(
+        num_jobs
+    ) as scale_executor:
+        opened_datasets = []
+        for (glob_path, slices), ds_paths in zip(
+            glob_paths,
+            executor.map(glob.glob, [glob_path for glob_path, _ in glob_paths]),
+        ):
+            for ds_path in ds_paths:
                 ds_path = Path(ds_path)
-                try:
-                    print("Adding %s" % (ds_path))
-                    array = open_ds(ds_path)
-                    arrays = [(array, ds_path)]
-
-                except Exception as e:
-                    print(type(e), e)
-                    print("Didn't work, checking if this is multi-res...")
-
-                    scales = glob.glob(f"{ds_path}/s*")
-                    if len(scales) == 0:
-                        print(f"Couldn't read {ds_path}, skipping...")
-                        raise e
-                    print(
-                        "Found scales %s"
-                        % ([os.path.relpath(s, ds_path) for s in scales],)
+                opened_datasets.append(
+                    (
+                        ds_path,
+                        slices,
+                        executor.submit(
+                            open_dataset,
+                            ds_path,
+                            slices,
+                            scale_executor,
+                            metadata_cache,
+                            args.auto_config,
+                        ),
                     )
-                    arrays = [([open_ds(scale_ds) for scale_ds in scales], ds_path)]
+                )
 
-                for array, _ in arrays:
-                    if not isinstance(array, list):
-                        array = [array]
-                    for arr in array:
-                        if slices is not None:
-                            arr.lazy_op(slices)
+        num_arrays = 0
+        open_time = 0.0
+        # the arrays to derive layers from, and their keys and versions to
+        # cache meshes under
+        sources = {}
+        source_keys = {}
+        source_versions = {}
+        for ds_path, slices, opened_dataset in opened_datasets:
+            array, statistics, duration = opened_dataset.result()
+            num_arrays += len(array) if isinstance(array, list) else 1
+            open_time += duration
 
+            if isinstance(array, AnnotationSource):
                 with viewer.txn() as s:
-                    for array, dataset in arrays:
-                        add_layer(s, array, Path(dataset).name)
+                    add_annotation_layer(s, array, ds_path.name)
+                continue
 
-    url = str(viewer)
-    print(url)
-    if os.environ.get("DISPLAY") and not args.no_browser:
-        webbrowser.open_new(url)
+            # meshes of sliced datasets are cached separately
+            mesh_key = str(ds_path.absolute()) + ("" if slices is None else str(slices))
+            mesh_version = (
+                get_data_version(ds_path) if mesh_service is not None else None
+            )
+            sources[get_identifier(ds_path.name)] = array
+            source_keys[get_identifier(ds_path.name)] = mesh_key
+            source_versions[get_identifier(ds_path.name)] = mesh_version
+
+            with viewer.txn() as s:
+                add_layer(
+                    s,
+                    array,
+                    ds_path.name,
+                    chunk_cache=chunk_cache,
+                    native_scales=args.native_scales,
+                    storage_cache=storage_cache,
+                    io_pool=io_pool,
+                    statistics=statistics,
+                    serving_policy=serving_policy,
+                    mesh_service=mesh_service,
+                    mesh_level=args.mesh_level,
+                    mesh_key=mesh_key,
+                    mesh_version=mesh_version,
+                    metrics=metrics,
+                )
+
+            mesh_generator = getattr(
+                get_volume(viewer, viewer.state.layers[-1]), "mesh_generator", None
+            )
+            if args.premesh is not None and mesh_generator is not None:
+                premesh_threads.append(
+                    threading.Thread(
+                        target=premesh,
+                        args=(ds_path.name, mesh_generator, premesh_ids),
+                        daemon=True,
+                    )
+                )
+                premesh_threads[-1].start()
+
+            if args.build_pyramids and not isinstance(array, list):
+                builders.append(
+                    build_pyramid(
+                        viewer,
+                        viewer.state.layers[-1],
+                        os.path.join(
+                            pyramid_dir, "%d_%s" % (len(builders), ds_path.name)
+                        ),
+                        build_executor,
+                    )
+                )
+
+    if args.derived and storage_cache is None:
+        derived_cache = DecodedChunkCache(max_bytes=args.derived_cache_size * 1024**2)
+    else:
+        derived_cache = storage_cache
+    for name, expression in args.derived:
+        with print_lock:
+            print("Adding %s = %s" % (name, expression))
+        names = sorted(n for n in get_source_names(expression) if n in sources)
+        array = create_derived_array(expression, {n: sources[n] for n in names})
+        mesh_key = "%s from %s" % (
+            expression,
+            ", ".join("%s=%s" % (n, source_keys[n]) for n in names),
+        )
+        versions = [source_versions[n] for n in names if source_versions[n]]
+        mesh_version = max(versions) if versions else None
+
+        statistics = None
+        if args.auto_config:
+            first = array[0] if isinstance(array, list) else array
+            if get_volume_type(first) == "image":
+                statistics = compute_statistics(array)
+
+        with viewer.txn() as s:
+            add_layer(
+                s,
+                array,
+                name,
+                chunk_cache=chunk_cache,
+                native_scales=args.native_scales,
+                storage_cache=derived_cache,
+                io_pool=io_pool,
+                statistics=statistics,
+                serving_policy=serving_policy,
+                mesh_service=mesh_service,
+                mesh_level=args.mesh_level,
+                mesh_key=mesh_key,
+                mesh_version=mesh_version,
+                dask_batcher=dask_batcher,
+                metrics=metrics,
+            )
+        sources[get_identifier(name)] = array
+        source_keys[get_identifier(name)] = "(%s)" % mesh_key
+        source_versions[get_identifier(name)] = mesh_version
+
+    print(
+        "Added %d datasets (%d arrays) in %.2fs, spent %.2fs opening datasets "
+        "on %d threads"
+        % (
+            len(opened_datasets),
+            num_arrays,
+            time.perf_counter() - start_time,
+            open_time,
+            num_jobs,
+        )
+    )
+
+    if metadata_cache is not None:
+        metadata_cache.save()
 
     print("Press ENTER to quit")
     input()
+
+    for builder in builders:
+        builder.stop()
+    if build_executor is not None:
+        build_executor.shutdown(cancel_futures=True)
+    if args.build_pyramids and args.pyramid_dir is None:
+        shutil.rmtree(pyramid_dir)
+
+    if chunk_cache is not None:
+        print(chunk_cache)
+    if storage_cache is not None:
+        print(storage_cache)
+    if io_pool is not None:
+        print(io_pool)
+    if dask_batcher is not None:
+        print(dask_batcher)
+    summary = metrics.summary()
+    if summary:
+        print(summary)
+    if mesh_service is not None:
+        mesh_service.shutdown()
+        for layer in viewer.state.layers:
+            volume = get_volume(viewer, layer)
+            if getattr(volume, "mesh_generator", None) is not None:
+                print(volume.mesh_generator)
+    if serving_policy is not None:
+        for layer in viewer.state.layers:
+            volume = get_volume(viewer, layer)
+            if volume is not None and volume.serving_policy is not None:
+                print("%s: %s" % (layer.name, volume.serving_policy))
@@ -0,0 +1,204 @@
+from .chunk_aligned_array import ChunkAlignedArray
+from collections import OrderedDict
+from concurrent.futures import Future
+from dask.base import get_scheduler
+import logging
+import threading
+import time
+
+import dask
+import dask.core
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class DaskBatcher:
+    """Computes the blocks of dask arrays in batches, usually shared between
+    all layers of a viewer (see :class:`BatchedDaskArray`).
+
+    Computing a small slice of a dask array builds, optimizes, and schedules
+    a new task graph, which often takes longer than reading the data. Instead,
+    the optimized graph of each block is built once (and kept for the most
+    recently used ``max_graphs`` blocks), and all blocks requested while a
+    batch is computed are computed together in the next batch, with a single
+    call to the scheduler. Tasks shared between blocks (e.g., reading the same
+    storage chunk) are computed once per batch. Batches are computed by a
+    worker thread, started with the first request.
+
+    Args:
+
+            scheduler (``str`` or ``distributed.Client``, optional):
+
+                The dask scheduler to compute batches with, e.g.,
+                ``"threads"``, ``"synchronous"``, ``"processes"``, or a
+                client of a distributed cluster.
+
+            max_graphs (``int``, optional):
+
+                The number of optimized block graphs to keep.
+    """
+
+    def __init__(self, scheduler="threads", max_graphs=65536):
+        self.scheduler = scheduler
+        self.max_graphs = max_graphs
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_blocks = 0
+        self.num_graphs_built = 0
+        self.compute_time = 0.0
+
+        self._get = get_scheduler(scheduler=scheduler)
+        self._graphs = OrderedDict()
+        self._queue = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._worker = None
+
+    def get_blocks(self, array, chunk_indices):
+        """Get the blocks ``chunk_indices`` of the ``BatchedDaskArray``
+        ``array``, computed in the current or the next batch. Blocks that
+        are already being computed for another request are shared."""
+
+        futures = []
+        with self._lock:
+            self.num_requests += 1
+            for chunk_index in chunk_indices:
+                key = (array.token, chunk_index)
+                future = self._pending.get(key)
+                if future is None:
+                    future = self._pending[key] = Future()
+                    self._queue.append((array, chunk_index, future))
+                futures.append(future)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._queued.notify()
+
+        return [future.result() for future in futures]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._queued.wait()
+                batch = self._queue
+                self._queue = []
+            self._compute(batch)
+
+    def _compute(self, batch):
+        start_time = time.perf_counter()
+        try:
+            graph = {}
+            keys = []
+            for array, chunk_index, _ in batch:
+                block_graph, key = self._get_graph(array, chunk_index)
+                graph.update(block_graph)
+                keys.append(key)
+            blocks = self._get(graph, keys)
+        except BaseException as e:
+            with self._lock:
+                for array, chunk_index, future in batch:
+                    del self._pending[(array.token, chunk_index)]
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        duration = time.perf_counter() - start_time
+        logger.debug("Computed a batch of %d blocks in %.3fs", len(batch), duration)
+        with self._lock:
+            self.num_batches += 1
+            self.num_blocks += len(batch)
+            self.compute_time += duration
+            for array, chunk_index, future in batch:
+                del self._pending[(array.token, chunk_index)]
+        for (_, _, future), block in zip(batch, blocks):
+            block = np.asarray(block)
+            # blocks can be shared between requests, protect them
+            block.flags.writeable = False
+            future.set_result(block)
+
+    def _get_graph(self, array, chunk_index):
+        """Get the optimized graph and the output key of a block of
+        ``array``."""
+
+        key = (array.token, chunk_index)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self._graphs.move_to_end(key)
+                return graph
+
+        (block,) = dask.optimize(array.data.blocks[chunk_index])
+        graph = (
+            dict(block.__dask_graph__()),
+            next(dask.core.flatten(block.__dask_keys__())),
+        )
+
+        with self._lock:
+            self.num_graphs_built += 1
+            self._graphs[key] = graph
+            while len(self._graphs) > self.max_graphs:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def __repr__(self):
+        return (
+            "DaskBatcher(%s, %d requests, %d blocks in %d batches in %.1fs, "
+            "%d graphs built)"
+            % (
+                self.scheduler,
+                self.num_requests,
+                self.num_blocks,
+                self.num_batches,
+                self.compute_time,
+                self.num_graphs_built,
+            )
+        )
+
+
+class BatchedDaskArray(ChunkAlignedArray):
+    """Wraps a dask array, such that reads are computed by a
+    :class:`DaskBatcher`, block by block.
+
+    Reads are aligned to the blocks of the dask array. If a
+    ``DecodedChunkCache`` is given, computed blocks are kept in it, as by
+    :class:`ChunkAlignedArray`.
+
+    Args:
+
+            data (``dask.array.Array``):
+
+                The array to wrap.
+
+            batcher (``DaskBatcher``):
+
+                The batcher to compute blocks with, can be shared between
+                arrays.
+
+            cache (``DecodedChunkCache``, optional):
+
+                The cache to keep computed blocks in.
+    """
+
+    def __init__(self, data, batcher, cache=None):
+        super().__init__(data, cache)
+        self.batcher = batcher
+
+    def _get_chunks(self, chunk_indices):
+        if self.cache is None:
+            return self.batcher.get_blocks(self, chunk_indices)
+
+        chunks = [self.cache.get(self.token, c) for c in chunk_indices]
+        missing = [c for c, chunk in zip(chunk_indices, chunks) if chunk is None]
+        if missing:
+            computed = dict(zip(missing, self.batcher.get_blocks(self, missing)))
+            for chunk_index in missing:
+                self.cache.put(self.token, chunk_index, computed[chunk_index])
+            chunks = [
+                computed[c] if chunk is None else chunk
+                for c, chunk in zip(chunk_indices, chunks)
+            ]
+        return chunks
@@ -0,0 +1,248 @@
+"""A compact script format for ``video_tool``, which stores a shared base
+state once and each keypoint as a delta to it.
+
+A delta script is a text file starting with the line ``HEADER``, followed by
+one JSON record per line:
+
+  {"base": <viewer-state-json>}
+  {"insert": <index>, "delta": <delta>, "duration": <transition-duration>}
+  {"delete": <index>}
+  {"set_duration": <index>, "duration": <transition-duration>}
+
+Deltas are JSON merge patches (RFC 7386) of the keypoint state against the
+last ``base`` record. The keypoints are obtained by replaying all records in
+order, such that edits can be appended to the file instead of rewriting it.
+The state of a keypoint is only parsed when it is accessed.
+"""
+
+import copy
+import json
+import os
+
+import neuroglancer
+
+HEADER = "# neuroglancer video_tool delta script v1"
+
+
+def is_delta_script(script_path):
+    """Whether the script at ``script_path`` is a delta script."""
+
+    with open(script_path, "r") as f:
+        return f.readline().rstrip("\n") == HEADER
+
+
+def make_delta(base, target):
+    """Get the JSON merge patch that turns ``base`` into ``target``."""
+
+    if not isinstance(base, dict) or not isinstance(target, dict):
+        return target
+
+    delta = {}
+    for key, value in target.items():
+        if key not in base:
+            delta[key] = value
+        elif base[key] != value:
+            if isinstance(base[key], dict) and isinstance(value, dict):
+                delta[key] = make_delta(base[key], value)
+            else:
+                delta[key] = value
+    for key in base:
+        if key not in target:
+            delta[key] = None
+    return delta
+
+
+def apply_delta(base, delta):
+    """Apply the JSON merge patch ``delta`` to ``base``. Unchanged parts of
+    ``base`` are shared with the result, not copied."""
+
+    if not isinstance(delta, dict):
+        return delta
+    if not isinstance(base, dict):
+        base = {}
+
+    result = dict(base)
+    for key, value in delta.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_delta(base.get(key), value)
+    return result
+
+
+class LazyKeypoint(dict):
+    """A keypoint as returned by ``load_script``, whose ``"state"`` is only
+    parsed from the base state and its delta when it is first accessed."""
+
+    def __init__(self, base, delta, transition_duration):
+        super().__init__(transition_duration=transition_duration)
+        self.base = base
+        self.delta = delta
+
+    def __missing__(self, key):
+        if key != "state":
+            raise KeyError(key)
+        state = neuroglancer.ViewerState(
+            copy.deepcopy(apply_delta(self.base, self.delta))
+        )
+        self["state"] = state
+        return state
+
+    def get_delta(self, base):
+        """Get the delta of this keypoint's state against ``base``, without
+        parsing the state if possible."""
+
+        if "state" in self:
+            return make_delta(base, self["state"].to_json())
+        if base is self.base:
+            return self.delta
+        return make_delta(base, apply_delta(self.base, self.delta))
+
+
+def load_delta_script(script_path, transition_duration=1):
+    return DeltaScript(script_path).load(transition_duration)
+
+
+class DeltaScript:
+    """Saves edits of a list of keypoints to a delta script, by appending a
+    record for each edit. The script is rewritten (compacted) once more than
+    ``compact_ratio`` records per keypoint have accumulated.
+
+    Args:
+
+            script_path (``str``):
+
+                The delta script to write to.
+
+            compact_ratio (``float``, optional):
+
+                Rewrite the script if it has more than this many records per
+                keypoint.
+    """
+
+    def __init__(self, script_path, compact_ratio=4):
+        self.script_path = script_path
+        self.compact_ratio = compact_ratio
+
+        self.base = None
+        self.num_records = 0
+
+    def load(self, transition_duration=1):
+        """Load the keypoints of the script, subsequent edits are appended to
+        it."""
+
+        keypoints = []
+        base = {}
+        num_records = 0
+        with open(self.script_path, "r") as f:
+            f.readline()
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                num_records += 1
+                if "base" in record:
+                    base = record["base"]
+                elif "insert" in record:
+                    keypoints.insert(
+                        record["insert"],
+                        LazyKeypoint(
+                            base,
+                            record["delta"],
+                            record.get("duration", transition_duration),
+                        ),
+                    )
+                elif "delete" in record:
+                    del keypoints[record["delete"]]
+                elif "set_duration" in record:
+                    keypoints[record["set_duration"]]["transition_duration"] = record[
+                        "duration"
+                    ]
+                else:
+                    raise ValueError(
+                        "Invalid record in %s: %s" % (self.script_path, line)
+                    )
+
+        self.base = base
+        self.num_records = num_records
+        return keypoints
+
+    def save(self, keypoints):
+        """Rewrite the script with ``keypoints``, using the state of the first
+        one as base."""
+
+        if keypoints:
+            first = keypoints[0]
+            if isinstance(first, LazyKeypoint) and "state" not in first:
+                base = apply_delta(first.base, first.delta)
+            else:
+                base = first["state"].to_json()
+        else:
+            base = {}
+
+        records = [{"base": base}]
+        for index, keypoint in enumerate(keypoints):
+            records.append(self._insert_record(index, keypoint, base))
+
+        temp_path = self.script_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(HEADER + "\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.script_path)
+
+        self.base = base
+        self.num_records = len(records)
+
+    def insert(self, keypoints, index):
+        """Save the insertion of ``keypoints[index]``."""
+
+        if not self._append_or_compact(keypoints):
+            self._append(self._insert_record(index, keypoints[index], self.base))
+
+    def delete(self, keypoints, index):
+        """Save the deletion of the keypoint at ``index`` (already removed from
+        ``keypoints``)."""
+
+        if not self._append_or_compact(keypoints):
+            self._append({"delete": index})
+
+    def set_duration(self, keypoints, index):
+        """Save the changed transition duration of ``keypoints[index]``."""
+
+        if not self._append_or_compact(keypoints):
+            self._append(
+                {
+                    "set_duration": index,
+                    "duration": keypoints[index]["transition_duration"],
+                }
+            )
+
+    def _append_or_compact(self, keypoints):
+        """Rewrite the script if it was not written by this object yet or has
+        too many records. Returns whether the script was rewritten."""
+
+        if (
+            self.base is None
+            or self.num_records > self.compact_ratio * max(1, len(keypoints))
+            or not os.path.exists(self.script_path)
+        ):
+            self.save(keypoints)
+            return True
+        return False
+
+    def _insert_record(self, index, keypoint, base):
+        if isinstance(keypoint, LazyKeypoint):
+            delta = keypoint.get_delta(base)
+        else:
+            delta = make_delta(base, keypoint["state"].to_json())
+        return {
+            "insert": index,
+            "delta": delta,
+            "duration": keypoint["transition_duration"],
+        }
+
+    def _append(self, record):
+        with open(self.script_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.num_records += 1
@@ -0,0 +1,181 @@
+"""Arrays derived from other arrays by a NumPy expression, computed on-the-fly
+for each requested chunk (e.g., ``affs[0] > 0.5`` or
+``np.argmax(affs, axis=0)``).
+
+Derived arrays are lazy ``funlib.persistence`` arrays on top of the dask
+arrays of their sources, such that ``add_layer`` serves them like any other
+array, computed in batches if given a :class:`DaskBatcher`, and caches of
+computed blocks and encoded chunks apply to them as well.
+"""
+
+from funlib.geometry import Coordinate
+from funlib.persistence import Array
+import ast
+import re
+
+import dask.array as da
+import numpy as np
+
+# dtypes of expression results that neuroglancer can not show, and the dtype
+# to show them as instead
+_dtype_conversions = {
+    np.dtype(bool): np.dtype(np.uint8),
+    np.dtype(np.int64): np.dtype(np.int32),
+    np.dtype(np.float16): np.dtype(np.float32),
+}
+
+
+def get_identifier(name):
+    """Get the name to refer to the dataset ``name`` with in expressions,
+    e.g., ``affs_s0`` for ``affs.s0``."""
+
+    identifier = re.sub(r"\W", "_", name)
+    if identifier[:1].isdigit():
+        identifier = "_" + identifier
+    return identifier
+
+
+def get_source_names(expression):
+    """Get the names ``expression`` refers to (sources, but also, e.g.,
+    ``np``)."""
+
+    return {
+        node.id
+        for node in ast.walk(ast.parse(expression))
+        if isinstance(node, ast.Name)
+    }
+
+
+def create_derived_array(expression, sources):
+    """Create an array that evaluates ``expression`` on ``sources``.
+
+    Args:
+
+        expression (``str``):
+
+            A vectorized NumPy expression, in which sources are referred to
+            by name, and NumPy and dask are available as ``np`` and ``da``.
+
+        sources (``dict``):
+
+            The arrays to evaluate the expression on, by name. A source can
+            be a list of arrays (one per scale), in which case a list of
+            derived arrays is returned, one per voxel size that all sources
+            have.
+
+    All sources of a scale have to have the same voxel size and spatial axes,
+    and be aligned to the same voxel grid. The expression is evaluated on the
+    intersection of their ROIs. Its result has either the spatial axes of the
+    sources, or channel axes followed by the spatial axes.
+    """
+
+    voxel_sizes = _get_voxel_sizes(sources)
+    if len(voxel_sizes) == 0:
+        raise ValueError(
+            "The sources of %s have no voxel size in common" % (expression,)
+        )
+
+    arrays = [
+        _create_level(expression, dict(zip(sources, _get_levels(sources, v))))
+        for v in voxel_sizes
+    ]
+    if any(isinstance(source, list) for source in sources.values()):
+        return arrays
+    return arrays[0]
+
+
+def _get_voxel_sizes(sources):
+    """The voxel sizes all sources have, finest first."""
+
+    voxel_sizes = None
+    for source in sources.values():
+        arrays = source if isinstance(source, list) else [source]
+        source_voxel_sizes = {tuple(a.voxel_size) for a in arrays}
+        if voxel_sizes is None:
+            voxel_sizes = source_voxel_sizes
+        else:
+            voxel_sizes &= source_voxel_sizes
+    return sorted(voxel_sizes)
+
+
+def _get_levels(sources, voxel_size):
+    """The arrays of ``sources`` with ``voxel_size``."""
+
+    levels = []
+    for source in sources.values():
+        arrays = source if isinstance(source, list) else [source]
+        levels.append(
+            next(a for a in arrays if tuple(a.voxel_size) == tuple(voxel_size))
+        )
+    return levels
+
+
+def _get_spatial_axes(array):
+    return [name for name in array.axis_names if "^" not in name]
+
+
+def _create_level(expression, arrays):
+    names = list(arrays)
+    first = arrays[names[0]]
+    voxel_size = first.voxel_size
+    spatial_axes = _get_spatial_axes(first)
+
+    roi = first.roi
+    for name, array in arrays.items():
+        if _get_spatial_axes(array) != spatial_axes:
+            raise ValueError(
+                "%s has spatial axes %s, but %s has %s"
+                % (name, _get_spatial_axes(array), names[0], spatial_axes)
+            )
+        if (array.offset - first.offset) % voxel_size != Coordinate(
+            (0,) * len(voxel_size)
+        ):
+            raise ValueError(
+                "%s and %s are not aligned to the same voxel grid" % (name, names[0])
+            )
+        roi = roi.intersect(array.roi)
+    if roi.empty:
+        raise ValueError("The ROIs of %s do not intersect" % (names,))
+
+    # the data of all sources in the common ROI
+    namespace = {"np": np, "da": da}
+    for name, array in arrays.items():
+        begin = iter((roi.begin - array.offset) / voxel_size)
+        shape = iter(roi.shape / voxel_size)
+        slices = []
+        for axis_name in array.axis_names:
+            if "^" in axis_name:
+                slices.append(slice(None))
+            else:
+                b = next(begin)
+                slices.append(slice(b, b + next(shape)))
+        namespace[get_identifier(name)] = array.data[tuple(slices)]
+
+    data = da.asarray(eval(expression, namespace))
+    if data.ndim < len(spatial_axes):
+        raise ValueError(
+            "%s has %d dimensions, expected at least the %d spatial dimensions"
+            % (expression, data.ndim, len(spatial_axes))
+        )
+
+    dtype = _dtype_conversions.get(data.dtype)
+    if dtype is not None:
+        data = data.astype(dtype)
+
+    # channel axes come first, reuse the names of a source with as many
+    num_channel_dims = data.ndim - len(spatial_axes)
+    axis_names = None
+    for array in arrays.values():
+        if array.channel_dims == num_channel_dims:
+            axis_names = [name for name in array.axis_names if "^" in name]
+            break
+    if axis_names is None:
+        axis_names = ["c%d^" % i for i in range(num_channel_dims)]
+
+    return Array(
+        data,
+        offset=roi.offset,
+        voxel_size=voxel_size,
+        axis_names=axis_names + spatial_axes,
+        units=first.units,
+    )
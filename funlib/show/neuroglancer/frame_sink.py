@@ -0,0 +1,339 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+import zipfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class FrameSink:
+    """Base class for destinations of rendered frames. Frames are passed as
+    PNG encoded images.
+
+    Sinks that set ``ordered`` need to receive frames in order, which is
+    ensured by :class:`OrderedFrameWriter`. Sinks that set ``resumable`` keep
+    the frames of previous runs, such that rendering can be resumed.
+    """
+
+    ordered = False
+    resumable = False
+
+    def write(self, frame_number, data):
+        raise NotImplementedError()
+
+    def has_frame(self, frame_number):
+        """Whether ``frame_number`` was already written by a previous run,
+        used to resume rendering."""
+        return False
+
+    def get_name(self, frame_number):
+        """A human-readable name of where ``frame_number`` is written to."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PngDirectorySink(FrameSink):
+    """Writes each frame as a PNG file into ``directory``, named like
+    ``neuroglancer.ScreenshotSaver`` does.
+
+    Frames are written to a temporary file first and renamed when complete,
+    such that a killed run does not leave truncated frames behind."""
+
+    resumable = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._existing = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def get_name(self, frame_number):
+        return os.path.join(self.directory, "%07d.png" % frame_number)
+
+    def has_frame(self, frame_number):
+        # list the directory once instead of checking each frame, empty
+        # files are left over from killed runs
+        if self._existing is None:
+            with os.scandir(self.directory) as entries:
+                self._existing = set(
+                    entry.name
+                    for entry in entries
+                    if entry.name.endswith(".png") and entry.stat().st_size > 0
+                )
+        return "%07d.png" % frame_number in self._existing
+
+    def write(self, frame_number, data):
+        path = self.get_name(frame_number)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+class VideoSink(FrameSink):
+    """Streams frames into a video file through an ``ffmpeg`` subprocess.
+    An existing video file is overwritten, rendering can not be resumed.
+
+    Args:
+
+            path (``str``):
+
+                The video file to write, its extension determines the
+                container format.
+
+            fps (``float``):
+
+                The frame rate of the video.
+
+            codec_args (``list`` of ``str``, optional):
+
+                Arguments for ``ffmpeg`` to encode the output with. Defaults
+                to H.264 with a pixel format most players support.
+
+            ffmpeg (``str``, optional):
+
+                The ``ffmpeg`` executable to use.
+    """
+
+    ordered = True
+
+    def __init__(self, path, fps, codec_args=None, ffmpeg="ffmpeg"):
+        if codec_args is None:
+            codec_args = [
+                "-c:v",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                # yuv420p needs even dimensions
+                "-vf",
+                "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            ]
+        self.path = path
+        self.command = (
+            [ffmpeg, "-y", "-loglevel", "error"]
+            + ["-f", "image2pipe", "-c:v", "png", "-framerate", str(fps), "-i", "-"]
+            + codec_args
+            + [path]
+        )
+        self._process = None
+
+    def get_name(self, frame_number):
+        return "%s (frame %d)" % (self.path, frame_number)
+
+    def write(self, frame_number, data):
+        if self._process is None:
+            logger.debug("Starting %s", " ".join(self.command))
+            self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE)
+        self._process.stdin.write(data)
+
+    def close(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise RuntimeError(
+                "%s exited with code %d" % (self.command[0], self._process.returncode)
+            )
+        self._process = None
+
+
+class ArchiveSink(FrameSink):
+    """Writes all frames as PNG files into a single (uncompressed) zip
+    archive. Frames already in the archive are kept, such that rendering can
+    be resumed."""
+
+    ordered = True
+    resumable = True
+
+    def __init__(self, path):
+        self.path = path
+        self._archive = None
+
+        if os.path.exists(path):
+            with zipfile.ZipFile(path, "r") as archive:
+                self._existing = set(archive.namelist())
+        else:
+            self._existing = set()
+
+    def get_name(self, frame_number):
+        return "%s:%07d.png" % (self.path, frame_number)
+
+    def has_frame(self, frame_number):
+        return "%07d.png" % frame_number in self._existing
+
+    def write(self, frame_number, data):
+        if self._archive is None:
+            self._archive = zipfile.ZipFile(self.path, "a", zipfile.ZIP_STORED)
+        self._archive.writestr("%07d.png" % frame_number, data)
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+
+class JournaledSink(FrameSink):
+    """Wraps a sink to record each written frame in a journal, from which
+    the frames written by previous runs are obtained in a single read.
+
+    The journal is a text file with one JSON record per written frame:
+
+      {"frame": <frame-number>, "name": <name>, "size": <bytes>, "crc32": <crc>}
+
+    Records are appended once the wrapped sink has written a frame, such that
+    frames of a killed run are either complete and recorded, or not recorded
+    at all. If there is no journal yet, :meth:`has_frame` falls back to the
+    wrapped sink (e.g., for output of runs that did not write a journal).
+
+    Args:
+
+            sink (``FrameSink``):
+
+                The sink to write frames to.
+
+            journal_path (``str``):
+
+                The journal to read and append to.
+
+            resume (``bool``, optional):
+
+                If not set, an existing journal is discarded.
+    """
+
+    def __init__(self, sink, journal_path, resume=True):
+        self.sink = sink
+        self.journal_path = journal_path
+        self.ordered = sink.ordered
+        self.resumable = sink.resumable
+
+        self._journal = None
+        self._incomplete = False
+        self._lock = threading.Lock()
+
+        if not resume and os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.records = self._read_journal()
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return None
+        records = {}
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                self._incomplete = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # incomplete last record of a killed run
+                    logger.warning(
+                        "Ignoring invalid record in %s: %r", self.journal_path, line
+                    )
+                    continue
+                records[record["frame"]] = record
+        return records
+
+    def get_name(self, frame_number):
+        return self.sink.get_name(frame_number)
+
+    def has_frame(self, frame_number):
+        if self.records is None:
+            return self.sink.has_frame(frame_number)
+        return frame_number in self.records
+
+    def write(self, frame_number, data):
+        self.sink.write(frame_number, data)
+        record = {
+            "frame": frame_number,
+            "name": self.sink.get_name(frame_number),
+            "size": len(data),
+            "crc32": zlib.crc32(data),
+        }
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a")
+                if self._incomplete:
+                    # terminate the incomplete last record of a killed run
+                    self._journal.write("\n")
+                    self._incomplete = False
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+
+    def close(self):
+        self.sink.close()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class OrderedFrameWriter:
+    """Passes frames to a sink in order, buffering frames that arrive early.
+
+    Args:
+
+            sink (``FrameSink``):
+
+                The sink to write to. If it is not ``ordered``, frames are
+                passed on immediately.
+
+            frame_numbers (``list`` of ``int``):
+
+                All frames that will be written.
+
+            max_buffered_frames (``int``):
+
+                If this many frames are buffered, :meth:`write` blocks for all
+                but the next frame in order.
+    """
+
+    def __init__(self, sink, frame_numbers, max_buffered_frames):
+        self.sink = sink
+        self.max_buffered_frames = max_buffered_frames
+
+        self._order = sorted(frame_numbers)
+        self._next = 0
+        self._buffer = {}
+        self._condition = threading.Condition()
+
+    @property
+    def next_frame_number(self):
+        if self._next < len(self._order):
+            return self._order[self._next]
+        return None
+
+    def is_full(self):
+        return len(self._buffer) >= self.max_buffered_frames
+
+    def write(self, frame_number, data, block=True):
+        """Write a frame. If ``block`` is set and the buffer is full, wait
+        until this frame is the next one in order."""
+
+        if not self.sink.ordered:
+            self.sink.write(frame_number, data)
+            return
+
+        with self._condition:
+            while block and self.is_full() and frame_number != self.next_frame_number:
+                self._condition.wait()
+
+            self._buffer[frame_number] = data
+            while self.next_frame_number in self._buffer:
+                self.sink.write(
+                    self.next_frame_number, self._buffer.pop(self.next_frame_number)
+                )
+                self._next += 1
+            self._condition.notify_all()
+
+    def close(self):
+        if self._buffer:
+            logger.warning(
+                "Frames %s were never written, missing frame %s",
+                sorted(self._buffer.keys()),
+                self.next_frame_number,
+            )
+        self.sink.close()
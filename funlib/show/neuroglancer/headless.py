@@ -0,0 +1,332 @@
+from .scale_pyramid import ScalePyramid
+from neuroglancer.segment_colors import hex_string_from_segment_id
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# screen axes (right, down) of the cross-section panels in display coordinates
+panel_axes = {
+    "xy": ([1, 0, 0], [0, 1, 0]),
+    "xz": ([1, 0, 0], [0, 0, 1]),
+    "yz": ([0, 0, 1], [0, 1, 0]),
+}
+
+background_colors = {
+    "black": (0, 0, 0),
+    "white": (255, 255, 255),
+    "gray": (128, 128, 128),
+    "grey": (128, 128, 128),
+}
+
+
+def parse_color(color):
+    if color is None:
+        return np.zeros(3)
+    if color in background_colors:
+        return np.array(background_colors[color], dtype=np.float64)
+    color = color.lstrip("#")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    return np.array([int(color[i : i + 2], 16) for i in (0, 2, 4)], dtype=np.float64)
+
+
+def quaternion_to_matrix(q):
+    x, y, z, w = q
+    return np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+
+
+def normalize(values, dtype):
+    """Map values to [0, 1] the way neuroglancer's default shader does: the
+    full range for integer types, [0, 1] for floats."""
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        values = (values.astype(np.float64) - info.min) / (info.max - info.min)
+    return np.clip(values, 0.0, 1.0)
+
+
+class HeadlessRenderer:
+    """Renders cross-sections of the volume layers of a viewer on the CPU,
+    without a browser or GPU.
+
+    The camera (position, orientation, zoom, and layout) is taken from the
+    ``ViewerState`` passed to :meth:`render`, the layers (and their
+    visibility and opacity) from ``viewer``. Volumes are resliced with
+    nearest-neighbor interpolation. For ``ScalePyramid`` layers, the coarsest
+    level that is not coarser than a screen pixel is used.
+
+    Only the default shaders are emulated: image layers are shown in
+    grayscale (or as RGB if they have a channel dimension with at least three
+    channels), segmentation layers with neuroglancer's segment colors. Only
+    the ``xy``, ``xz``, and ``yz`` cross-sections can be rendered, other
+    layouts are rendered as ``xy``.
+
+    Args:
+
+            viewer (``neuroglancer.Viewer``):
+
+                The viewer holding the layers to render.
+
+            width, height (``int``):
+
+                The size of the rendered frames.
+
+            tile_size (``int``, optional):
+
+                Frames are sampled in tiles of this size. Each tile reads one
+                block of data, unless that block would be much larger than
+                the tile.
+    """
+
+    def __init__(self, viewer, width, height, tile_size=64):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+
+        self.layers = []
+        for layer in viewer.state.layers:
+            volume = None
+            for source in layer.source:
+                url = source.url if isinstance(source.url, str) else ""
+                if url.startswith("python://volume/"):
+                    token = url.split(".")[-1]
+                    volume = viewer.volume_manager.volumes.get(token)
+            if volume is None:
+                logger.warning(
+                    "Layer %s has no local volume source, skipping it", layer.name
+                )
+                continue
+            self.layers.append((layer, volume))
+
+    def render(self, state):
+        """Render the cross-section of ``state`` as a ``(height, width, 3)``
+        ``uint8`` array."""
+
+        names, scales, position = self._get_global_coordinates(state)
+
+        display_names = state.display_dimensions or names[:3]
+        display_dims = [names.index(name) for name in display_names]
+
+        orientation = state.cross_section_orientation
+        if orientation is None:
+            orientation = [0, 0, 0, 1]
+        zoom = state.cross_section_scale or 1.0
+        pixel_size = zoom * scales[display_dims].min()
+
+        layout = state.layout.type if state.layout is not None else "xy"
+        axes = panel_axes.get(layout, panel_axes["xy"])
+        rotation = quaternion_to_matrix(orientation)
+        right, down = (rotation @ np.array(axis, dtype=np.float64) for axis in axes)
+
+        # global coordinates of the center of each pixel
+        u = np.arange(self.width) + 0.5 - self.width / 2
+        v = np.arange(self.height) + 0.5 - self.height / 2
+        points = np.tile(position, (self.height, self.width, 1))
+        for k, d in enumerate(display_dims):
+            points[..., d] += (
+                (u[None, :] * right[k] + v[:, None] * down[k]) * pixel_size / scales[d]
+            )
+
+        frame = np.tile(
+            parse_color(state.cross_section_background_color),
+            (self.height, self.width, 1),
+        )
+        for layer, volume in self.layers:
+            if layer.visible is False:
+                continue
+            colors, alpha = self._render_layer(
+                layer, volume, names, scales, points, pixel_size
+            )
+            alpha = alpha[..., None]
+            frame = frame * (1 - alpha) + colors * alpha
+
+        return np.round(np.clip(frame, 0, 255)).astype(np.uint8)
+
+    def _get_global_coordinates(self, state):
+        if state.dimensions is not None and len(state.dimensions.names) > 0:
+            names = list(state.dimensions.names)
+            scales = np.array(state.dimensions.scales, dtype=np.float64)
+        else:
+            # no global coordinate space yet (it is normally set by the
+            # browser), use the spatial dimensions of the first layer
+            dimensions = self._get_levels(self.layers[0][1])[0].dimensions
+            names = [name for name in dimensions.names if "^" not in name]
+            scales = np.array(
+                [
+                    scale
+                    for name, scale in zip(dimensions.names, dimensions.scales)
+                    if "^" not in name
+                ],
+                dtype=np.float64,
+            )
+
+        if state.position is not None and len(state.position) == len(names):
+            position = np.array(state.position, dtype=np.float64)
+        else:
+            position = self._get_center(names, scales)
+
+        return names, scales, position
+
+    def _get_center(self, names, scales):
+        level = self._get_levels(self.layers[0][1])[0]
+        center = np.zeros(len(names))
+        for j, name in enumerate(level.dimensions.names):
+            if name in names:
+                i = names.index(name)
+                center[i] = (
+                    (level.voxel_offset[j] + level.shape[j] / 2)
+                    * level.dimensions.scales[j]
+                    / scales[i]
+                )
+        return center
+
+    def _get_levels(self, volume):
+        """Get the levels of a volume, finest first."""
+
+        if isinstance(volume, ScalePyramid):
+            return [
+                volume.volume_layers[scale]
+                for scale in sorted(volume.volume_layers.keys(), key=np.prod)
+            ]
+        return [volume]
+
+    def _render_layer(self, layer, volume, names, scales, points, pixel_size):
+        levels = self._get_levels(volume)
+        level = levels[0]
+        for candidate in levels[1:]:
+            voxel_size = min(
+                scale
+                for name, scale in zip(
+                    candidate.dimensions.names, candidate.dimensions.scales
+                )
+                if name in names
+            )
+            if voxel_size <= pixel_size:
+                level = candidate
+
+        # voxel indices of all pixels in the level's spatial dimensions
+        spatial_dims = []
+        indices = []
+        for j, name in enumerate(level.dimensions.names):
+            if name not in names:
+                continue
+            i = names.index(name)
+            spatial_dims.append(j)
+            indices.append(
+                np.floor(
+                    points[..., i] * scales[i] / level.dimensions.scales[j]
+                    - level.voxel_offset[j]
+                ).astype(np.int64)
+            )
+        indices = np.stack(indices, axis=-1)
+
+        values, valid = self._sample(level, spatial_dims, indices)
+
+        if volume.volume_type == "segmentation":
+            return self._color_segments(layer, values[..., 0], valid)
+
+        values = normalize(values, np.dtype(level.data.dtype))
+        if values.shape[-1] >= 3:
+            colors = values[..., :3] * 255
+        else:
+            colors = np.repeat(values[..., :1], 3, axis=-1) * 255
+        opacity = layer.opacity if layer.opacity is not None else 0.5
+        return colors, valid * opacity
+
+    def _color_segments(self, layer, segments, valid):
+        color_seed = layer.color_seed or 0
+        alpha = layer.selected_alpha if layer.selected_alpha is not None else 0.5
+
+        ids, inverse = np.unique(segments, return_inverse=True)
+        palette = np.zeros((len(ids), 3))
+        for k, segment_id in enumerate(ids):
+            if segment_id != 0:
+                palette[k] = parse_color(
+                    hex_string_from_segment_id(color_seed, segment_id)
+                )
+        colors = palette[inverse.reshape(segments.shape)]
+
+        return colors, (valid & (segments != 0)) * alpha
+
+    def _sample(self, level, spatial_dims, indices):
+        """Read the values of ``level`` at ``indices`` (an array of shape
+        ``(height, width, len(spatial_dims))``). Returns the values with all
+        channels in the last dimension, and a mask of valid (in bounds)
+        pixels."""
+
+        shape = np.array(level.shape)
+        spatial_shape = shape[spatial_dims]
+        channel_dims = [d for d in range(len(shape)) if d not in spatial_dims]
+        # read at most three channels, enough for RGB
+        channel_slices = {d: slice(0, min(3, shape[d])) for d in channel_dims}
+        num_channels = int(np.prod([s.stop for s in channel_slices.values()]))
+
+        valid = np.all((indices >= 0) & (indices < spatial_shape), axis=-1)
+        values = np.zeros(
+            indices.shape[:2] + (num_channels,), dtype=np.dtype(level.data.dtype)
+        )
+
+        for y in range(0, indices.shape[0], self.tile_size):
+            for x in range(0, indices.shape[1], self.tile_size):
+                tile = np.s_[y : y + self.tile_size, x : x + self.tile_size]
+                self._sample_tile(
+                    level,
+                    spatial_dims,
+                    channel_slices,
+                    indices[tile],
+                    valid[tile],
+                    values[tile],
+                )
+
+        return values, valid
+
+    def _sample_tile(self, level, spatial_dims, channel_slices, indices, valid, out):
+        if not valid.any():
+            return
+
+        points = indices[valid]
+        lower = points.min(axis=0)
+        upper = points.max(axis=0) + 1
+        block_size = np.prod(upper - lower)
+
+        if block_size > max(4096, 8 * len(points)) and valid.size > 1:
+            # the block is much larger than the tile (e.g., for oblique
+            # cross-sections), split the tile instead
+            h, w = valid.shape
+            for tile in [
+                np.s_[: h // 2, : w // 2],
+                np.s_[: h // 2, w // 2 :],
+                np.s_[h // 2 :, : w // 2],
+                np.s_[h // 2 :, w // 2 :],
+            ]:
+                if valid[tile].size > 0:
+                    self._sample_tile(
+                        level,
+                        spatial_dims,
+                        channel_slices,
+                        indices[tile],
+                        valid[tile],
+                        out[tile],
+                    )
+            return
+
+        slices = [None] * len(level.shape)
+        for k, d in enumerate(spatial_dims):
+            slices[d] = slice(lower[k], upper[k])
+        for d, s in channel_slices.items():
+            slices[d] = s
+        block = np.asarray(level.data[tuple(slices)])
+
+        # move channel dimensions last and flatten them
+        block = np.moveaxis(block, spatial_dims, list(range(len(spatial_dims))))
+        block = block.reshape(tuple(upper - lower) + (-1,))
+
+        out[valid] = block[tuple((points - lower).T)]
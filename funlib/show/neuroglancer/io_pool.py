@@ -0,0 +1,194 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import neuroglancer
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def set_server_threads(num_threads):
+    """Let the neuroglancer server handle up to ``num_threads`` chunk requests
+    at once (it handles as many as there are CPUs by default).
+
+    With a :class:`ChunkRequestPool`, the server's threads only wait for the
+    pool. More server threads allow more requests to queue in the pool, such
+    that the pool can choose which ones to serve first."""
+
+    neuroglancer.server.start()
+    server = neuroglancer.server.global_server
+    previous_executor = server.executor
+    server.executor = ThreadPoolExecutor(max_workers=num_threads)
+    previous_executor.shutdown(wait=False)
+
+
+class ChunkRequestPool:
+    """A bounded pool of threads to read and encode the chunks of several
+    layers.
+
+    Requests for chunks in the current view of ``viewer`` are served before
+    requests for other chunks (e.g., chunks neuroglancer prefetches). A chunk
+    is considered in view if it intersects one of the cross-sections through
+    the current position (ignoring the cross-section orientation).
+
+    Args:
+
+            num_threads (``int``):
+
+                The number of threads to read and encode chunks with.
+
+            max_requests_per_layer (``int``, optional):
+
+                How many chunks of a single layer can be read at the same
+                time. Defaults to half of ``num_threads``, such that no layer
+                can hold up all others.
+
+            viewer (``neuroglancer.Viewer``, optional):
+
+                The viewer to get the current view from. If not given, all
+                requests have the same priority.
+    """
+
+    def __init__(self, num_threads, max_requests_per_layer=None, viewer=None):
+        if max_requests_per_layer is None:
+            max_requests_per_layer = max(1, num_threads // 2)
+
+        self.num_threads = num_threads
+        self.max_requests_per_layer = max_requests_per_layer
+        self.viewer = viewer
+
+        self.num_visible = 0
+        self.num_prefetch = 0
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._active = {}
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._worker = threading.local()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def run(self, volume, start, end, scale_key, func, *args):
+        """Run ``func(*args)`` to read and encode the chunk from ``start`` to
+        ``end`` at ``scale_key`` of ``volume`` in the pool, and return its
+        result."""
+
+        if getattr(self._worker, "active", False):
+            # nested request (e.g., from a ScalePyramid to one of its scales),
+            # waiting for another worker could deadlock
+            return func(*args)
+
+        priority = self.get_priority(volume, start, end, scale_key)
+        future = Future()
+        with self._condition:
+            if priority == 0:
+                self.num_visible += 1
+            else:
+                self.num_prefetch += 1
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._counter), volume.token, future, func, args),
+            )
+            self._condition.notify()
+        return future.result()
+
+    def get_priority(self, volume, start, end, scale_key):
+        """Get the priority of a chunk request, ``0`` for chunks in the current
+        view and ``1`` for all others."""
+
+        if self.viewer is None:
+            return 0
+
+        state = self.viewer.state
+        dimensions = state.dimensions
+        position = state.position
+        if (
+            dimensions is None
+            or position is None
+            or len(position) != len(dimensions.names)
+        ):
+            return 0
+
+        names = list(dimensions.names)
+        display_names = list(state.display_dimensions or names[:3])
+        layout = getattr(state.layout, "type", None)
+        # the dimensions orthogonal to the shown cross-sections
+        if layout in ("xy", "xz", "yz") and len(display_names) == 3:
+            normal_names = [display_names[{"xy": 2, "xz": 1, "yz": 0}[layout]]]
+        else:
+            normal_names = display_names
+
+        factors = [int(f) for f in scale_key.split(",")]
+        volume_names = list(volume.dimensions.names)
+        for name in normal_names:
+            if name not in volume_names:
+                return 0
+            i = names.index(name)
+            j = volume_names.index(name)
+            voxel = (
+                position[i] * dimensions.scales[i] / volume.dimensions.scales[j]
+                - volume.voxel_offset[j]
+            ) / factors[j]
+            if start[j] <= voxel < end[j]:
+                return 0
+
+        return 1
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _next_request(self):
+        """Get the request with the highest priority whose layer is below its
+        concurrency limit, or ``None``."""
+
+        skipped = []
+        request = None
+        while self._queue:
+            candidate = heapq.heappop(self._queue)
+            if self._active.get(candidate[2], 0) < self.max_requests_per_layer:
+                request = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self._queue, candidate)
+        return request
+
+    def _work(self):
+        self._worker.active = True
+        while True:
+            with self._condition:
+                request = self._next_request()
+                while request is None and not self._shutdown:
+                    self._condition.wait()
+                    request = self._next_request()
+                if request is None:
+                    return
+                token = request[2]
+                self._active[token] = self._active.get(token, 0) + 1
+
+            _, _, _, future, func, args = request
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._active[token] -= 1
+                    # a request of this layer might be runnable now
+                    self._condition.notify_all()
+
+    def __repr__(self):
+        return "ChunkRequestPool(%d threads, %d visible, %d prefetch requests)" % (
+            self.num_threads,
+            self.num_visible,
+            self.num_prefetch,
+        )
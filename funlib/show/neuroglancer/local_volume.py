@@ -0,0 +1,280 @@
+from .chunk_aligned_array import ChunkAlignedArray
+from neuroglancer import downsample
+from neuroglancer.chunks import encode_jpeg, encode_npz
+import neuroglancer
+import threading
+import time
+
+import numpy as np
+
+# the chunk encodings neuroglancer's python data source can decode
+SUPPORTED_ENCODINGS = ("npz", "raw", "jpeg")
+
+# the timings of the chunk request served in the current thread, if any
+_current_request = threading.local()
+
+
+class ChunkTimings:
+    """The time it took to read and to encode a chunk."""
+
+    def __init__(self):
+        self.read_time = 0.0
+        self.encode_time = 0.0
+
+
+def encode_subvolume(data_format, subvol):
+    """Encode ``subvol`` in ``data_format`` (``"npz"``, ``"raw"``, or
+    ``"jpeg"``). Returns ``(data, content_type)``."""
+
+    if data_format == "npz":
+        return encode_npz(subvol), "application/octet-stream"
+    if data_format == "raw":
+        return subvol.tobytes("C"), "application/octet-stream"
+    if data_format == "jpeg":
+        return encode_jpeg(subvol), "image/jpeg"
+    raise ValueError("Invalid data format requested.")
+
+
+class LocalVolume(neuroglancer.LocalVolume):
+    """A ``neuroglancer.LocalVolume`` with optional caching of encoded chunks.
+
+    Args:
+
+            chunk_cache (``ChunkCache``, optional):
+
+                The cache to store encoded chunks in. If not given, every chunk
+                request is read and encoded from ``data``.
+
+            io_pool (``ChunkRequestPool``, optional):
+
+                The pool to read and encode chunks in. If not given, chunks
+                are read in the thread of the request.
+
+            serving_policy (``LayerServingPolicy``, optional):
+
+                Which chunks to read from ``data`` and how many bytes per
+                second, see :meth:`ServingPolicy.bind`. Chunks the policy does
+                not allow are served as filler chunks (zeros).
+
+            mesh_generator (``MeshGenerator``, optional):
+
+                The generator to get meshes of objects from. If not given,
+                meshes are generated by ``neuroglancer.LocalVolume``.
+
+            metrics (``LayerMetrics``, optional):
+
+                The metrics to record chunk requests in, see
+                :meth:`ChunkMetrics.layer`.
+
+    All other arguments are passed on to ``neuroglancer.LocalVolume``.
+    """
+
+    def __init__(
+        self,
+        *args,
+        chunk_cache=None,
+        io_pool=None,
+        serving_policy=None,
+        mesh_generator=None,
+        metrics=None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+
+        if self.encoding not in SUPPORTED_ENCODINGS:
+            raise ValueError(
+                "Encoding %s is not supported by neuroglancer's python data "
+                "source, use one of %s" % (self.encoding, SUPPORTED_ENCODINGS)
+            )
+
+        self.chunk_cache = chunk_cache
+        self.io_pool = io_pool
+        self.serving_policy = serving_policy
+        self.mesh_generator = mesh_generator
+        self.metrics = metrics
+
+    def get_encoded_subvolume(self, data_format, start, end, scale_key=None):
+        # requests from a ScalePyramid to one of its scales are recorded by
+        # the pyramid
+        if self.metrics is None or getattr(_current_request, "timings", None):
+            return self._serve_encoded_subvolume(
+                data_format, start, end, scale_key, ChunkTimings()
+            )[0]
+
+        start_time = time.perf_counter()
+        timings = ChunkTimings()
+        chunk = None
+        result = "error"
+        try:
+            chunk, result = self._serve_encoded_subvolume(
+                data_format, start, end, scale_key, timings
+            )
+            return chunk
+        finally:
+            self.metrics.record(
+                scale_key or ",".join(("1",) * self.rank),
+                result,
+                time.perf_counter() - start_time,
+                len(chunk[0]) if chunk is not None else 0,
+                timings,
+                start,
+                end,
+            )
+
+    def _serve_encoded_subvolume(self, data_format, start, end, scale_key, timings):
+        """Get the encoded chunk, and whether it was ``"read"``, a
+        ``"cache_hit"``, or a ``"filler"``."""
+
+        if self.serving_policy is not None and not self.serving_policy.allows(
+            start, end, scale_key
+        ):
+            return (
+                self.serving_policy.get_filler_chunk(data_format, start, end),
+                "filler",
+            )
+
+        if self.chunk_cache is None:
+            return (
+                self._read_encoded_subvolume(
+                    data_format, start, end, scale_key, timings
+                ),
+                "read",
+            )
+
+        key = (data_format, scale_key, tuple(start), tuple(end))
+        chunk = self.chunk_cache.get(self.token, key)
+        if chunk is not None:
+            return chunk, "cache_hit"
+
+        chunk = self._read_encoded_subvolume(
+            data_format, start, end, scale_key, timings
+        )
+        self.chunk_cache.put(self.token, key, chunk)
+        return chunk, "read"
+
+    def _read_encoded_subvolume(self, data_format, start, end, scale_key, timings):
+        if self.serving_policy is not None:
+            self.serving_policy.throttle(self._get_read_bytes(start, end, scale_key))
+
+        if self.io_pool is None:
+            return self._get_timed_encoded_subvolume(
+                timings, data_format, start, end, scale_key
+            )
+
+        return self.io_pool.run(
+            self,
+            start,
+            end,
+            scale_key or ",".join(("1",) * self.rank),
+            self._get_timed_encoded_subvolume,
+            timings,
+            data_format,
+            start,
+            end,
+            scale_key,
+        )
+
+    def _get_timed_encoded_subvolume(self, timings, data_format, start, end, scale_key):
+        """Get the encoded chunk, and add the time to read and encode it to
+        ``timings`` (unless this is a nested request of a ScalePyramid, whose
+        timings are collected by the pyramid)."""
+
+        if getattr(_current_request, "timings", None) is not None:
+            return self._get_encoded_subvolume(data_format, start, end, scale_key)
+
+        _current_request.timings = timings
+        try:
+            return self._get_encoded_subvolume(data_format, start, end, scale_key)
+        finally:
+            _current_request.timings = None
+
+    def _get_encoded_subvolume(self, data_format, start, end, scale_key):
+        start_time = time.perf_counter()
+        subvol = self._get_subvolume(
+            start, end, scale_key or ",".join(("1",) * self.rank)
+        )
+        read_time = time.perf_counter()
+        chunk = encode_subvolume(data_format, subvol)
+
+        timings = getattr(_current_request, "timings", None)
+        if timings is not None:
+            timings.read_time += read_time - start_time
+            timings.encode_time += time.perf_counter() - read_time
+        return chunk
+
+    def _get_read_bytes(self, start, end, scale_key):
+        """An upper bound of the number of bytes read from ``data`` to serve
+        the chunk from ``start`` to ``end`` at ``scale_key``."""
+
+        factors = [int(f) for f in scale_key.split(",")] if scale_key else 1
+        return int(
+            np.prod(np.array(end) - np.array(start))
+            * np.prod(factors)
+            * self.data.dtype.itemsize
+        )
+
+    def _get_subvolume(self, start, end, scale_key):
+        """Read (and downsample) the data between ``start`` and ``end`` at
+        ``scale_key``, like ``neuroglancer.LocalVolume`` does before
+        encoding."""
+
+        if len(start) != self.rank or len(end) != self.rank:
+            raise ValueError("Invalid request")
+        downsample_factor = np.array(scale_key.split(","), dtype=np.int64)
+        if (
+            len(downsample_factor) != self.rank
+            or np.any(downsample_factor < 1)
+            or np.any(downsample_factor > self.max_downsampling)
+            or np.prod(downsample_factor) > self.max_downsampling
+        ):
+            raise ValueError("Invalid downsampling factor.")
+        downsampled_shape = np.asarray(
+            np.ceil(self.shape / downsample_factor), dtype=np.int64
+        )
+        if np.any(end < start) or np.any(start < 0) or np.any(end > downsampled_shape):
+            raise ValueError("Out of bounds data request.")
+
+        subvol = np.asarray(
+            self.data[
+                tuple(
+                    np.s_[
+                        start[i]
+                        * downsample_factor[i] : min(
+                            self.shape[i], end[i] * downsample_factor[i]
+                        )
+                    ]
+                    for i in range(self.rank)
+                )
+            ]
+        )
+        if subvol.dtype == "float64":
+            subvol = np.asarray(subvol, dtype=np.float32)
+
+        if np.any(downsample_factor != 1):
+            if self.volume_type == "image":
+                subvol = downsample.downsample_with_averaging(subvol, downsample_factor)
+            else:
+                subvol = downsample.downsample_with_striding(subvol, downsample_factor)
+        return subvol
+
+    def get_object_mesh(self, object_id):
+        if self.mesh_generator is not None:
+            return self.mesh_generator.get_mesh(object_id)
+        return super().get_object_mesh(object_id)
+
+    def invalidate(self):
+        if self.chunk_cache is not None:
+            self.chunk_cache.invalidate(self.token)
+        self._invalidate_storage_cache()
+        if self.mesh_generator is not None:
+            self.mesh_generator.invalidate()
+        return super().invalidate()
+
+    def _invalidate_storage_cache(self):
+        """Remove decoded storage chunks of this volume from its
+        ``DecodedChunkCache``, if reads are aligned to storage chunks."""
+
+        # neuroglancer wraps the data in a DataWrapper
+        data = getattr(self.data, "_data", self.data)
+        if isinstance(data, ChunkAlignedArray):
+            data.invalidate()
@@ -0,0 +1,442 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from neuroglancer.local_volume import InvalidObjectIdForMesh
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def default_mesh_cache_dir():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "funlib.show.neuroglancer", "meshes")
+
+
+def _generate_mesh(mask, voxel_size, offset, mesh_options):
+    """Mesh the foreground of a binary ``mask`` with neuroglancer's mesh
+    generator (run in the worker processes of a :class:`MeshService`).
+    Returns the encoded mesh, or ``None`` if ``mask`` is empty."""
+
+    from neuroglancer import _neuroglancer
+
+    generator = _neuroglancer.OnDemandObjectMeshGenerator(
+        mask.transpose(), voxel_size, offset, **mesh_options
+    )
+    return generator.get_mesh(1)
+
+
+class MeshService:
+    """A pool of processes to generate meshes of segmentation layers in,
+    usually shared between all layers of a viewer (see :class:`MeshGenerator`).
+
+    Args:
+
+            num_workers (``int``, optional):
+
+                The number of processes to generate meshes with. Defaults to
+                the number of CPUs.
+
+            cache_dir (``str``, optional):
+
+                The directory to cache generated meshes in. Defaults to
+                ``$XDG_CACHE_HOME/funlib.show.neuroglancer/meshes``.
+    """
+
+    def __init__(self, num_workers=None, cache_dir=None):
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        if cache_dir is None:
+            cache_dir = default_mesh_cache_dir()
+
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+
+        self._processes = None
+        # for reading the data of objects to mesh and waiting for the
+        # processes, when meshing a batch of objects
+        self._threads = ThreadPoolExecutor(2 * num_workers)
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._processes is None:
+                # started once the first mesh is requested, not forked, since
+                # forking while other threads (e.g., of the neuroglancer
+                # server) hold locks can deadlock the workers
+                self._processes = ProcessPoolExecutor(
+                    self.num_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+        return self._processes.submit(func, *args)
+
+    def map(self, func, iterable):
+        return self._threads.map(func, iterable)
+
+    def shutdown(self):
+        self._threads.shutdown(cancel_futures=True)
+        with self._lock:
+            if self._processes is not None:
+                self._processes.shutdown(cancel_futures=True)
+                self._processes = None
+
+    def __repr__(self):
+        return "MeshService(%d workers, cache in %s)" % (
+            self.num_workers,
+            self.cache_dir,
+        )
+
+
+class MeshGenerator:
+    """Generates, and caches on disk, the meshes of the objects of a
+    segmentation layer.
+
+    Meshes are generated from ``volume``, which can be a coarser scale of the
+    layer than its first scale ``reference_volume`` (meshes are placed in the
+    coordinate space of the latter). Each object is meshed in a worker
+    process of ``service``, from a crop of ``volume`` around the object only.
+    The crops are found with an index of the objects in each block of
+    ``block_size`` voxels, which is built in the background with a single
+    pass over ``volume`` when the first mesh is requested (and cached on disk
+    as well). Until it is built, objects are found in the whole ``volume``.
+
+    Meshes and the index are cached in a directory per ``key`` (e.g., the path
+    of the dataset), ``version`` of the data, and scale of ``volume``. The
+    directory is only created once the first mesh is generated, and meshes
+    cached for other versions of the same ``key`` are removed then.
+
+    Args:
+
+            service (``MeshService``):
+
+                The pool of processes to generate meshes in, and the cache
+                directory to use.
+
+            volume (``LocalVolume``):
+
+                The scale of the layer to generate meshes from.
+
+            reference_volume (``LocalVolume``):
+
+                The first scale of the layer.
+
+            key (``str``):
+
+                A unique name of the dataset shown in the layer.
+
+            version (``str``, optional):
+
+                The version of the data (e.g., the modification time of the
+                dataset). Meshes cached for other versions are not used.
+
+            block_size (``int``, optional):
+
+                The size of the blocks of the index.
+
+            mesh_options (``dict``, optional):
+
+                Options of neuroglancer's mesh generator, see
+                ``neuroglancer.LocalVolume``.
+    """
+
+    def __init__(
+        self,
+        service,
+        volume,
+        reference_volume,
+        key,
+        version=None,
+        block_size=32,
+        mesh_options=None,
+    ):
+        self.service = service
+        self.volume = volume
+        self.key = key
+        self.version = version
+        self.block_size = block_size
+        self.mesh_options = mesh_options if mesh_options is not None else {}
+
+        # the mesh generator places vertices at (index + offset) * voxel_size,
+        # choose the offset such that meshes of any scale are placed like
+        # neuroglancer places meshes generated from the first scale
+        reference_scales = np.array(reference_volume.dimensions.scales)
+        self.voxel_size = np.array(volume.dimensions.scales, dtype=np.float64)
+        shift = (
+            np.array(volume.voxel_offset) * self.voxel_size
+            - np.array(reference_volume.voxel_offset) * reference_scales
+        )
+        self.offset = 0.5 + (shift - 0.5 * reference_scales) / self.voxel_size
+
+        scale = np.rint(self.voxel_size / reference_scales).astype(np.int64)
+        self.key_dir = os.path.join(
+            service.cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16]
+        )
+        self.cache_dir = os.path.join(
+            self.key_dir,
+            "unversioned" if version is None else "v%s" % (version,),
+            "_".join(map(str, scale)),
+        )
+        self._cache_dir_created = False
+
+        self.num_cached = 0
+        self.num_generated = 0
+        self.generation_time = 0.0
+
+        self._index = None
+        self._index_thread = None
+        # incremented on invalidation, to discard indices built before
+        self._index_generation = 0
+        self._index_lock = threading.Lock()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_mesh(self, object_id):
+        """Get the encoded mesh of ``object_id``, from the cache or generated
+        in the service's worker processes. Concurrent requests for the same
+        object share one generated mesh."""
+
+        path = os.path.join(self.cache_dir, "%d" % object_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            with self._lock:
+                self.num_cached += 1
+        except FileNotFoundError:
+            with self._lock:
+                future = self._pending.get(object_id)
+                owner = future is None
+                if owner:
+                    future = self._pending[object_id] = Future()
+            if owner:
+                try:
+                    future.set_result(self._generate_mesh(object_id, path))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        del self._pending[object_id]
+            data = future.result()
+
+        if not data:
+            # objects without mesh are cached as empty files
+            raise InvalidObjectIdForMesh()
+        return data
+
+    def generate(self, object_ids):
+        """Generate the meshes of all ``object_ids`` in parallel (and cache
+        them). Returns the number of objects that have a mesh."""
+
+        def generate_mesh(object_id):
+            try:
+                self.get_mesh(object_id)
+                return True
+            except InvalidObjectIdForMesh:
+                return False
+
+        start_time = time.perf_counter()
+        # without the index, each object would be searched in the whole volume
+        self._get_index(wait=True)
+        num_meshes = sum(self.service.map(generate_mesh, object_ids))
+        logger.info(
+            "Generated %d meshes of %s in %.2fs",
+            num_meshes,
+            self.key,
+            time.perf_counter() - start_time,
+        )
+        return num_meshes
+
+    def invalidate(self):
+        """Remove all cached meshes (and the index) of this scale."""
+
+        with self._index_lock:
+            self._index = None
+            self._index_thread = None
+            self._index_generation += 1
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            with self._lock:
+                self._cache_dir_created = False
+
+    def _create_cache_dir(self):
+        """Create the cache directory before the first mesh or index is
+        written to it, and remove meshes cached for other versions."""
+
+        with self._lock:
+            if self._cache_dir_created:
+                return
+            version_dir = os.path.dirname(self.cache_dir)
+            if os.path.isdir(self.key_dir):
+                for name in os.listdir(self.key_dir):
+                    path = os.path.join(self.key_dir, name)
+                    if os.path.isdir(path) and path != version_dir:
+                        logger.info("Removing stale meshes of %s in %s", self.key, path)
+                        shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.key_dir, "key"), "w") as f:
+                f.write(self.key)
+            self._cache_dir_created = True
+
+    def _generate_mesh(self, object_id, path):
+        start_time = time.perf_counter()
+
+        mask, start = self._get_object_mask(object_id)
+        if mask is None:
+            data = b""
+        else:
+            offset = self.offset + start
+            data = self.service.submit(
+                _generate_mesh, mask, self.voxel_size, offset, self.mesh_options
+            ).result()
+            if data is None:
+                data = b""
+
+        self._create_cache_dir()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+        with self._lock:
+            self.num_generated += 1
+            self.generation_time += time.perf_counter() - start_time
+
+        return data
+
+    def _get_object_mask(self, object_id):
+        """Get a mask of ``object_id``, cropped to the object padded by one
+        voxel, and the start of the crop in ``volume``. The mask is ``None``
+        if the object does not exist."""
+
+        index = self._get_index()
+        if index is not None:
+            slices = self._get_object_slices(index, object_id)
+            if slices is None:
+                return None, None
+            mask = np.asarray(self.volume.data[slices]) == object_id
+            return mask.astype(np.uint8), np.array([s.start for s in slices])
+
+        # the index is not built yet, find the object in the whole volume
+        shape = self.volume.data.shape
+        mask = np.asarray(self.volume.data[tuple(slice(0, s) for s in shape)])
+        mask = mask == object_id
+        slices = []
+        for axis, size in enumerate(shape):
+            other_axes = tuple(a for a in range(len(shape)) if a != axis)
+            (indices,) = np.nonzero(mask.any(axis=other_axes))
+            if len(indices) == 0:
+                return None, None
+            slices.append(slice(max(indices[0] - 1, 0), min(indices[-1] + 2, size)))
+        slices = tuple(slices)
+        return mask[slices].astype(np.uint8), np.array([s.start for s in slices])
+
+    def _get_object_slices(self, index, object_id):
+        """Get the slices of the blocks containing ``object_id`` in
+        ``index``, padded by one voxel, or ``None`` if the object does not
+        exist."""
+
+        block_ids, block_indices = index
+        begin = np.searchsorted(block_ids, object_id, side="left")
+        end = np.searchsorted(block_ids, object_id, side="right")
+        if begin == end:
+            return None
+
+        shape = np.array(self.volume.data.shape)
+        grid_shape = -(-shape // self.block_size)
+        blocks = np.array(np.unravel_index(block_indices[begin:end], grid_shape))
+        start = np.maximum(blocks.min(axis=1) * self.block_size - 1, 0)
+        stop = np.minimum((blocks.max(axis=1) + 1) * self.block_size + 1, shape)
+        return tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+
+    def _get_index(self, wait=False):
+        """Get the index of objects to blocks, as the sorted object IDs and
+        the (flat) indices of the blocks they are contained in. If it is not
+        cached, it is built in the background and ``None`` is returned until
+        it is done, unless ``wait`` is set."""
+
+        with self._index_lock:
+            if self._index is not None:
+                return self._index
+
+            if self._index_thread is None:
+                path = os.path.join(self.cache_dir, "index.npz")
+                if os.path.exists(path):
+                    with np.load(path) as index:
+                        self._index = (index["ids"], index["blocks"])
+                    return self._index
+
+                self._index_thread = threading.Thread(
+                    target=self._build_index,
+                    args=(self._index_generation,),
+                    daemon=True,
+                )
+                self._index_thread.start()
+            thread = self._index_thread
+
+        if wait:
+            thread.join()
+        return self._index
+
+    def _build_index(self, generation):
+        start_time = time.perf_counter()
+        shape = self.volume.data.shape
+        grid_shape = [-(-s // self.block_size) for s in shape]
+
+        def get_block_ids(block_index):
+            block = np.unravel_index(block_index, grid_shape)
+            slices = tuple(
+                slice(b * self.block_size, min(s, (b + 1) * self.block_size))
+                for b, s in zip(block, shape)
+            )
+            ids = np.unique(np.asarray(self.volume.data[slices]))
+            return ids[ids != 0]
+
+        num_blocks = int(np.prod(grid_shape))
+        # not in the service's threads, which might all generate meshes
+        try:
+            with ThreadPoolExecutor(self.service.num_workers) as executor:
+                block_ids = list(executor.map(get_block_ids, range(num_blocks)))
+        except Exception:
+            logger.exception("Failed to index the objects of %s", self.key)
+            with self._index_lock:
+                if generation == self._index_generation:
+                    # try again with the next request
+                    self._index_thread = None
+            return
+        ids = np.concatenate(block_ids)
+        blocks = np.fromiter(
+            itertools.chain.from_iterable(
+                itertools.repeat(b, len(i)) for b, i in enumerate(block_ids)
+            ),
+            dtype=np.int64,
+            count=len(ids),
+        )
+        order = np.argsort(ids, kind="stable")
+        index = (ids[order], blocks[order])
+
+        with self._index_lock:
+            # the data changed while indexing
+            if generation != self._index_generation:
+                return
+            self._create_cache_dir()
+            path = os.path.join(self.cache_dir, "index.npz")
+            np.savez(path + ".tmp.npz", ids=index[0], blocks=index[1])
+            os.replace(path + ".tmp.npz", path)
+            self._index = index
+        logger.info(
+            "Indexed %d objects in %d blocks of %s in %.2fs",
+            len(np.unique(ids)),
+            num_blocks,
+            self.key,
+            time.perf_counter() - start_time,
+        )
+
+    def __repr__(self):
+        return "MeshGenerator(%s, %d cached, %d generated meshes in %.1fs)" % (
+            self.key,
+            self.num_cached,
+            self.num_generated,
+            self.generation_time,
+        )
@@ -0,0 +1,228 @@
+from funlib.persistence import Array, open_ds
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import zarr
+
+logger = logging.getLogger(__name__)
+
+# files whose modification time invalidates the cached metadata of a dataset,
+# for zarr v2 and zarr v3 containers
+METADATA_FILES = ["", ".zarray", ".zattrs", ".zgroup", "zarr.json"]
+
+# files that mark a zarr v2 or v3 array (v3 groups are not opened as arrays)
+ZARR_ARRAY_FILES = [".zarray", "zarr.json"]
+
+
+def default_cache_file():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "funlib.show.neuroglancer", "metadata.json")
+
+
+def get_mtime(ds_path):
+    """Get the latest modification time (in ns) of the dataset directory and
+    its metadata files, or ``None`` if ``ds_path`` is not a local path."""
+
+    mtimes = []
+    for name in METADATA_FILES:
+        try:
+            mtimes.append(os.stat(os.path.join(ds_path, name)).st_mtime_ns)
+        except OSError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+def get_chunk_mtimes(ds_path, chunk_indices):
+    """Get the modification times (in ns) of the storage chunks
+    ``chunk_indices`` of the zarr array at ``ds_path`` (``None`` for chunks
+    that were never written), or ``None`` if ``ds_path`` can not be opened."""
+
+    try:
+        metadata = zarr.open_array(ds_path, mode="r").metadata
+    except Exception:
+        return None
+
+    mtimes = []
+    for chunk_index in chunk_indices:
+        key = metadata.encode_chunk_key(tuple(chunk_index))
+        try:
+            mtimes.append(os.stat(os.path.join(ds_path, key)).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def is_zarr_array(ds_path):
+    """Check whether ``ds_path`` is a local zarr array, whose metadata can be
+    cached."""
+
+    return any(os.path.isfile(os.path.join(ds_path, name)) for name in ZARR_ARRAY_FILES)
+
+
+class LazyZarrArray:
+    """A stand-in for a zarr array with known shape and dtype, which is only
+    opened when data is read from it for the first time."""
+
+    def __init__(self, store, shape, dtype):
+        self.store = store
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+        self._array = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if self._array is None:
+            with self._lock:
+                if self._array is None:
+                    self._array = zarr.open(self.store, mode="r")
+        return self._array[key]
+
+    def __dask_tokenize__(self):
+        return (LazyZarrArray, self.store, self.shape, self.dtype.str)
+
+
+class MetadataCache:
+    """An on-disk cache of the metadata of datasets, to avoid reading it from
+    storage again for datasets that did not change since they were last
+    opened. Entries are keyed by the absolute path of a dataset and the
+    modification time of its metadata files.
+
+    Args:
+
+            cache_file (``str``, optional):
+
+                The JSON file to store the cache in. Defaults to
+                ``$XDG_CACHE_HOME/funlib.show.neuroglancer/metadata.json``.
+
+            refresh (``bool``, optional):
+
+                If set, existing entries are ignored and overwritten.
+    """
+
+    def __init__(self, cache_file=None, refresh=False):
+        if cache_file is None:
+            cache_file = default_cache_file()
+        self.cache_file = cache_file
+
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if not refresh and os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                logger.warning("Ignoring corrupt metadata cache %s", cache_file)
+
+    def get(self, ds_path, field):
+        """Get the cached ``field`` of the dataset at ``ds_path``, or ``None``
+        if it is not cached or the dataset changed since."""
+
+        key = os.path.abspath(ds_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or field not in entry:
+            return None
+        if entry["mtime"] != get_mtime(key):
+            return None
+        return entry[field]
+
+    def put(self, ds_path, field, value):
+        """Store ``field`` of the dataset at ``ds_path``. ``value`` has to be
+        JSON serializable."""
+
+        key = os.path.abspath(ds_path)
+        mtime = get_mtime(key)
+        if mtime is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["mtime"] != mtime:
+                entry = {"mtime": mtime}
+                self._entries[key] = entry
+            entry[field] = value
+            self._dirty = True
+
+    def get_statistics(self, ds_path):
+        """Get the cached intensity statistics (see ``compute_statistics``) of
+        the zarr array at ``ds_path``, or ``None`` if they are not cached or
+        any of the sampled storage chunks changed since."""
+
+        entry = self.get(ds_path, "statistics")
+        if entry is None or "chunk_mtimes" not in entry:
+            return None
+        if get_chunk_mtimes(ds_path, entry["chunks"]) != entry["chunk_mtimes"]:
+            return None
+        return entry
+
+    def put_statistics(self, ds_path, statistics):
+        """Store the intensity ``statistics`` of the zarr array at
+        ``ds_path``, together with the modification times of the storage
+        chunks they were computed from."""
+
+        if statistics.get("chunks") is None or not is_zarr_array(ds_path):
+            return
+        chunk_mtimes = get_chunk_mtimes(ds_path, statistics["chunks"])
+        if chunk_mtimes is None:
+            return
+        self.put(ds_path, "statistics", dict(statistics, chunk_mtimes=chunk_mtimes))
+
+    def open_ds(self, ds_path):
+        """Open the array at ``ds_path`` like ``funlib.persistence.open_ds``,
+        but from cached metadata if possible. Only the metadata of zarr
+        arrays is cached, other datasets (e.g., N5) are always opened with
+        ``open_ds``."""
+
+        if not is_zarr_array(ds_path):
+            return open_ds(ds_path)
+
+        metadata = self.get(ds_path, "array")
+        if metadata is not None:
+            return Array(
+                LazyZarrArray(
+                    os.path.abspath(ds_path), metadata["shape"], metadata["dtype"]
+                ),
+                offset=metadata["offset"],
+                voxel_size=metadata["voxel_size"],
+                axis_names=metadata["axis_names"],
+                units=metadata["units"],
+                types=metadata["types"],
+                chunks=metadata["chunks"],
+            )
+
+        array = open_ds(ds_path)
+        self.put(
+            ds_path,
+            "array",
+            {
+                "shape": [int(x) for x in array.shape],
+                "dtype": np.dtype(array.dtype).str,
+                "offset": [int(x) for x in array.offset],
+                "voxel_size": [int(x) for x in array.voxel_size],
+                "axis_names": list(array.axis_names),
+                "units": list(array.units),
+                "types": list(array.types),
+                "chunks": [int(x) for x in array.chunk_shape],
+            },
+        )
+
+        return array
+
+    def save(self):
+        """Write the cache to disk, if anything changed."""
+
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_path = "%s.%d.tmp" % (self.cache_file, os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.cache_file)
+            self._dirty = False
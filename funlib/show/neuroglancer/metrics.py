@@ -0,0 +1,337 @@
+"""Counters and latency histograms of the chunk requests of each layer and
+scale, exposed in the Prometheus text format on the neuroglancer server."""
+
+import bisect
+import logging
+import threading
+
+import neuroglancer
+import numpy as np
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH_REGEX = r"^/metrics$"
+
+# upper bounds of the latency histogram buckets, in seconds
+default_buckets = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # the last count is for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate the ``q``-quantile, as the upper bound of the bucket it
+        falls into."""
+
+        if self.count == 0:
+            return 0.0
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, q * self.count))
+        return self.buckets[i] if i < len(self.buckets) else np.inf
+
+
+class ScaleMetrics:
+    """The metrics of one scale of a layer."""
+
+    def __init__(self, buckets):
+        self.results = {}
+        self.bytes_out = 0
+        self.num_slow = 0
+        self.request_time = Histogram(buckets)
+        self.read_time = Histogram(buckets)
+        self.encode_time = Histogram(buckets)
+
+
+class LayerMetrics:
+    """The metrics of the chunk requests of a single layer, by scale.
+    Obtained with :meth:`ChunkMetrics.layer`."""
+
+    def __init__(self, name, buckets, slow_request_seconds):
+        self.name = name
+        self.buckets = buckets
+        self.slow_request_seconds = slow_request_seconds
+        self.scales = {}
+        self._lock = threading.Lock()
+
+    def record(self, scale_key, result, request_time, num_bytes, timings, start, end):
+        """Record a chunk request of the chunk from ``start`` to ``end`` at
+        ``scale_key``, which was served as ``result`` (``"read"``,
+        ``"cache_hit"``, ``"filler"``, or ``"error"``) in ``request_time``
+        seconds. ``timings`` are the ``ChunkTimings`` of reading and encoding
+        the chunk, if it was read."""
+
+        with self._lock:
+            metrics = self.scales.get(scale_key)
+            if metrics is None:
+                metrics = self.scales[scale_key] = ScaleMetrics(self.buckets)
+            metrics.results[result] = metrics.results.get(result, 0) + 1
+            metrics.bytes_out += num_bytes
+            metrics.request_time.observe(request_time)
+            if result == "read":
+                metrics.read_time.observe(timings.read_time)
+                metrics.encode_time.observe(timings.encode_time)
+            slow = (
+                self.slow_request_seconds is not None
+                and request_time > self.slow_request_seconds
+            )
+            if slow:
+                metrics.num_slow += 1
+
+        if slow:
+            logger.warning(
+                "Slow chunk request of layer %s at scale %s from %s to %s: "
+                "%.2fs (%s, read %.2fs, encode %.2fs, %d bytes)",
+                self.name,
+                scale_key,
+                [int(x) for x in start],
+                [int(x) for x in end],
+                request_time,
+                result,
+                timings.read_time,
+                timings.encode_time,
+                num_bytes,
+            )
+
+
+class ChunkMetrics:
+    """Collects the metrics of the chunk requests of all layers it is passed
+    to (see ``add_layer``), per layer and scale: the number of requests by
+    result (read, cache hit, filler, error), the number of bytes sent, and
+    histograms of the request, read, and encode times.
+
+    Args:
+
+            slow_request_seconds (``float``, optional):
+
+                Log a warning for every chunk request that takes longer than
+                this. If not given, no requests are logged.
+
+            buckets (``tuple`` of ``float``, optional):
+
+                The upper bounds of the histogram buckets, in seconds.
+    """
+
+    def __init__(self, slow_request_seconds=None, buckets=default_buckets):
+        self.slow_request_seconds = slow_request_seconds
+        self.buckets = buckets
+        self.layers = {}
+        self._lock = threading.Lock()
+
+    def layer(self, name):
+        """Get the metrics of the layer ``name``, to pass to its
+        ``LocalVolume`` or ``ScalePyramid``."""
+
+        with self._lock:
+            layer = self.layers.get(name)
+            if layer is None:
+                layer = self.layers[name] = LayerMetrics(
+                    name, self.buckets, self.slow_request_seconds
+                )
+            return layer
+
+    def serve(self):
+        """Serve the metrics at ``/metrics`` of the neuroglancer server.
+        Returns the URL."""
+
+        neuroglancer.server.start()
+        server = neuroglancer.server.global_server
+        with self._lock:
+            server.app.add_handlers(
+                r".*$", [(METRICS_PATH_REGEX, MetricsHandler, dict(metrics=self))]
+            )
+        return server.server_url + "/metrics"
+
+    def to_prometheus(self):
+        """Get the metrics in the Prometheus text format."""
+
+        with self._lock:
+            layers = list(self.layers.values())
+        scales = []
+        for layer in layers:
+            with layer._lock:
+                for scale_key, metrics in sorted(layer.scales.items()):
+                    scales.append((layer.name, scale_key, _copy(metrics)))
+
+        lines = []
+
+        def add_header(name, metric_type, help_text):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+
+        def add_sample(name, labels, value):
+            labels = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            lines.append("%s{%s} %s" % (name, labels, _format_value(value)))
+
+        add_header(
+            "funlib_chunk_requests_total",
+            "counter",
+            "Chunk requests by result (read, cache_hit, filler, error).",
+        )
+        for layer, scale_key, metrics in scales:
+            for result, count in sorted(metrics.results.items()):
+                add_sample(
+                    "funlib_chunk_requests_total",
+                    [("layer", layer), ("scale", scale_key), ("result", result)],
+                    count,
+                )
+
+        for name, help_text, attribute in [
+            ("funlib_chunk_bytes_total", "Bytes of encoded chunks sent.", "bytes_out"),
+            (
+                "funlib_chunk_slow_requests_total",
+                "Chunk requests slower than the slow request threshold.",
+                "num_slow",
+            ),
+        ]:
+            add_header(name, "counter", help_text)
+            for layer, scale_key, metrics in scales:
+                add_sample(
+                    name,
+                    [("layer", layer), ("scale", scale_key)],
+                    getattr(metrics, attribute),
+                )
+
+        for name, help_text, attribute in [
+            (
+                "funlib_chunk_request_seconds",
+                "Time to serve chunk requests.",
+                "request_time",
+            ),
+            (
+                "funlib_chunk_read_seconds",
+                "Time to read (and downsample) chunks from storage.",
+                "read_time",
+            ),
+            ("funlib_chunk_encode_seconds", "Time to encode chunks.", "encode_time"),
+        ]:
+            add_header(name, "histogram", help_text)
+            for layer, scale_key, metrics in scales:
+                histogram = getattr(metrics, attribute)
+                labels = [("layer", layer), ("scale", scale_key)]
+                cumulative = 0
+                for bound, count in zip(
+                    list(histogram.buckets) + [np.inf], histogram.counts
+                ):
+                    cumulative += count
+                    add_sample(
+                        name + "_bucket",
+                        labels + [("le", _format_value(bound))],
+                        cumulative,
+                    )
+                add_sample(name + "_sum", labels, histogram.sum)
+                add_sample(name + "_count", labels, histogram.count)
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Get a summary of the metrics of each layer, one line per layer."""
+
+        with self._lock:
+            layers = list(self.layers.values())
+
+        lines = []
+        for layer in layers:
+            with layer._lock:
+                scales = [_copy(metrics) for metrics in layer.scales.values()]
+            if not scales:
+                continue
+            request_time = _merge([m.request_time for m in scales])
+            read_time = _merge([m.read_time for m in scales])
+            encode_time = _merge([m.encode_time for m in scales])
+            num_hits = sum(m.results.get("cache_hit", 0) for m in scales)
+            lines.append(
+                "%s: %d requests (%d%% cache hits, %d errors), %.1f MB sent, "
+                "p50 %s, p95 %s, mean read %.1f ms, mean encode %.1f ms, "
+                "%d slow"
+                % (
+                    layer.name,
+                    request_time.count,
+                    100 * num_hits / max(1, request_time.count),
+                    sum(m.results.get("error", 0) for m in scales),
+                    sum(m.bytes_out for m in scales) / 1024**2,
+                    _format_bound(request_time.quantile(0.5)),
+                    _format_bound(request_time.quantile(0.95)),
+                    1e3 * read_time.sum / max(1, read_time.count),
+                    1e3 * encode_time.sum / max(1, encode_time.count),
+                    sum(m.num_slow for m in scales),
+                )
+            )
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "ChunkMetrics(%d layers)" % len(self.layers)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-type", "text/plain; version=0.0.4")
+        self.finish(self.metrics.to_prometheus())
+
+
+def _copy(metrics):
+    copy = ScaleMetrics(metrics.request_time.buckets)
+    copy.results = dict(metrics.results)
+    copy.bytes_out = metrics.bytes_out
+    copy.num_slow = metrics.num_slow
+    for name in ("request_time", "read_time", "encode_time"):
+        histogram = getattr(copy, name)
+        source = getattr(metrics, name)
+        histogram.counts = list(source.counts)
+        histogram.sum = source.sum
+        histogram.count = source.count
+    return copy
+
+
+def _merge(histograms):
+    merged = Histogram(histograms[0].buckets)
+    for histogram in histograms:
+        merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        merged.sum += histogram.sum
+        merged.count += histogram.count
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == np.inf:
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_bound(seconds):
+    if seconds == np.inf:
+        return "> max"
+    return "< %.0f ms" % (seconds * 1e3) if seconds < 1 else "< %.1f s" % seconds
@@ -0,0 +1,289 @@
+from .local_volume import LocalVolume
+from .scale_pyramid import ScalePyramid
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from neuroglancer.downsample_scales import compute_near_isotropic_downsampling_scales
+import itertools
+import logging
+import neuroglancer
+import os
+import threading
+import time
+import zarr
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _split_factors(block, factor):
+    """Reshape ``block`` such that each dimension ``d`` is split into
+    ``(block.shape[d] // factor[d], factor[d])``, and move all the factor
+    dimensions last."""
+
+    shape = []
+    for size, f in zip(block.shape, factor):
+        shape += [size // f, f]
+    block = block.reshape(shape)
+    n = len(factor)
+    return block.transpose(list(range(0, 2 * n, 2)) + list(range(1, 2 * n, 2)))
+
+
+def _pad_to_multiple(block, factor, mode, **kwargs):
+    padding = [(0, -size % f) for size, f in zip(block.shape, factor)]
+    if not any(after for _, after in padding):
+        return block
+    return np.pad(block, padding, mode=mode, **kwargs)
+
+
+def downsample_mean(block, factor):
+    """Downsample ``block`` by ``factor`` by averaging. Partial blocks at the
+    upper boundary are averaged over the voxels they contain."""
+
+    n = len(factor)
+    factor_axes = tuple(range(n, 2 * n))
+
+    sums = _split_factors(
+        _pad_to_multiple(block.astype(np.float64), factor, "constant"), factor
+    ).sum(axis=factor_axes)
+    counts = _split_factors(
+        _pad_to_multiple(np.ones(block.shape, dtype=np.uint32), factor, "constant"),
+        factor,
+    ).sum(axis=factor_axes)
+    mean = sums / counts
+
+    if np.issubdtype(block.dtype, np.integer):
+        mean = np.round(mean)
+    return mean.astype(block.dtype)
+
+
+def downsample_mode(block, factor):
+    """Downsample ``block`` by ``factor`` by taking the most frequent value,
+    as appropriate for label volumes. Ties are resolved in favor of the first
+    value in the downsampling window."""
+
+    n = len(factor)
+    windows = _split_factors(_pad_to_multiple(block, factor, "edge"), factor)
+    windows = windows.reshape(windows.shape[:n] + (-1,))
+
+    # windows are small (usually 8 voxels), count pairwise matches
+    counts = (windows[..., :, None] == windows[..., None, :]).sum(axis=-1)
+    mode = np.argmax(counts, axis=-1)
+    return np.take_along_axis(windows, mode[..., None], axis=-1)[..., 0]
+
+
+class PyramidBuilder:
+    """Builds a multiscale pyramid for a single-scale ``LocalVolume`` in the
+    background, and stores it in zarr arrays ``s1``, ``s2``, ... in a scratch
+    directory.
+
+    The levels are the scales neuroglancer requests for ``volume``, such that
+    every chunk request can be answered by a stored level. Each level is
+    computed from the previous one in blocks aligned with the chunks of the
+    level, using the mode for segmentation volumes and the mean for image
+    volumes.
+
+    Args:
+
+            volume (``LocalVolume``):
+
+                The single-scale volume, used as the finest level.
+
+            directory (``str``):
+
+                The scratch directory to store the levels in.
+
+            executor (``concurrent.futures.Executor``, optional):
+
+                The executor to compute blocks on. If not given, an executor
+                with ``num_workers`` threads is created.
+
+            num_workers (``int``, optional):
+
+                The number of threads to compute blocks with, if no
+                ``executor`` is given.
+
+            block_size (``int``, optional):
+
+                The size of blocks (and zarr chunks) in each spatial
+                dimension.
+
+            on_level (``callable``, optional):
+
+                Called with a ``ScalePyramid`` over all levels built so far,
+                whenever a level is finished.
+    """
+
+    def __init__(
+        self,
+        volume,
+        directory,
+        executor=None,
+        num_workers=None,
+        block_size=64,
+        on_level=None,
+    ):
+        self.volume = volume
+        self.directory = directory
+        self.block_size = block_size
+        self.on_level = on_level
+
+        self.levels = []
+        self.pyramid = None
+        self.done = threading.Event()
+
+        self._executor = executor
+        self._num_workers = num_workers
+        self._stopped = threading.Event()
+        self._thread = None
+
+        dims = volume.dimensions
+        self._spatial_dims = [d for d, name in enumerate(dims.names) if "^" not in name]
+
+        info = volume.info()
+        self.scales = [
+            tuple(int(x) for x in scale)
+            for scale in compute_near_isotropic_downsampling_scales(
+                size=np.array(volume.shape),
+                voxel_size=np.array(dims.scales),
+                dimensions_to_downsample=self._spatial_dims,
+                max_scales=info["maxDownsamplingScales"] or np.inf,
+                max_downsampling=info["maxDownsampling"],
+                max_downsampled_size=info["maxDownsampledSize"] or 0,
+            )
+        ][1:]
+
+    def start(self):
+        """Start building the pyramid in a background thread."""
+
+        self._thread = threading.Thread(target=self.build, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop building after the blocks that are currently computed."""
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def build(self):
+        """Build all levels."""
+
+        own_executor = self._executor is None
+        executor = (
+            ThreadPoolExecutor(self._num_workers) if own_executor else self._executor
+        )
+
+        try:
+            finest = self._get_finest_level()
+            source = self.volume
+            previous_scale = (1,) * self.volume.rank
+            for scale in self.scales:
+                factor = tuple(s // p for s, p in zip(scale, previous_scale))
+                start_time = time.perf_counter()
+                level = self._build_level(executor, source, scale, factor)
+                if level is None:
+                    return
+                logger.info(
+                    "Built scale %s of %s in %.2fs",
+                    scale,
+                    self.directory,
+                    time.perf_counter() - start_time,
+                )
+
+                self.levels.append(level)
+                self.pyramid = ScalePyramid(
+                    [finest] + self.levels,
+                    chunk_cache=self.volume.chunk_cache,
+                    io_pool=self.volume.io_pool,
+                    serving_policy=self.volume.serving_policy,
+                    mesh_generator=self.volume.mesh_generator,
+                    metrics=self.volume.metrics,
+                )
+                if self.on_level is not None:
+                    self.on_level(self.pyramid)
+
+                source, previous_scale = level, scale
+        except CancelledError:
+            return
+        finally:
+            if own_executor:
+                executor.shutdown(cancel_futures=True)
+            self.done.set()
+
+    def _get_finest_level(self):
+        """Get a copy of ``volume`` without a chunk cache, IO pool, and
+        serving policy to use as the finest level of the pyramid, such that
+        chunk requests are cached and throttled once, by the pyramid. It keeps
+        the token of ``volume``, under which the layer is served."""
+
+        volume = self.volume
+        finest = LocalVolume(
+            # neuroglancer wraps the data in a DataWrapper
+            data=getattr(volume.data, "_data", volume.data),
+            dimensions=volume.dimensions,
+            voxel_offset=volume.voxel_offset,
+            volume_type=volume.volume_type,
+            encoding=volume.encoding,
+            max_voxels_per_chunk_log2=volume.max_voxels_per_chunk_log2,
+            chunk_layout=volume.chunk_layout,
+            mesh_options=volume._mesh_options,
+        )
+        finest.token = volume.token
+        return finest
+
+    def _build_level(self, executor, source, scale, factor):
+        shape = tuple(-(-size // f) for size, f in zip(source.data.shape, factor))
+        chunks = tuple(
+            self.block_size if d in self._spatial_dims else size
+            for d, size in enumerate(shape)
+        )
+        data = zarr.open_array(
+            os.path.join(self.directory, "s%d" % (len(self.levels) + 1)),
+            mode="w",
+            shape=shape,
+            chunks=chunks,
+            dtype=source.data.dtype,
+        )
+
+        if self.volume.volume_type == "segmentation":
+            downsample = downsample_mode
+        else:
+            downsample = downsample_mean
+
+        def build_block(block_slices):
+            source_slices = tuple(
+                slice(s.start * f, min(size, s.stop * f))
+                for s, f, size in zip(block_slices, factor, source.data.shape)
+            )
+            block = np.asarray(source.data[source_slices])
+            data[block_slices] = downsample(block, factor)
+
+        blocks = [
+            tuple(
+                slice(start, min(size, start + chunk))
+                for start, size, chunk in zip(block_start, shape, chunks)
+            )
+            for block_start in itertools.product(
+                *(range(0, size, chunk) for size, chunk in zip(shape, chunks))
+            )
+        ]
+        futures = [executor.submit(build_block, block) for block in blocks]
+        for future in as_completed(futures):
+            if self._stopped.is_set():
+                for future in futures:
+                    future.cancel()
+                return None
+            future.result()
+
+        dims = self.volume.dimensions
+        return LocalVolume(
+            data=data,
+            dimensions=neuroglancer.CoordinateSpace(
+                names=dims.names,
+                units=dims.units,
+                scales=np.array(dims.scales) * np.array(scale),
+            ),
+            voxel_offset=np.array(self.volume.voxel_offset) / np.array(scale),
+            volume_type=self.volume.volume_type,
+            encoding=self.volume.encoding,
+        )
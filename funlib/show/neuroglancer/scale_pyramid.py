@@ -1,3 +1,5 @@
+from .local_volume import LocalVolume
+from neuroglancer.downsample_scales import compute_near_isotropic_downsampling_scales
 import neuroglancer
 import operator
 import logging
@@ -8,7 +10,7 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
-class ScalePyramid(neuroglancer.LocalVolume):
+class ScalePyramid(LocalVolume):
     """A neuroglancer layer that provides volume data on different scales.
     Mimics a LocalVolume.
 
@@ -17,13 +19,59 @@ class ScalePyramid(neuroglancer.LocalVolume):
             volume_layers (``list`` of ``LocalVolume``):
 
                 One ``LocalVolume`` per provided resolution.
+
+            chunk_cache (``ChunkCache``, optional):
+
+                The cache to store encoded chunks of all scales in.
+
+            native_scales (``bool``, optional):
+
+                If set, only the provided resolutions are advertised to
+                neuroglancer, such that every chunk is read directly from one
+                of the ``volume_layers`` without downsampling on-the-fly.
+
+            io_pool (``ChunkRequestPool``, optional):
+
+                The pool to read and encode chunks of all scales in.
+
+            serving_policy (``LayerServingPolicy``, optional):
+
+                Which chunks to read from the ``volume_layers`` and how many
+                bytes per second, see :meth:`ServingPolicy.bind`.
+
+            mesh_generator (``MeshGenerator``, optional):
+
+                The generator to get meshes of objects from. If not given,
+                meshes are generated from the first scale by
+                ``neuroglancer.LocalVolume``.
+
+            metrics (``LayerMetrics``, optional):
+
+                The metrics to record chunk requests of all scales in, see
+                :meth:`ChunkMetrics.layer`.
     """
 
-    def __init__(self, volume_layers):
+    def __init__(
+        self,
+        volume_layers,
+        chunk_cache=None,
+        native_scales=False,
+        io_pool=None,
+        serving_policy=None,
+        mesh_generator=None,
+        metrics=None,
+    ):
         volume_layers = volume_layers
 
         super(neuroglancer.LocalVolume, self).__init__()
 
+        self.chunk_cache = chunk_cache
+        self.native_scales = native_scales
+        self.io_pool = io_pool
+        self.serving_policy = serving_policy
+        self.mesh_generator = mesh_generator
+        self.metrics = metrics
+
         logger.debug("Creating scale pyramid...")
 
         self.min_voxel_size = min(
@@ -44,10 +92,21 @@ class ScalePyramid(neuroglancer.LocalVolume):
             for layer in volume_layers
         }
 
+        # scale key -> (volume layer, scale key relative to that layer),
+        # pre-populated with the stored levels and extended on demand
+        default_scale_key = ",".join(("1",) * self.dims)
+        self._scale_lookup = {
+            ",".join(map(str, volume_scales)): (layer, default_scale_key)
+            for volume_scales, layer in self.volume_layers.items()
+        }
+
         logger.debug("min_voxel_size: %s", self.min_voxel_size)
         logger.debug("scale keys: %s", self.volume_layers.keys())
         logger.debug(self.info())
 
+        if self.native_scales:
+            self._check_native_scales()
+
     @property
     def volume_type(self):
         return self.volume_layers[(1,) * self.dims].volume_type
@@ -56,6 +115,18 @@ class ScalePyramid(neuroglancer.LocalVolume):
     def token(self):
         return self.volume_layers[(1,) * self.dims].token
 
+    @property
+    def rank(self):
+        return self.dims
+
+    @property
+    def dimensions(self):
+        return self.volume_layers[(1,) * self.dims].dimensions
+
+    @property
+    def voxel_offset(self):
+        return self.volume_layers[(1,) * self.dims].voxel_offset
+
     def info(self):
         reference_layer = self.volume_layers[(1,) * self.dims]
         # return reference_layer.info()
@@ -79,13 +150,100 @@ class ScalePyramid(neuroglancer.LocalVolume):
             "maxDownsamplingScales": reference_info["maxDownsamplingScales"],
         }
 
+        if "maxVoxelsPerChunkLog2" in reference_info:
+            info["maxVoxelsPerChunkLog2"] = reference_info["maxVoxelsPerChunkLog2"]
+
+        if self.native_scales:
+            # neuroglancer derives the scales to request from these limits,
+            # stop it from requesting scales beyond the stored ones
+            info["maxDownsampling"] = int(
+                max(np.prod(volume_scales) for volume_scales in self.volume_layers)
+            )
+            info["maxDownsamplingScales"] = len(self.volume_layers)
+
         return info
 
-    def get_encoded_subvolume(self, data_format, start, end, scale_key=None):
+    def _check_native_scales(self):
+        """Warn if the scales neuroglancer will request do not match the
+        provided resolutions, in which case chunks of the missing scales will
+        still be downsampled on-the-fly."""
+
+        reference_layer = self.volume_layers[(1,) * self.dims]
+        info = self.info()
+        requested_scales = compute_near_isotropic_downsampling_scales(
+            size=np.array(reference_layer.shape),
+            voxel_size=np.array(reference_layer.dimensions.scales),
+            dimensions_to_downsample=[
+                d
+                for d, name in enumerate(reference_layer.dimensions.names)
+                if "^" not in name
+            ],
+            max_scales=info["maxDownsamplingScales"],
+            max_downsampling=info["maxDownsampling"],
+            max_downsampled_size=info["maxDownsampledSize"] or 0,
+        )
+        missing_scales = [
+            tuple(int(x) for x in scale)
+            for scale in requested_scales
+            if tuple(int(x) for x in scale) not in self.volume_layers
+        ]
+        if missing_scales:
+            logger.warning(
+                "Neuroglancer will request scales %s, which are not stored in "
+                "this pyramid (stored scales: %s)",
+                missing_scales,
+                list(self.volume_layers.keys()),
+            )
+
+    def _get_encoded_subvolume(self, data_format, start, end, scale_key):
+        if scale_key is None:
+            scale_key = ",".join(("1",) * self.dims)
+
+        volume_layer, relative_scale_key = self._resolve_scale(scale_key)
+
+        return volume_layer.get_encoded_subvolume(
+            data_format, start, end, scale_key=relative_scale_key
+        )
+
+    def _get_read_bytes(self, start, end, scale_key):
         if scale_key is None:
             scale_key = ",".join(("1",) * self.dims)
 
+        volume_layer, relative_scale_key = self._resolve_scale(scale_key)
+
+        return volume_layer._get_read_bytes(start, end, relative_scale_key)
+
+    def _resolve_scale(self, scale_key):
+        """Get the volume layer and relative scale key to serve ``scale_key``
+        from. Results are memoized, such that each distinct scale key is only
+        resolved once."""
+
+        try:
+            return self._scale_lookup[scale_key]
+        except KeyError:
+            pass
+
         scale = tuple(int(s) for s in scale_key.split(","))
+        closest_scale = self._find_closest_scale(scale)
+        relative_scale = np.array(scale) // np.array(closest_scale)
+
+        if self.native_scales:
+            logger.warning(
+                "Scale %s is not stored in this pyramid, downsampling from "
+                "scale %s on-the-fly",
+                scale,
+                closest_scale,
+            )
+
+        resolved = (
+            self.volume_layers[closest_scale],
+            ",".join(map(str, relative_scale)),
+        )
+        self._scale_lookup[scale_key] = resolved
+
+        return resolved
+
+    def _find_closest_scale(self, scale):
         closest_scale = None
         min_diff = np.inf
         for volume_scales in self.volume_layers.keys():
@@ -98,14 +256,20 @@ class ScalePyramid(neuroglancer.LocalVolume):
                 closest_scale = volume_scales
 
         assert closest_scale is not None
-        relative_scale = np.array(scale) // np.array(closest_scale)
 
-        return self.volume_layers[closest_scale].get_encoded_subvolume(
-            data_format, start, end, scale_key=",".join(map(str, relative_scale))
-        )
+        return closest_scale
 
     def get_object_mesh(self, object_id):
+        if self.mesh_generator is not None:
+            return self.mesh_generator.get_mesh(object_id)
         return self.volume_layers[(1,) * self.dims].get_object_mesh(object_id)
 
     def invalidate(self):
+        if self.chunk_cache is not None:
+            self.chunk_cache.invalidate(self.token)
+        if self.mesh_generator is not None:
+            self.mesh_generator.invalidate()
+        # decoded storage chunks of all scales
+        for volume_layer in self.volume_layers.values():
+            volume_layer._invalidate_storage_cache()
         return self.volume_layers[(1,) * self.dims].invalidate()
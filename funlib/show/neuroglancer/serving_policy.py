@@ -0,0 +1,190 @@
+from .local_volume import encode_subvolume
+from funlib.geometry import Coordinate
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ServingPolicy:
+    """Limits which chunks of a layer are read from storage, and how fast.
+
+    Chunks that intersect ``roi`` are served at all scales. Outside of it,
+    only chunks with a voxel size of at least ``min_voxel_size`` (in all
+    spatial dimensions) are served. All other chunks are served as filler
+    chunks (zeros), without reading from storage.
+
+    The same policy can be used for several layers, see :meth:`bind`.
+
+    Args:
+
+            roi (``Roi``, optional):
+
+                The region of interest in world units, served at all scales.
+                If not given, ``min_voxel_size`` applies everywhere.
+
+            min_voxel_size (``Coordinate``, optional):
+
+                The finest voxel size in world units to serve outside of
+                ``roi``. For multiscale layers, it is capped at the voxel size
+                of the coarsest stored scale, such that this scale is always
+                served. If not given, nothing is served outside of ``roi``.
+
+            max_bytes_per_second (``int``, optional):
+
+                The byte budget of each layer: once a layer read more than
+                this many bytes per second (on average, with bursts of up to
+                one second), its requests wait until the budget allows them.
+    """
+
+    def __init__(self, roi=None, min_voxel_size=None, max_bytes_per_second=None):
+        self.roi = roi
+        self.min_voxel_size = (
+            Coordinate(min_voxel_size) if min_voxel_size is not None else None
+        )
+        self.max_bytes_per_second = max_bytes_per_second
+
+    def bind(self, array):
+        """Get the policy for a layer showing ``array`` (or a list of arrays,
+        one per scale), to be passed to its ``LocalVolume`` or
+        ``ScalePyramid``. Each bound policy has its own byte budget."""
+
+        arrays = array if isinstance(array, list) else [array]
+        array = arrays[0]
+        spatial_axes = [i for i, name in enumerate(array.axis_names) if "^" not in name]
+        rank = len(array.axis_names)
+
+        # the policy in voxels of the first scale, relative to the start of
+        # its data (as requested by neuroglancer), with no limits for channel
+        # dimensions
+        roi_begin = np.full(rank, -np.inf)
+        roi_end = np.full(rank, np.inf)
+        if self.roi is not None:
+            if self.roi.dims != len(spatial_axes):
+                raise ValueError(
+                    "The ROI %s has %d dimensions, but the array has %d spatial "
+                    "dimensions" % (self.roi, self.roi.dims, len(spatial_axes))
+                )
+            roi_begin[spatial_axes] = (
+                np.array(self.roi.begin - array.offset) / array.voxel_size
+            )
+            roi_end[spatial_axes] = (
+                np.array(self.roi.end - array.offset) / array.voxel_size
+            )
+
+        min_factors = np.ones(rank)
+        if self.min_voxel_size is None:
+            if self.roi is not None:
+                min_factors[spatial_axes] = np.inf
+        else:
+            min_voxel_size = np.array(self.min_voxel_size, dtype=np.float64)
+            if len(arrays) > 1:
+                min_voxel_size = np.minimum(
+                    min_voxel_size,
+                    np.max([np.array(a.voxel_size) for a in arrays], axis=0),
+                )
+            min_factors[spatial_axes] = min_voxel_size / np.array(array.voxel_size)
+
+        dtype = np.dtype(array.dtype)
+        if dtype == np.float64:
+            # float64 data is served as float32, as by LocalVolume
+            dtype = np.dtype(np.float32)
+
+        return LayerServingPolicy(
+            roi_begin, roi_end, min_factors, dtype, self.max_bytes_per_second
+        )
+
+    def __repr__(self):
+        return "ServingPolicy(roi=%s, min_voxel_size=%s, max_bytes_per_second=%s)" % (
+            self.roi,
+            self.min_voxel_size,
+            self.max_bytes_per_second,
+        )
+
+
+class LayerServingPolicy:
+    """The :class:`ServingPolicy` of a single layer, in voxels of its first
+    scale. Obtained with :meth:`ServingPolicy.bind`."""
+
+    def __init__(self, roi_begin, roi_end, min_factors, dtype, max_bytes_per_second):
+        self.roi_begin = roi_begin
+        self.roi_end = roi_end
+        self.min_factors = min_factors
+        self.dtype = dtype
+        self.max_bytes_per_second = max_bytes_per_second
+
+        self.num_filled = 0
+        self.num_bytes = 0
+        self.throttled_time = 0.0
+
+        self._fillers = {}
+        self._available = max_bytes_per_second
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allows(self, start, end, scale_key):
+        """Whether the chunk from ``start`` to ``end`` at ``scale_key`` may be
+        read from storage."""
+
+        if scale_key is None:
+            factors = np.ones(len(start))
+        else:
+            factors = np.array([int(f) for f in scale_key.split(",")])
+
+        if np.all(factors >= self.min_factors):
+            return True
+
+        return bool(
+            np.all(np.array(start) * factors < self.roi_end)
+            and np.all(np.array(end) * factors > self.roi_begin)
+        )
+
+    def get_filler_chunk(self, data_format, start, end):
+        """Get an encoded chunk of zeros from ``start`` to ``end``. Fillers are
+        encoded once per format and shape."""
+
+        shape = tuple(int(e - s) for s, e in zip(start, end))
+        key = (data_format, shape)
+        with self._lock:
+            self.num_filled += 1
+            chunk = self._fillers.get(key)
+        if chunk is None:
+            chunk = encode_subvolume(data_format, np.zeros(shape, dtype=self.dtype))
+            with self._lock:
+                self._fillers[key] = chunk
+        return chunk
+
+    def throttle(self, num_bytes):
+        """Account for reading ``num_bytes`` from storage, and wait until the
+        byte budget allows it."""
+
+        with self._lock:
+            self.num_bytes += num_bytes
+            if self.max_bytes_per_second is None:
+                return
+            # refill the budget for the time since the last request, up to
+            # one second worth of bytes, and reserve the bytes of this request
+            now = time.monotonic()
+            self._available = min(
+                self.max_bytes_per_second,
+                self._available + (now - self._last_time) * self.max_bytes_per_second,
+            )
+            self._last_time = now
+            self._available -= num_bytes
+            wait = max(0.0, -self._available / self.max_bytes_per_second)
+            self.throttled_time += wait
+
+        if wait > 0:
+            logger.debug("Throttling request of %d bytes for %.2fs", num_bytes, wait)
+            time.sleep(wait)
+
+    def __repr__(self):
+        return "%s(%d filler chunks, %d bytes read, throttled for %.1fs)" % (
+            type(self).__name__,
+            self.num_filled,
+            self.num_bytes,
+            self.throttled_time,
+        )
@@ -33,6 +33,14 @@ over the specified duration: positions are interpolated linearly, orientations
 are interpolated using spherical linear interpolation, and zoom factors are
 interpolated exponentially.
 
+Alternatively, scripts can be stored as "delta scripts" (see `delta_script`),
+which store a base state once and each keypoint as a JSON delta to it. Edits
+are appended to delta scripts instead of rewriting them, and keypoint states
+are only parsed when needed, which makes large scripts much faster to load
+and edit. `load_script` detects the format of a script, `convert_script`
+converts between both formats, and the editor keeps the format of an existing
+script (or uses `script_format` for new ones).
+
 Note that combining zooming with position movement in a single transition (as
 can occur when using the mouse wheel rather than the keyboard commands to zoom
 out) may produce a poor interpolation result, because the position will appear
@@ -44,6 +52,39 @@ The `render` command is used to render an existing script to a sequence of PNG
 images.  Frames are captured only once all data has been loaded; because of
 this, rendering can be slow.
 
+With `headless` set, frames are instead rendered on the CPU directly from the
+volume layers of the viewer (see `HeadlessRenderer`), without a browser or
+GPU. Only cross-section views can be rendered this way. Frames are distributed
+over `shards` worker processes.
+
+By default (`state_updates` set to "camera"), the layers of the viewer are set
+once per transition and only the camera (position, orientation, and zoom) of
+the state sent to the viewer changes between frames, without converting the
+layers to and from JSON for every frame. Set `state_updates` to "full" to
+interpolate and send the full viewer state for each frame instead.
+
+With `shard_mode` set to "processes", each shard renders in its own process
+with its own viewer (instead of a thread in this process). Each shard starts
+with a contiguous range of frames; shards that run out of frames steal the
+second half of the largest remaining range of another shard. On platforms that
+do not fork new processes, the function creating the viewer has to be
+picklable for this (and for headless rendering).
+
+By default, frames are written as PNG files into `output_directory`. Setting
+`sink` to another `FrameSink` (e.g., a `VideoSink` to stream frames into an
+ffmpeg process, or an `ArchiveSink` to write them into a single zip file)
+writes frames there instead. Frames rendered out of order are buffered (at
+most `max_buffered_frames`) and passed on in order.
+
+Written frames are recorded with their size and checksum in a journal (see
+`JournaledSink`), by default `render_journal.jsonl` in `output_directory` for
+PNG output, or `journal` if set. With `resume` set, the frames recorded in the
+journal are skipped, without checking for each frame whether it exists. Only
+sinks that keep the frames of previous runs can be resumed (PNG output and
+`ArchiveSink`, not `VideoSink`).
+Progress is reported as the exact number of frames done out of all frames,
+with the frame rate of this run and the estimated time remaining.
+
 The layer panel and other UI widgets, as well as the borders around panels, are
 disabled when rendering.  Additionally, the image size is determined by the
 command line `--width` and `--height` arguments, rather than the size of the
@@ -63,13 +104,25 @@ be rendered in several ways:
 from __future__ import print_function, division
 
 import bisect
+import collections
+import copy
+import io
+import itertools
 import math
+import multiprocessing
 import os
+import queue
 import threading
 import time
 import webbrowser
 
 import neuroglancer
+import numpy as np
+from PIL import Image
+
+from .delta_script import DeltaScript, is_delta_script, load_delta_script
+from .frame_sink import JournaledSink, OrderedFrameWriter, PngDirectorySink
+from .headless import HeadlessRenderer
 
 
 class RenderArgs:
@@ -91,12 +144,156 @@ class RenderArgs:
         self.shards = 1
         self.output_directory = "."
         self.resume = False
+        self.headless = False
+        self.shard_mode = "threads"
+        self.sink = None
+        self.max_buffered_frames = 100
+        self.journal = None
+        self.state_updates = "camera"
+        self.script_format = "urls"
+
+
+def slerp_quaternions(a, b, t):
+    """Spherical linear interpolation of unit quaternions ``a`` and ``b`` for
+    an array of weights ``t``, vectorized version of
+    ``neuroglancer.viewer_state.quaternion_slerp``."""
+
+    a = np.array([0, 0, 0, 1] if a is None else a, dtype=np.float64)
+    b = np.array([0, 0, 0, 1] if b is None else b, dtype=np.float64)
+    cosom = np.dot(a, b)
+    if cosom < 0.0:
+        cosom = -cosom
+        b = -b
+    if (1.0 - cosom) > 0.000001:
+        omega = math.acos(cosom)
+        sinom = math.sin(omega)
+        scale0 = np.sin((1.0 - t) * omega) / sinom
+        scale1 = np.sin(t * omega) / sinom
+    else:
+        scale0 = 1.0 - t
+        scale1 = t
+    return scale0[:, None] * a + scale1[:, None] * b
+
+
+def interpolate_camera(a, b, t):
+    """Interpolate the camera of viewer states ``a`` and ``b`` for an array of
+    weights ``t`` at once, the same way ``neuroglancer.ViewerState.interpolate``
+    does for a single weight.
+
+    Returns a dictionary from ``ViewerState`` attribute names to arrays with
+    one entry per weight (or ``None`` if the attribute is not set)."""
+
+    camera = {}
+
+    if (
+        a.position is not None
+        and b.position is not None
+        and len(a.position) == len(b.position)
+    ):
+        camera["position"] = np.outer(1 - t, a.position) + np.outer(t, b.position)
+    elif a.position is not None:
+        camera["position"] = np.tile(a.position, (len(t), 1))
+    else:
+        camera["position"] = None
+
+    for name in ["cross_section_scale", "projection_scale"]:
+        zoom_a, zoom_b = getattr(a, name), getattr(b, name)
+        if zoom_a is None or zoom_b is None:
+            camera[name] = None if zoom_a is None else np.full(len(t), zoom_a)
+        else:
+            camera[name] = zoom_a * np.exp(math.log(zoom_b / zoom_a) * t)
+
+    for name in ["cross_section_orientation", "projection_orientation"]:
+        camera[name] = slerp_quaternions(getattr(a, name), getattr(b, name), t)
+
+    return camera
+
+
+# JSON keys of the attributes returned by interpolate_camera
+camera_json_keys = {
+    "position": "position",
+    "cross_section_scale": "crossSectionScale",
+    "projection_scale": "projectionScale",
+    "cross_section_orientation": "crossSectionOrientation",
+    "projection_orientation": "projectionOrientation",
+}
+
+
+class RenderStates:
+    """Creates the raw JSON viewer states to render, for a viewer whose layers
+    are kept (as ``run_render`` does).
+
+    The JSON of the first keypoint of each transition, with the given
+    ``layers``, is created only once. The state of a frame is a shallow copy
+    of it with the interpolated camera, such that the layers are neither
+    interpolated nor converted to and from JSON per frame. Transitions that
+    change the layout are interpolated in full.
+    """
+
+    def __init__(self, keypoint_states, layers):
+        self.keypoint_states = keypoint_states
+        self.layers = layers
+        self._transitions = {}
+
+    def _get_transition(self, i):
+        transition = self._transitions.get(i)
+        if transition is None:
+            # the layers are replaced, do not interpolate them
+            a = neuroglancer.ViewerState(
+                dict(self.keypoint_states[i].to_json(), layers=[])
+            )
+            b = neuroglancer.ViewerState(
+                dict(self.keypoint_states[i + 1].to_json(), layers=[])
+            )
+            # all but the camera and the layout are taken from a
+            a_json = neuroglancer.ViewerState.interpolate(a, b, 0).to_json()
+            a_json["layers"] = self.layers
+            camera_only = a.to_json().get("layout") == b.to_json().get("layout")
+            transition = self._transitions[i] = (a, b, a_json, camera_only)
+        return transition
+
+    def get_state(self, i, t):
+        """Get the state at ``t`` in the transition from keypoint ``i`` to
+        ``i + 1``."""
+
+        a, b, a_json, camera_only = self._get_transition(i)
+        if not camera_only:
+            state = neuroglancer.ViewerState.interpolate(a, b, t).to_json()
+            state["layers"] = self.layers
+            return state
+
+        state = dict(a_json)
+        for name, values in interpolate_camera(a, b, np.array([t])).items():
+            if values is not None:
+                state[camera_json_keys[name]] = values[0].tolist()
+        return state
+
+
+def set_render_state(viewer, state, prefetch_states):
+    """Set the raw JSON ``state`` of ``viewer`` and the states to prefetch,
+    without converting them to ``ViewerState`` objects."""
+
+    viewer.set_state(state)
+    config = dict(viewer.config_state.raw_state)
+    config["prefetch"] = [
+        {"state": prefetch_state, "priority": len(prefetch_states) - i}
+        for i, prefetch_state in enumerate(prefetch_states)
+    ]
+    viewer.config_state.set_state(config)
 
 
 class PlaybackManager(object):
-    def __init__(self, keypoints, frames_per_second):
+    """Provides the interpolated viewer states of all frames of a script.
+
+    The camera of all frames is interpolated once, when the playback manager
+    is created. Viewer states are created from that on demand, the last
+    ``max_cached_states`` of them are kept.
+    """
+
+    def __init__(self, keypoints, frames_per_second, max_cached_states=32):
         self.keypoints = keypoints
         self.frames_per_second = frames_per_second
+        self.max_cached_states = max_cached_states
 
         self.total_frames = 0
         self.keypoint_start_frame = []
@@ -116,6 +313,32 @@ class PlaybackManager(object):
         self.total_frames += 1
         self.keypoint_end_frame.append(self.total_frames)
 
+        self._interpolate_cameras()
+
+    def _interpolate_cameras(self):
+        self._cameras = []
+        self._camera_only = []
+        keypoints_json = [k["state"].to_json() for k in self.keypoints]
+        for i in range(len(self.keypoints) - 1):
+            num_frames = self.keypoint_end_frame[i] - self.keypoint_start_frame[i]
+            self._cameras.append(
+                interpolate_camera(
+                    self.keypoints[i]["state"],
+                    self.keypoints[i + 1]["state"],
+                    np.arange(num_frames) / max(1, num_frames),
+                )
+            )
+            # if only the camera changes during a transition, states can be
+            # created without interpolating the layers
+            self._camera_only.append(
+                all(
+                    keypoints_json[i].get(key) == keypoints_json[i + 1].get(key)
+                    for key in ["layers", "layout"]
+                )
+            )
+        self._states = collections.OrderedDict()
+        self._states_lock = threading.Lock()
+
     def get_keypoint_from_frame(self, frame_i):
         if frame_i < 0 or frame_i >= self.total_frames:
             raise ValueError
@@ -129,13 +352,32 @@ class PlaybackManager(object):
         a = self.keypoints[start_keypoint]["state"]
         if start_keypoint == len(self.keypoints) - 1:
             return a
+
+        with self._states_lock:
+            state = self._states.get(frame_i)
+            if state is not None:
+                self._states.move_to_end(frame_i)
+                return state
+
+        start_frame = self.keypoint_start_frame[start_keypoint]
+        if self._camera_only[start_keypoint]:
+            state = copy.deepcopy(a)
         else:
             end_keypoint = start_keypoint + 1
             b = self.keypoints[end_keypoint]["state"]
-            start_frame = self.keypoint_start_frame[start_keypoint]
             end_frame = self.keypoint_end_frame[start_keypoint]
             t = (frame_i - start_frame) / (end_frame - start_frame)
-            return neuroglancer.ViewerState.interpolate(a, b, t)
+            state = neuroglancer.ViewerState.interpolate(a, b, t)
+        for name, values in self._cameras[start_keypoint].items():
+            if values is not None:
+                setattr(state, name, values[frame_i - start_frame])
+
+        with self._states_lock:
+            self._states[frame_i] = state
+            while len(self._states) > self.max_cached_states:
+                self._states.popitem(last=False)
+
+        return state
 
     def get_frames(self, start_frame, end_frame):
         return [
@@ -263,7 +505,19 @@ class EditorPlaybackManager(object):
         self._display_frame()
 
 
+def get_script_format(script_path):
+    """Get the format of the script at ``script_path``, ``"delta"`` or
+    ``"urls"``."""
+
+    if is_delta_script(script_path):
+        return "delta"
+    return "urls"
+
+
 def load_script(script_path, transition_duration=1):
+    if get_script_format(script_path) == "delta":
+        return load_delta_script(script_path, transition_duration)
+
     keypoints = []
     with open(script_path, "r") as f:
         while True:
@@ -281,7 +535,11 @@ def load_script(script_path, transition_duration=1):
     return keypoints
 
 
-def save_script(script_path, keypoints):
+def save_script(script_path, keypoints, script_format="urls"):
+    if script_format == "delta":
+        DeltaScript(script_path).save(keypoints)
+        return
+
     temp_path = script_path + ".tmp"
     with open(temp_path, "w") as f:
         for x in keypoints:
@@ -290,7 +548,18 @@ def save_script(script_path, keypoints):
     os.rename(temp_path, script_path)
 
 
+def convert_script(source_path, target_path, script_format):
+    """Convert the script at ``source_path`` (in either format) to a script
+    in ``script_format`` (``"delta"`` or ``"urls"``) at ``target_path``."""
+
+    save_script(target_path, load_script(source_path), script_format)
+
+
 class ScriptEditor(object):
+    # seconds to wait after a change of the viewer state before checking
+    # whether it differs from the current keypoint
+    dirty_check_interval = 0.1
+
     def __init__(
         self,
         create_viewer_func,
@@ -300,6 +569,7 @@ class ScriptEditor(object):
         fullscreen_height,
         fullscreen_scale_bar_scale,
         frames_per_second,
+        script_format="urls",
     ):
         self.viewer = create_viewer_func()
         self.script_path = script_path
@@ -310,14 +580,25 @@ class ScriptEditor(object):
         self.fullscreen_scale_bar_scale = fullscreen_scale_bar_scale
         self.keypoint_index = 0
         if os.path.exists(script_path):
-            self.keypoints = load_script(script_path, self.default_transition_duration)
+            script_format = get_script_format(script_path)
+        if script_format == "delta":
+            # edits are appended to the script
+            self.delta_script = DeltaScript(script_path)
         else:
-            self.keypoints = []
+            self.delta_script = None
+        self.keypoints = self._load()
 
         self.transition_duration = transition_duration
-        self.viewer.shared_state.add_changed_callback(self._viewer_state_changed)
         self.quit_event = threading.Event()
         self.is_dirty = True
+        # the JSON of the current keypoint's state, split by top-level key
+        self._reference_state = None
+        self._reference_json = None
+        # the top-level key that differed from the keypoint in the last check
+        self._changed_key = None
+        self._dirty_check_lock = threading.Lock()
+        self._dirty_check_pending = False
+        self.viewer.shared_state.add_changed_callback(self._viewer_state_changed)
         self.is_fullscreen = False
         keybindings = [
             ("keyk", "add-keypoint"),
@@ -358,11 +639,16 @@ class ScriptEditor(object):
         self.playback_manager = None
         self._set_keypoint_index(1)
 
+    def _load(self):
+        if not os.path.exists(self.script_path):
+            return []
+        if self.delta_script is not None:
+            return self.delta_script.load(self.default_transition_duration)
+        return load_script(self.script_path, self.default_transition_duration)
+
     def _revert_script(self, s):
         if os.path.exists(self.script_path):
-            self.keypoints = load_script(
-                self.script_path, self.default_transition_duration
-            )
+            self.keypoints = self._load()
             if self.playback_manager is not None:
                 self.playback_manager.reload()
             else:
@@ -403,7 +689,10 @@ class ScriptEditor(object):
         )
         self.keypoint_index += 1
         self.is_dirty = False
-        self.save()
+        if self.delta_script is not None:
+            self.delta_script.insert(self.keypoints, self.keypoint_index - 1)
+        else:
+            self.save()
         self._update_status()
 
     def _toggle_play(self, s):
@@ -420,11 +709,17 @@ class ScriptEditor(object):
         self.transition_duration = value
         if self.keypoint_index > 0:
             self.keypoints[self.keypoint_index - 1]["transition_duration"] = value
-        self.save()
+            if self.delta_script is not None:
+                self.delta_script.set_duration(self.keypoints, self.keypoint_index - 1)
+        if self.delta_script is None:
+            self.save()
         self._update_status()
 
     def save(self):
-        save_script(self.script_path, self.keypoints)
+        if self.delta_script is not None:
+            self.delta_script.save(self.keypoints)
+        else:
+            save_script(self.script_path, self.keypoints)
 
     def _increase_duration(self, s):
         self._set_transition_duration(self.transition_duration + 0.1)
@@ -432,13 +727,54 @@ class ScriptEditor(object):
     def _decrease_duration(self, s):
         self._set_transition_duration(self.transition_duration - 0.1)
 
+    def _get_reference_json(self):
+        """Get the JSON of the current keypoint's state, serialized only once
+        per keypoint."""
+
+        state = self.keypoints[self.keypoint_index - 1]["state"]
+        if state is not self._reference_state:
+            self._reference_json = state.to_json()
+            self._reference_state = state
+            self._changed_key = None
+        return self._reference_json
+
     def _get_is_dirty(self):
         if self.keypoint_index == 0:
             return True
-        state = self.keypoints[self.keypoint_index - 1]["state"]
-        return state.to_json() != self.viewer.state.to_json()
+        reference = self._get_reference_json()
+        current = self.viewer.shared_state.raw_state
+        if current.keys() != reference.keys():
+            return True
+
+        # the key that differed last time most likely still differs (e.g., the
+        # position while navigating), check it first and stop at the first
+        # difference
+        keys = list(current.keys())
+        if self._changed_key in current:
+            keys.remove(self._changed_key)
+            keys.insert(0, self._changed_key)
+        for key in keys:
+            if current[key] != reference[key]:
+                self._changed_key = key
+                return True
+        return False
 
     def _viewer_state_changed(self):
+        if self.playback_manager is not None:
+            return
+        # called for every change (e.g., every mouse move), check at most once
+        # per dirty_check_interval
+        with self._dirty_check_lock:
+            if self._dirty_check_pending:
+                return
+            self._dirty_check_pending = True
+        timer = threading.Timer(self.dirty_check_interval, self._check_dirty)
+        timer.daemon = True
+        timer.start()
+
+    def _check_dirty(self):
+        with self._dirty_check_lock:
+            self._dirty_check_pending = False
         if self.playback_manager is not None:
             return
         is_dirty = self._get_is_dirty()
@@ -450,7 +786,10 @@ class ScriptEditor(object):
         self._stop_playback()
         if self.keypoint_index > 0:
             del self.keypoints[self.keypoint_index - 1]
-            self.save()
+            if self.delta_script is not None:
+                self.delta_script.delete(self.keypoints, self.keypoint_index - 1)
+            else:
+                self.save()
             self.keypoint_index = self.keypoint_index - 1
             self.is_dirty = self._get_is_dirty()
             self._update_status()
@@ -519,6 +858,7 @@ def run_edit(create_viewer_func, args=RenderArgs()):
         fullscreen_height=args.height,
         fullscreen_scale_bar_scale=args.scale_bar_scale,
         frames_per_second=args.fps,
+        script_format=args.script_format,
     )
     print(editor.viewer)
     if args.browser:
@@ -526,6 +866,454 @@ def run_edit(create_viewer_func, args=RenderArgs()):
     editor.quit_event.wait()
 
 
+def get_render_frames(keypoints, fps):
+    """Get ``(frame_number, keypoint_index, t)`` for all frames to render,
+    where ``t`` is the interpolation weight between keypoint
+    ``keypoint_index`` and the next one."""
+
+    frames = []
+    frame_number = 0
+    for i in range(len(keypoints) - 1):
+        duration = keypoints[i]["transition_duration"]
+        num_frames = max(1, int(duration * fps))
+        for frame_i in range(num_frames):
+            frames.append((frame_number, i, frame_i / num_frames))
+            frame_number += 1
+    return frames
+
+
+def get_frame_sink(args):
+    journal = args.journal
+    if args.sink is not None:
+        sink = args.sink
+    else:
+        sink = PngDirectorySink(args.output_directory)
+        if journal is None:
+            journal = os.path.join(args.output_directory, "render_journal.jsonl")
+    if args.resume and not sink.resumable:
+        raise ValueError(
+            "Can not resume rendering into %s, it does not keep the frames of "
+            "previous runs" % type(sink).__name__
+        )
+    if journal is None:
+        return sink
+    return JournaledSink(sink, journal, resume=args.resume)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class RenderProgress:
+    """Reports the progress of rendering ``total_frames`` frames, of which
+    ``num_skipped`` were already rendered by a previous run. The frame rate
+    and the estimated time remaining are based on the frames rendered in this
+    run."""
+
+    def __init__(self, total_frames, num_skipped=0):
+        self.total_frames = total_frames
+        self.num_skipped = num_skipped
+        self.num_rendered = 0
+        self.start_time = time.time()
+
+    @property
+    def num_done(self):
+        return self.num_skipped + self.num_rendered
+
+    def get_fps(self):
+        elapsed = time.time() - self.start_time
+        return self.num_rendered / elapsed if elapsed > 0 else 0
+
+    def update(self, t, num_keypoints, name):
+        """Count a rendered frame and print the progress."""
+
+        self.num_rendered += 1
+        fps = self.get_fps()
+        remaining = self.total_frames - self.num_done
+        print(
+            "[%07d/%07d] keypoint %.3f/%5d: %s (%.2f frames/s, ETA %s)"
+            % (
+                self.num_done,
+                self.total_frames,
+                t,
+                num_keypoints,
+                name,
+                fps,
+                format_duration(remaining / fps) if fps > 0 else "-",
+            )
+        )
+
+    def print_summary(self):
+        elapsed = time.time() - self.start_time
+        print(
+            "Rendered %d frames in %s (%.2f frames/s), skipped %d frames "
+            "rendered before"
+            % (
+                self.num_rendered,
+                format_duration(elapsed),
+                self.get_fps(),
+                self.num_skipped,
+            )
+        )
+
+
+def encode_png(image):
+    data = io.BytesIO()
+    Image.fromarray(image).save(data, format="PNG")
+    return data.getvalue()
+
+
+_headless_worker = None
+
+
+def _init_headless_worker(create_viewer_func, keypoints, args):
+    global _headless_worker
+    renderer = HeadlessRenderer(create_viewer_func(), args.width, args.height)
+    keypoint_states = [neuroglancer.ViewerState(k) for k in keypoints]
+    _headless_worker = (renderer, keypoint_states)
+
+
+def _render_headless_frame(frame):
+    renderer, keypoint_states = _headless_worker
+    frame_number, i, t = frame
+    state = neuroglancer.ViewerState.interpolate(
+        keypoint_states[i], keypoint_states[i + 1], t
+    )
+    return frame_number, i + t, encode_png(renderer.render(state))
+
+
+def run_render_headless(create_viewer_func, keypoints, args):
+    sink = get_frame_sink(args)
+    all_frames = get_render_frames(keypoints, args.fps)
+    frames = [
+        frame for frame in all_frames if not (args.resume and sink.has_frame(frame[0]))
+    ]
+    progress = RenderProgress(len(all_frames), len(all_frames) - len(frames))
+    writer = OrderedFrameWriter(
+        sink, [frame[0] for frame in frames], args.max_buffered_frames
+    )
+    # viewer states are passed to workers as JSON
+    initargs = (
+        create_viewer_func,
+        [k["state"].to_json() for k in keypoints],
+        args,
+    )
+
+    if args.shards > 1:
+        pool = multiprocessing.Pool(
+            args.shards, initializer=_init_headless_worker, initargs=initargs
+        )
+
+        def render_frames():
+            # results are collected in order, with at most max_buffered_frames
+            # frames rendered ahead
+            pending = collections.deque()
+            for frame in frames:
+                pending.append(pool.apply_async(_render_headless_frame, (frame,)))
+                if len(pending) >= args.max_buffered_frames:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+        rendered_frames = render_frames()
+    else:
+        pool = None
+        _init_headless_worker(*initargs)
+        rendered_frames = map(_render_headless_frame, frames)
+
+    for frame_number, t, data in rendered_frames:
+        writer.write(frame_number, data)
+        progress.update(t, len(keypoints), sink.get_name(frame_number))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
+    progress.print_summary()
+
+
+def create_render_viewer(create_viewer_func, args):
+    viewer = create_viewer_func()
+    with viewer.config_state.txn() as s:
+        s.show_ui_controls = False
+        s.show_panel_borders = False
+        s.viewer_size = [args.width, args.height]
+        s.scale_bar_options.scale_factor = args.scale_bar_scale
+
+    print("Open the specified URL to begin rendering")
+    print(viewer)
+    if args.browser:
+        webbrowser.open_new(viewer.get_viewer_url())
+    return viewer
+
+
+class PrefetchWindow:
+    """Decides how many of the upcoming frames to prefetch while rendering.
+
+    The depth of the window is the number of captures it takes to load the
+    data of a frame, estimated from the latency of captures that had to wait
+    for chunks to load and of captures that did not. It starts at (and never
+    exceeds) ``max_depth``.
+    """
+
+    def __init__(self, max_depth, smoothing=0.2):
+        self.max_depth = max_depth
+        self.depth = max_depth
+        self.smoothing = smoothing
+        self.num_captures = 0
+        self.num_resident = 0
+        self.total_depth = 0
+        self._resident_latency = None
+        self._stalled_latency = None
+
+    def update(self, latency, resident):
+        """Report the ``latency`` of a capture, and whether all its chunks
+        were ``resident`` already."""
+
+        self.num_captures += 1
+        self.total_depth += self.depth
+
+        if resident:
+            self.num_resident += 1
+            self._resident_latency = self._smooth(self._resident_latency, latency)
+            # without stalls, slowly forget how long loading takes
+            if self._stalled_latency is not None:
+                self._stalled_latency = self._smooth(self._stalled_latency, latency)
+        else:
+            self._stalled_latency = self._smooth(self._stalled_latency, latency)
+
+        if self._resident_latency and self._stalled_latency is not None:
+            depth = math.ceil(self._stalled_latency / self._resident_latency)
+            self.depth = min(self.max_depth, max(min(1, self.max_depth), depth))
+
+    def _smooth(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+
+def capture_frame(viewer):
+    """Take a screenshot with ``viewer``. Returns the PNG encoded image and
+    whether all visible chunks were in GPU memory when the screenshot was
+    requested."""
+
+    resident = [True]
+
+    def statistics_callback(statistics):
+        total = statistics.total
+        if total is not None and (total.visible_chunks_gpu_memory or 0) < (
+            total.visible_chunks_total or 0
+        ):
+            resident[0] = False
+
+    reply = viewer.screenshot(statistics_callback=statistics_callback)
+    return reply.screenshot.image, resident[0]
+
+
+def print_prefetch_statistics(windows):
+    num_captures = sum(window.num_captures for window in windows)
+    if num_captures == 0:
+        return
+    num_resident = sum(window.num_resident for window in windows)
+    print(
+        "Captured %d/%d frames (%.1f%%) with all chunks resident, "
+        "mean prefetch depth %.1f"
+        % (
+            num_resident,
+            num_captures,
+            100.0 * num_resident / num_captures,
+            sum(window.total_depth for window in windows) / num_captures,
+        )
+    )
+
+
+def _render_shard_process(shard, create_viewer_func, keypoints, args, messages, work):
+    keypoint_states = [neuroglancer.ViewerState(k) for k in keypoints]
+    viewer = create_render_viewer(create_viewer_func, args)
+
+    def get_state(frame):
+        _, i, t = frame
+        state = neuroglancer.ViewerState.interpolate(
+            keypoint_states[i], keypoint_states[i + 1], t
+        ).to_json()
+        state["layers"] = viewer.state.to_json()["layers"]
+        return neuroglancer.ViewerState(state)
+
+    if args.state_updates == "camera":
+        render_states = RenderStates(
+            keypoint_states, viewer.shared_state.raw_state["layers"]
+        )
+    else:
+        render_states = None
+
+    window = PrefetchWindow(args.prefetch_frames)
+    while True:
+        messages.put(("request", shard, window.depth))
+        next_work = work.get()
+        if next_work is None:
+            return
+        frame, prefetch_frames = next_work
+
+        if render_states is not None:
+            set_render_state(
+                viewer,
+                render_states.get_state(frame[1], frame[2]),
+                [render_states.get_state(i, t) for _, i, t in prefetch_frames],
+            )
+        else:
+            viewer.set_state(get_state(frame))
+            with viewer.config_state.txn() as s:
+                del s.prefetch[:]
+                for i, prefetch_frame in enumerate(prefetch_frames):
+                    s.prefetch.append(
+                        neuroglancer.PrefetchState(
+                            state=get_state(prefetch_frame),
+                            priority=len(prefetch_frames) - i,
+                        )
+                    )
+        start_time = time.time()
+        data, resident = capture_frame(viewer)
+        duration = time.time() - start_time
+        window.update(duration, resident)
+        messages.put(
+            (
+                "done",
+                shard,
+                frame[0],
+                frame[1] + frame[2],
+                data,
+                duration,
+                resident,
+                window.depth,
+            )
+        )
+
+
+def run_render_processes(create_viewer_func, keypoints, args):
+    sink = get_frame_sink(args)
+    all_frames = get_render_frames(keypoints, args.fps)
+    frames = [
+        frame for frame in all_frames if not (args.resume and sink.has_frame(frame[0]))
+    ]
+    writer = OrderedFrameWriter(
+        sink, [frame[0] for frame in frames], args.max_buffered_frames
+    )
+
+    # initial contiguous ranges of frames per shard
+    frames_per_shard = int(math.ceil(len(frames) / args.shards))
+    shard_frames = [
+        collections.deque(
+            frames[shard * frames_per_shard : (shard + 1) * frames_per_shard]
+        )
+        for shard in range(args.shards)
+    ]
+
+    def next_frame(shard, prefetch_depth):
+        """Get the next frame for ``shard`` and the frames to prefetch,
+        ``None`` if there are no frames left, or ``"wait"`` if the writer is
+        full and waits for a frame that is already being rendered."""
+
+        if writer.is_full():
+            # only hand out the next frame to write, until the buffered
+            # frames can be written
+            remaining = [frames for frames in shard_frames if frames]
+            if not remaining:
+                return None
+            lowest = min(remaining, key=lambda frames: frames[0][0])
+            if lowest[0][0] != writer.next_frame_number:
+                return "wait"
+            return lowest.popleft(), []
+        if not shard_frames[shard]:
+            victim = max(shard_frames, key=len)
+            if not victim:
+                return None
+            stolen = [victim.pop() for _ in range((len(victim) + 1) // 2)]
+            shard_frames[shard].extend(reversed(stolen))
+        frame = shard_frames[shard].popleft()
+        prefetch_frames = list(itertools.islice(shard_frames[shard], prefetch_depth))
+        return frame, prefetch_frames
+
+    messages = multiprocessing.Queue()
+    work = [multiprocessing.Queue() for _ in range(args.shards)]
+    processes = [
+        multiprocessing.Process(
+            target=_render_shard_process,
+            args=(
+                shard,
+                create_viewer_func,
+                [k["state"].to_json() for k in keypoints],
+                args,
+                messages,
+                work[shard],
+            ),
+            daemon=True,
+        )
+        for shard in range(args.shards)
+    ]
+    for process in processes:
+        process.start()
+
+    progress = RenderProgress(len(all_frames), len(all_frames) - len(frames))
+    shard_stats = [[0, 0.0, 0, 0] for _ in range(args.shards)]
+    active_shards = args.shards
+    # requests of shards for work that could not be answered yet, since the
+    # writer is full
+    requests = collections.deque()
+    while active_shards > 0:
+        try:
+            message = messages.get(timeout=1)
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                raise RuntimeError("A render process died")
+            continue
+
+        if message[0] == "request":
+            _, shard, prefetch_depth = message
+            requests.append((shard, prefetch_depth))
+        else:
+            _, shard, frame_number, t, data, duration, resident, depth = message
+            # the writer holds at most max_buffered_frames plus the frames in
+            # flight, since no frames are handed out while it is full
+            writer.write(frame_number, data, block=False)
+            shard_stats[shard][0] += 1
+            shard_stats[shard][1] += duration
+            shard_stats[shard][2] += resident
+            shard_stats[shard][3] += depth
+            progress.update(t, len(keypoints), sink.get_name(frame_number))
+
+        while requests:
+            next_work = next_frame(*requests[0])
+            if next_work == "wait":
+                break
+            shard, _ = requests.popleft()
+            if next_work is None:
+                active_shards -= 1
+            work[shard].put(next_work)
+
+    for process in processes:
+        process.join()
+    writer.close()
+
+    elapsed = time.time() - progress.start_time
+    progress.print_summary()
+    for shard, (num_frames, capture_time, num_resident, total_depth) in enumerate(
+        shard_stats
+    ):
+        print(
+            "  shard %d: %d frames, %.2f frames/s (%.2f frames/s while capturing), "
+            "%d frames with all chunks resident, mean prefetch depth %.1f"
+            % (
+                shard,
+                num_frames,
+                num_frames / elapsed if elapsed > 0 else 0,
+                num_frames / capture_time if capture_time > 0 else 0,
+                num_resident,
+                total_depth / num_frames if num_frames > 0 else 0,
+            )
+        )
+
+
 def run_render(create_viewer_func, args=RenderArgs()):
     keypoints = load_script(args.script)
     num_prefetch_frames = args.prefetch_frames
@@ -536,81 +1324,83 @@ def run_render(create_viewer_func, args=RenderArgs()):
         keypoint["state"].cross_section_background_color = (
             args.cross_section_background_color
         )
-    viewers = [create_viewer_func() for _ in range(args.shards)]
-    for viewer in viewers:
-        with viewer.config_state.txn() as s:
-            s.show_ui_controls = False
-            s.show_panel_borders = False
-            s.viewer_size = [args.width, args.height]
-            s.scale_bar_options.scale_factor = args.scale_bar_scale
-
-        print("Open the specified URL to begin rendering")
-        print(viewer)
-        if args.browser:
-            webbrowser.open_new(viewer.get_viewer_url())
+    if args.headless:
+        return run_render_headless(create_viewer_func, keypoints, args)
+    if args.shard_mode == "processes":
+        return run_render_processes(create_viewer_func, keypoints, args)
+    viewers = [
+        create_render_viewer(create_viewer_func, args) for _ in range(args.shards)
+    ]
     lock = threading.Lock()
-    num_frames_written = [0]
+    prefetch_windows = []
     fps = args.fps
-    total_frames = sum(max(1, k["transition_duration"] * fps) for k in keypoints[:-1])
+    all_frames = get_render_frames(keypoints, fps)
+    total_frames = len(all_frames)
+    sink = get_frame_sink(args)
+    frames = [
+        frame for frame in all_frames if not (args.resume and sink.has_frame(frame[0]))
+    ]
+    progress = RenderProgress(total_frames, total_frames - len(frames))
+    writer = OrderedFrameWriter(
+        sink, [frame[0] for frame in frames], args.max_buffered_frames
+    )
 
     def render_func(viewer, start_frame, end_frame):
-        with lock:
-            saver = neuroglancer.ScreenshotSaver(viewer, args.output_directory)
+        if args.state_updates == "camera":
+            render_states = RenderStates(
+                [k["state"] for k in keypoints],
+                viewer.shared_state.raw_state["layers"],
+            )
+        else:
+            render_states = None
+
         states_to_capture = []
-        frame_number = 0
-        for i in range(len(keypoints) - 1):
-            a = keypoints[i]["state"]
-            b = keypoints[i + 1]["state"]
-            duration = keypoints[i]["transition_duration"]
-            num_frames = max(1, int(duration * fps))
-            for frame_i in range(num_frames):
-                t = frame_i / num_frames
-                if frame_number >= end_frame:
-                    return
-
-                if frame_number < start_frame:
-                    frame_number += 1
-                    continue
-
-                path = saver.get_path(frame_number)
-
-                if args.resume and os.path.exists(path):
-                    frame_number += 1
-                    with lock:
-                        num_frames_written[0] += 1
-                else:
-                    cur_state = neuroglancer.ViewerState.interpolate(a, b, t)
-                    states_to_capture.append((frame_number, i + t, cur_state))
-                    frame_number += 1
-        for frame_number, t, cur_state in states_to_capture:
+        for frame_number, i, t in frames:
+            if frame_number < start_frame or frame_number >= end_frame:
+                continue
+            if render_states is not None:
+                cur_state = render_states.get_state(i, t)
+            else:
+                cur_state = neuroglancer.ViewerState.interpolate(
+                    keypoints[i]["state"], keypoints[i + 1]["state"], t
+                )
+            states_to_capture.append((frame_number, i + t, cur_state))
+
+        window = PrefetchWindow(num_prefetch_frames)
+        with lock:
+            prefetch_windows.append(window)
+        for index, (frame_number, t, cur_state) in enumerate(states_to_capture):
+            # the frames this shard captures next
             prefetch_states = [
-                x[2]
-                for x in states_to_capture[
-                    frame_number + 1 : frame_number + 1 + num_prefetch_frames
-                ]
+                x[2] for x in states_to_capture[index + 1 : index + 1 + window.depth]
             ]
-            prev_state = viewer.state.to_json()
-            cur_state = cur_state.to_json()
-            cur_state["layers"] = prev_state["layers"]
-            cur_state = neuroglancer.ViewerState(cur_state)
-            viewer.set_state(cur_state)
-            if num_prefetch_frames > 0:
-                with viewer.config_state.txn() as s:
-                    del s.prefetch[:]
-                    for i, state in enumerate(prefetch_states[1:]):
-                        s.prefetch.append(
-                            neuroglancer.PrefetchState(
-                                state=state, priority=num_prefetch_frames - i
+            if render_states is not None:
+                set_render_state(
+                    viewer,
+                    cur_state,
+                    prefetch_states if num_prefetch_frames > 0 else [],
+                )
+            else:
+                prev_state = viewer.state.to_json()
+                cur_state = cur_state.to_json()
+                cur_state["layers"] = prev_state["layers"]
+                cur_state = neuroglancer.ViewerState(cur_state)
+                viewer.set_state(cur_state)
+                if num_prefetch_frames > 0:
+                    with viewer.config_state.txn() as s:
+                        del s.prefetch[:]
+                        for i, state in enumerate(prefetch_states):
+                            s.prefetch.append(
+                                neuroglancer.PrefetchState(
+                                    state=state, priority=len(prefetch_states) - i
+                                )
                             )
-                        )
-            frame_number, path = saver.capture(frame_number)
+            start_time = time.time()
+            data, resident = capture_frame(viewer)
+            window.update(time.time() - start_time, resident)
+            writer.write(frame_number, data)
             with lock:
-                num_frames_written[0] += 1
-                cur_num_frames_written = num_frames_written[0]
-                print(
-                    "[%07d/%07d] keypoint %.3f/%5d: %s"
-                    % (cur_num_frames_written, total_frames, t, len(keypoints), path)
-                )
+                progress.update(t, len(keypoints), sink.get_name(frame_number))
 
     shard_frames = []
     frames_per_shard = int(math.ceil(total_frames / args.shards))
@@ -626,3 +1416,6 @@ def run_render(create_viewer_func, args=RenderArgs()):
         t.start()
     for t in render_threads:
         t.join()
+    writer.close()
+    progress.print_summary()
+    print_prefetch_statistics(prefetch_windows)